@@ -0,0 +1,261 @@
+"""Append-only log of usage events and its daily rollups, kept apart from the bot database.
+
+Inline queries, chosen results, commands and registrations are buffered in memory and written in
+batches to a local SQLite file in WAL mode, ANALYTICS_DB, by default analytics.db in
+LOGPATH. Processes of a cluster share the file. `python manage.py rollup` aggregates
+the events into daily tables which admin commands read, e.g. from cron:
+
+    daily_usage             active users, inline queries and their hit rate, chosen results, commands, registrations
+    daily_queries           inline queries by text, with hits and chosen results
+    daily_shortcut_uses     chosen results per user and shortcut, which rank search results
+    daily_user_activity     events per user
+    cohorts                 registration day and start param of users, for retention
+"""
+import logging
+import sqlite3
+from contextlib import closing
+from datetime import date, datetime as dt, timedelta
+from os import getenv
+from os.path import join
+from time import time
+
+import metrics
+from flusher import BackgroundFlusher
+
+QUERY_LENGTH = 64                                               # Characters of a query or a command argument kept
+ANALYTICS_KEEP_DAYS = int(getenv('ANALYTICS_KEEP_DAYS', 90))    # Days events are kept after rollups, 0 to keep all
+RECENT_USES_DAYS = int(getenv('RECENT_USES_DAYS', 30))          # Days of chosen results which rank search results
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS events (
+    ts INTEGER NOT NULL,            -- Unix time, seconds
+    kind TEXT NOT NULL,             -- inline, chosen, command or register
+    user_id INTEGER NOT NULL,
+    shortcut_id INTEGER,            -- Chosen shortcut
+    text TEXT,                      -- Normalized query, command with its argument or start param
+    results INTEGER                 -- Shortcuts matching an inline query
+);
+CREATE INDEX IF NOT EXISTS ix_events_ts ON events (ts);
+CREATE TABLE IF NOT EXISTS daily_usage (
+    day TEXT PRIMARY KEY, active_users INTEGER, inline_queries INTEGER, inline_hits INTEGER, chosen_results INTEGER, commands INTEGER,
+    registrations INTEGER
+);
+CREATE TABLE IF NOT EXISTS daily_queries (
+    day TEXT, query TEXT, queries INTEGER, hits INTEGER, chosen INTEGER, PRIMARY KEY (day, query)
+);
+CREATE TABLE IF NOT EXISTS daily_shortcut_uses (
+    day TEXT, user_id INTEGER, shortcut_id INTEGER, uses INTEGER, PRIMARY KEY (day, user_id, shortcut_id)
+);
+CREATE INDEX IF NOT EXISTS ix_daily_shortcut_uses_user ON daily_shortcut_uses (user_id, day);
+CREATE TABLE IF NOT EXISTS daily_user_activity (
+    day TEXT, user_id INTEGER, events INTEGER, PRIMARY KEY (day, user_id)
+);
+CREATE TABLE IF NOT EXISTS cohorts (
+    user_id INTEGER PRIMARY KEY, day TEXT, start_param TEXT
+);
+'''
+
+# Days of events in local time, as the other stats of the bot
+DAY = "date(ts, 'unixepoch', 'localtime')"
+
+ROLLUP = [
+    'DELETE FROM daily_usage WHERE day >= :day',
+    f'''INSERT INTO daily_usage
+        SELECT {DAY} AS day, count(DISTINCT user_id), sum(kind = 'inline'), sum(kind = 'inline' AND results > 0),
+               sum(kind = 'chosen'), sum(kind = 'command'), sum(kind = 'register')
+        FROM events WHERE ts >= :ts GROUP BY day''',
+    'DELETE FROM daily_queries WHERE day >= :day',
+    f'''INSERT INTO daily_queries
+        SELECT {DAY} AS day, text, sum(kind = 'inline'), sum(kind = 'inline' AND results > 0), sum(kind = 'chosen')
+        FROM events WHERE ts >= :ts AND kind IN ('inline', 'chosen') AND text != '' GROUP BY day, text''',
+    'DELETE FROM daily_shortcut_uses WHERE day >= :day',
+    f'''INSERT INTO daily_shortcut_uses
+        SELECT {DAY} AS day, user_id, shortcut_id, count(*)
+        FROM events WHERE ts >= :ts AND kind = 'chosen' GROUP BY day, user_id, shortcut_id''',
+    'DELETE FROM daily_user_activity WHERE day >= :day',
+    f'''INSERT INTO daily_user_activity
+        SELECT {DAY} AS day, user_id, count(*) FROM events WHERE ts >= :ts GROUP BY day, user_id''',
+    f'''INSERT OR IGNORE INTO cohorts
+        SELECT user_id, {DAY}, text FROM events WHERE ts >= :ts AND kind = 'register' ''',
+]
+
+
+def analytics_path() -> str:
+    """SQLite file of the event log, none if ANALYTICS_DB is set empty"""
+    return getenv('ANALYTICS_DB', join(getenv('LOGPATH', '/tmp'), 'analytics.db'))
+
+
+# Files whose tables this process has created
+_created = set()
+
+
+def connect(path: str = None) -> sqlite3.Connection:
+    """Opens the event log, creating its tables on first use in the process"""
+    path = path or analytics_path()
+    connection = sqlite3.connect(path, timeout=10)
+    # Readers do not block writers of other processes, and commits do not wait for fsync
+    connection.execute('PRAGMA synchronous=NORMAL')
+    if path not in _created:
+        # WAL mode is persistent, set once with the tables
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.executescript(SCHEMA)
+        _created.add(path)
+    return connection
+
+
+def normalize_query(query: str) -> str:
+    return ' '.join((query or '').lower().split())[:QUERY_LENGTH]
+
+
+class EventLog(BackgroundFlusher):
+    """Write-behind buffer of usage events
+
+    Events are collected in memory and written by a background thread every
+    `flush_interval` seconds or as soon as `flush_size` are pending, in one transaction.
+    Up to `max_pending` events wait, the others are dropped. Pending events are also
+    written at exit.
+    """
+
+    thread_name = 'event-log'
+
+    def __init__(self, path: str = None, flush_interval: float = 10, flush_size: int = 1000, max_pending: int = 100000):
+        super().__init__(flush_interval)
+        self.path = path
+        self.flush_size = flush_size
+        self.max_pending = max_pending
+        self.dropped = 0
+        self._pending = []
+
+    def record(self, kind: str, user_id: int, shortcut_id: int = None, text: str = None, results: int = None):
+        """Buffer an event, never touches the file itself"""
+        with self._lock:
+            if len(self._pending) >= self.max_pending:
+                self.dropped += 1
+                return
+            self._pending.append((int(time()), kind, user_id, shortcut_id, text, results))
+            size = len(self._pending)
+        self._added(size, self.flush_size)
+
+    def record_inline_query(self, user_id: int, query: str, results: int):
+        self.record('inline', user_id, text=normalize_query(query), results=results)
+
+    def record_chosen_result(self, user_id: int, shortcut_id, query: str):
+        self.record('chosen', user_id, shortcut_id=int(shortcut_id), text=normalize_query(query))
+
+    def record_registration(self, user_id: int, start_param: str):
+        self.record('register', user_id, text=(start_param or '')[:QUERY_LENGTH])
+
+    def record_command(self, user_id: int, text: str):
+        """Records a command with its argument, e.g. a start param, without the bot's username"""
+        command, _, argument = (text or '').partition(' ')
+        command = command[1:].split('@')[0]
+        self.record('command', user_id, text=f'{command} {argument.strip()}'.strip()[:QUERY_LENGTH])
+
+    def flush(self):
+        """Write all pending events"""
+        with self._lock:
+            pending, self._pending = self._pending, []
+        path = self.path or analytics_path()
+        if not pending or not path:
+            return
+        try:
+            # The connection's context manager only commits, closing() closes it
+            with closing(connect(path)) as connection, connection:
+                connection.executemany('INSERT INTO events VALUES (?, ?, ?, ?, ?, ?)', pending)
+        except Exception as e:
+            # Analytics must never affect the bot, the events are lost
+            self.dropped += len(pending)
+            logging.error(f'Failed to write {len(pending)} usage events: {e}')
+
+
+event_log = EventLog(
+    flush_interval=float(getenv('ANALYTICS_FLUSH_INTERVAL', 10)),    # Seconds between writes of events
+    flush_size=int(getenv('ANALYTICS_FLUSH_SIZE', 1000)),            # Write earlier when so many events are pending
+    max_pending=int(getenv('ANALYTICS_MAX_PENDING', 100000))         # Events waiting to be written, the others are dropped
+)
+
+metrics.Gauge('analytics_events_pending', 'Usage events waiting to be written', event_log.pending)
+metrics.Gauge('analytics_events_dropped', 'Usage events dropped because the buffer was full or writing failed', lambda: event_log.dropped)
+
+
+def rollup(days: int = 2, keep_days: int = None, path: str = None) -> dict:
+    """Recomputes daily aggregates of the last `days` days, today included, and deletes events older than `keep_days`"""
+    since = date.today() - timedelta(days=days - 1)
+    params = {'day': since.isoformat(), 'ts': int(dt.combine(since, dt.min.time()).timestamp())}
+    connection = connect(path)
+    try:
+        with connection:
+            for statement in ROLLUP:
+                connection.execute(statement, params)
+        deleted = 0
+        if keep_days:
+            oldest = dt.combine(date.today() - timedelta(days=keep_days), dt.min.time())
+            with connection:
+                deleted = connection.execute('DELETE FROM events WHERE ts < ?', (int(oldest.timestamp()),)).rowcount
+        return {'days': days, 'events': connection.execute('SELECT count(*) FROM events WHERE ts >= :ts', params).fetchone()[0], 'deleted': deleted}
+    finally:
+        connection.close()
+
+
+def _read(query: str, params: tuple = (), path: str = None) -> list:
+    connection = connect(path)
+    try:
+        return connection.execute(query, params).fetchall()
+    finally:
+        connection.close()
+
+
+def _since(days: int) -> str:
+    return (date.today() - timedelta(days=days - 1)).isoformat()
+
+
+def get_daily_usage(days: int = 7) -> list:
+    """Returns (day, active users, inline queries, inline hits, chosen results, commands, registrations) rows of the last days"""
+    return _read('SELECT * FROM daily_usage WHERE day >= ? ORDER BY day', (_since(days),))
+
+
+def get_top_queries(days: int = 7, limit: int = 20) -> list:
+    """Returns (query, queries, hits, chosen) of the most frequent inline queries of the last days"""
+    return _read(
+        'SELECT query, sum(queries) AS total, sum(hits), sum(chosen) FROM daily_queries WHERE day >= ? GROUP BY query ORDER BY total DESC LIMIT ?',
+        (_since(days), limit)
+    )
+
+
+def get_retention(days: int = 30) -> list:
+    """Returns (start param, users, active a day later, active a week later) for users registered in the last days"""
+    return _read('''
+        SELECT c.start_param, count(*),
+               count(DISTINCT d1.user_id),
+               count(DISTINCT d7.user_id)
+        FROM cohorts c
+        LEFT JOIN daily_user_activity d1 ON d1.user_id = c.user_id AND d1.day = date(c.day, '+1 day')
+        LEFT JOIN daily_user_activity d7 ON d7.user_id = c.user_id AND d7.day = date(c.day, '+7 day')
+        WHERE c.day >= ?
+        GROUP BY c.start_param
+        ORDER BY count(*) DESC
+    ''', (_since(days),))
+
+
+def get_user_activity(days: int = 7) -> dict:
+    """Returns user id -> number of events of the last days"""
+    return dict(_read('SELECT user_id, sum(events) FROM daily_user_activity WHERE day >= ? GROUP BY user_id', (_since(days),)))
+
+
+
+def get_shortcut_uses(user_id: int, days: int = RECENT_USES_DAYS) -> dict:
+    """Returns shortcut id -> times the user chose it in the last days, up to the last rollup
+
+    Read when a user's search index is loaded. An empty dict if the log is disabled or can't be read,
+    so search falls back to total usage.
+    """
+    if not days or not analytics_path():
+        return {}
+    try:
+        return dict(_read(
+            'SELECT shortcut_id, sum(uses) FROM daily_shortcut_uses WHERE user_id = ? AND day >= ? GROUP BY shortcut_id',
+            (user_id, _since(days))
+        ))
+    except sqlite3.Error as e:
+        logging.error(f'Failed to read recent uses of shortcuts of {user_id}: {e}')
+        return {}
@@ -0,0 +1,417 @@
+#!/usr/bin/env python3
+"""Asyncio runtime of the bot: the same handlers on AsyncTeleBot and the async database layer.
+
+Selected with BOT_RUNTIME=async, see bot.py.
+"""
+import asyncio
+import logging
+from operator import attrgetter
+from os import getenv
+from random import sample
+from traceback import format_exc
+
+import telebot as tb
+from sqlalchemy.exc import IntegrityError
+from telebot.async_telebot import AsyncTeleBot
+from telebot.asyncio_handler_backends import BaseMiddleware, ContinueHandling
+
+from bot import (
+    check_environment, setup_logging, help_message, add_message, welcome_message, no_shortcuts_msg, error_msg, duplicate_name_msg, text_name_msg, broken_shortcuts_msg, log_chat_id,
+    import_message, import_result_msg, DOWNLOAD_SIZE_LIMIT, ALLOWED_UPDATES, INLINE_PAGE_SIZE, LIST_PAGE_SIZE, get_cached_results, complete_results, get_shortcut_context,
+    format_inline_offset, parse_inline_offset, instrument_inline_results_cache,
+    get_list_page, get_list_header, get_command_number, format_user_line, format_registrations,
+    format_top_shortcuts, format_daily_active_users, format_daily_usage, format_top_queries, format_retention, MessageChunker
+)
+from models import (
+    async_create_user, async_get_user, async_add_shortcut, async_get_shortcuts, async_get_shortcut_names,
+    async_search_shortcuts_page, async_get_shortcuts_by_ids,
+    async_get_shortcut, async_delete_shortcut, async_iter_users_list, async_get_users_count, async_get_registrations,
+    async_get_top_shortcuts, async_get_daily_active_users, async_record_activity,
+    async_is_admin, get_cache_stats, rebuild_stats, get_media_stats
+)
+from usage import usage_aggregator
+from sender import AsyncSender, AsyncForwardBatcher, shortcuts_plan
+from state import create_state_store
+from transfer import export_file, import_url
+from media import start_media_validator
+from analytics import event_log, get_daily_usage, get_top_queries, get_retention, get_user_activity
+from metrics import handler_timed, instrument_telegram_api, start_update, finish_update, start_metrics_server
+
+# Created by init(), handlers use these globals
+bot = None
+sender = None
+forwarder = None
+state_store = None
+
+class ActivityMiddleware(BaseMiddleware):
+    """Records users active today for daily active users stats"""
+    def __init__(self):
+        self.update_types = ['message', 'inline_query', 'chosen_inline_result']
+
+    async def pre_process(self, message, data):
+        try:
+            await async_record_activity(message.from_user.id)
+        except Exception:
+            logging.error(format_exc())
+
+    async def post_process(self, message, data, exception):
+        pass
+
+class AnalyticsMiddleware(BaseMiddleware):
+    """Records commands in the usage event log"""
+    def __init__(self):
+        self.update_types = ['message']
+
+    async def pre_process(self, message, data):
+        if (message.text or '').startswith('/'):
+            event_log.record_command(message.from_user.id, message.text)
+
+    async def post_process(self, message, data, exception):
+        pass
+
+class MetricsMiddleware(BaseMiddleware):
+    """Counts DB round-trips per update"""
+    def __init__(self):
+        self.update_types = ['message', 'inline_query', 'chosen_inline_result']
+
+    async def pre_process(self, message, data):
+        start_update()
+
+    async def post_process(self, message, data, exception):
+        finish_update(type(message).__name__)
+
+async def register_next_step(message, handler, **context):
+    """Route the next message of the chat to the handler, `context` must be JSON serializable"""
+    await state_store.async_set(message.chat.id, handler.__name__, context)
+
+@handler_timed
+async def process_next_step(message):
+    """Call a pending step handler of the chat instead of regular handlers"""
+    state = await state_store.async_pop(message.chat.id)
+    if state is None or state[0] not in next_step_handlers:
+        return ContinueHandling()
+    step, context = state
+    await next_step_handlers[step](message, **context)
+
+@handler_timed
+async def send_welcome(message):
+    """Send welcome-message when a user send a command at the first time else help-message with a list of available commands."""
+    logging.info(f'''{message.from_user.username or message.from_user.id}: {message.text}''')
+    if await async_get_user(message.from_user.id):
+        await bot.reply_to(message=message, text=help_message)
+    else:
+        params = message.text.split(maxsplit=1)
+        start_param = params[1] if len(params) > 1 else None
+        await async_create_user(telegram_user_id=message.from_user.id, username=message.from_user.username, start_param=start_param)
+        event_log.record_registration(message.from_user.id, start_param)
+        await bot.reply_to(message=message, text=welcome_message.format(first_name=message.from_user.first_name, last_name=message.from_user.last_name))
+
+@handler_timed
+async def handle_add_shortcut(message):
+    """Ask a content for a new Shortcut, then a name for it. Create a corresponding object in DB"""
+    logging.info(f'''{message.from_user.username or message.from_user.id}: add''')
+    msg = await bot.reply_to(message=message, text=add_message, parse_mode='MarkdownV2')
+    await register_next_step(msg, process_add_shortcut_content)
+
+@handler_timed
+async def process_add_shortcut_content(message):
+    """Ask for a name for a new shortcut"""
+    try:
+        msg = await bot.reply_to(message, f'''{sample(['Great', 'Magnificent', 'Fantastic', 'Wonderful'], k=1)[0]}! Now give me a short name for your shortcut:''')
+        await register_next_step(msg, process_add_shortcut_name, context=get_shortcut_context(message))
+    except Exception:
+        logging.error(format_exc())
+        await bot.reply_to(message=message, text=error_msg)
+
+@handler_timed
+async def process_add_shortcut_name(message, context):
+    """Save a Shortcut to BD"""
+    if not message.text:
+        msg = await bot.reply_to(message=message, text=text_name_msg)
+        await register_next_step(msg, process_add_shortcut_name, context=context)
+        return
+    try:
+        await async_add_shortcut(**context, telegram_user_id=message.from_user.id, shortcut_name=message.text)
+        await bot.reply_to(message=message, text=f'Shortcut "{message.text}" was successfully saved!')
+        logging.info(f'''{message.from_user.username or message.from_user.id}: added {context['content_type']} shortcut''')
+    except IntegrityError:
+        if await async_get_shortcut(message.from_user.id, message.text) is None:
+            logging.error(format_exc())
+            await bot.reply_to(message=message, text=error_msg)
+            return
+        # Names are unique per user, ask for another one
+        msg = await bot.reply_to(message=message, text=duplicate_name_msg.format(name=message.text))
+        await register_next_step(msg, process_add_shortcut_name, context=context)
+    except Exception:
+        logging.error(format_exc())
+        await bot.reply_to(message=message, text=error_msg)
+
+@handler_timed
+async def list_shortcuts_handler(message):
+    """List stored Shortcuts of a user, one page at a time"""
+    logging.info(f'''{message.from_user.username or message.from_user.id}: list''')
+    shortcuts = await async_get_shortcuts(message.from_user.id)
+    sendable = sorted((x for x in shortcuts if not x.is_broken), key=attrgetter('id'))
+    broken, shortcuts = len(shortcuts) - len(sendable), sendable
+    if not shortcuts:
+        await bot.reply_to(message=message, text=broken_shortcuts_msg.format(broken=broken) if broken else no_shortcuts_msg)
+        return
+    page, pages = get_list_page(message, len(shortcuts))
+    await bot.reply_to(message=message, text=get_list_header(len(shortcuts), page, pages, broken))
+    start = (page - 1) * LIST_PAGE_SIZE
+    page_shortcuts = await async_get_shortcuts_by_ids(message.from_user.id, [x.id for x in shortcuts[start: start + LIST_PAGE_SIZE]])
+    await sender.run(message.from_user.id, shortcuts_plan(page_shortcuts, start=start + 1))
+    if page < pages:
+        await sender.call('send_message', message.from_user.id, text=f'Send /list {page + 1} for the next page')
+
+@handler_timed
+async def delete_shortcut_handler(message):
+    """Ask which Shortcut from list of available Shortcuts to delete"""
+    logging.info(f'''{message.from_user.username or message.from_user.id}: delete''')
+    names = await async_get_shortcut_names(message.from_user.id)
+    if names:
+        kb = tb.types.ReplyKeyboardMarkup(one_time_keyboard=True)
+        for i in range(0, len(names), 2):
+            kb.add(*[f'"{name}"' for name in names[i: i + 2]])
+        kb.add('Cancel')
+        msg = await bot.reply_to(message=message, text='''Which shortcut do you want to delete?''', reply_markup=kb)
+        await register_next_step(msg, process_delete_shortcut)
+    else:
+        await bot.reply_to(message=message, text=no_shortcuts_msg)
+
+@handler_timed
+async def process_delete_shortcut(msg):
+    """Delete chosen Shortcut or cancel if 'Cancel' option was chosed"""
+    shortcut = await async_get_shortcut(telegram_user_id=msg.from_user.id, shortcut_name=(msg.text or '')[1:-1])
+    if shortcut:
+        await async_delete_shortcut(shortcut.id)
+        await bot.reply_to(message=msg, text=f'''Shortcut `{shortcut.shortcut_name}` was successfully deleted!''', reply_markup=tb.types.ReplyKeyboardRemove())
+    elif msg.text == 'Cancel':
+        await bot.reply_to(message=msg, text='Deletion was cancelled', reply_markup=tb.types.ReplyKeyboardRemove())
+    else:
+        await bot.reply_to(message=msg, text='Please, use the Telegram keyboard')
+
+@handler_timed
+async def export_handler(message):
+    """Send all Shortcuts of a user as a JSON Lines file"""
+    logging.info(f'''{message.from_user.username or message.from_user.id}: export''')
+    shortcuts = await async_get_shortcuts(message.from_user.id)
+    if not shortcuts:
+        await bot.reply_to(message=message, text=no_shortcuts_msg)
+        return
+    with await asyncio.to_thread(export_file, message.from_user.id) as file:
+        await bot.send_document(message.chat.id, file, visible_file_name='shortcuts.jsonl', caption=f'{len(shortcuts)} shortcuts')
+
+@handler_timed
+async def import_handler(message):
+    """Ask for a JSON Lines file with Shortcuts to import"""
+    logging.info(f'''{message.from_user.username or message.from_user.id}: import''')
+    msg = await bot.reply_to(message=message, text=import_message)
+    await register_next_step(msg, process_import_file)
+
+@handler_timed
+async def process_import_file(message):
+    """Import Shortcuts from a sent file, streaming it line by line"""
+    if message.content_type != 'document':
+        await bot.reply_to(message=message, text='Import was cancelled, send /import and then a file')
+        return
+    if (message.document.file_size or 0) > DOWNLOAD_SIZE_LIMIT:
+        await bot.reply_to(message=message, text='Sorry, the file is too big, I can read files up to 20 MB')
+        return
+    try:
+        url = await bot.get_file_url(message.document.file_id)
+        result = await asyncio.to_thread(import_url, message.from_user.id, url)
+        await bot.reply_to(message=message, text=import_result_msg.format(**result))
+        logging.info(f'''{message.from_user.username or message.from_user.id}: imported {result['imported']} shortcuts''')
+    except Exception:
+        logging.error(format_exc())
+        await bot.reply_to(message=message, text=error_msg)
+
+# Handlers which can be a pending step, by the names kept in the state store
+next_step_handlers = {handler.__name__: handler for handler in (
+    process_add_shortcut_content, process_add_shortcut_name, process_delete_shortcut, process_import_file
+)}
+
+@handler_timed
+async def query_text(inline_query):
+    """List shortcuts matching the text and ranked by use, a page at a time"""
+    logging.info(f'''{inline_query.from_user.username or inline_query.from_user.id}: inline ({inline_query.query})''')
+    after, all_shortcuts = parse_inline_offset(inline_query.offset)
+    found_shortcuts, last_key = [], None
+    if not all_shortcuts:
+        found_shortcuts, last_key = await async_search_shortcuts_page(inline_query.from_user.id, inline_query.query, limit=INLINE_PAGE_SIZE, after=after)
+    if not found_shortcuts and (all_shortcuts or after is None):
+        all_shortcuts = True
+        found_shortcuts, last_key = await async_search_shortcuts_page(inline_query.from_user.id, '', limit=INLINE_PAGE_SIZE, after=after)
+    if after is None:
+        event_log.record_inline_query(inline_query.from_user.id, inline_query.query, 0 if all_shortcuts else len(found_shortcuts))
+    results = get_cached_results(found_shortcuts)
+    missing = [shortcut_id for shortcut_id, result in results.items() if result is None]
+    results = complete_results(results, await async_get_shortcuts_by_ids(inline_query.from_user.id, missing))
+    if not found_shortcuts and after is None:
+        results.append(
+            tb.types.InlineQueryResultArticle(
+                id='1',
+                title='Test shortcut',
+                input_message_content=tb.types.InputTextMessageContent(
+                    message_text='This is a test shortcut. It will disappear from your search results when you add your first own shortcut in direct messages of @shortcut_robot.'
+                )
+            )
+        )
+    await bot.answer_inline_query(
+        inline_query.id,
+        results,
+        cache_time=1,
+        is_personal=True,
+        next_offset=format_inline_offset(last_key, all_shortcuts) if last_key else '',
+        button=tb.types.InlineQueryResultsButton(
+            text='Add a new shortcut' if found_shortcuts else 'Add your own shortcut',
+            start_parameter='from_menu'
+        )
+    )
+
+@handler_timed
+async def handle_chosen_shortcut(chosen_result):
+    """Increase number of uses of a Shortcut and update last use datetime"""
+    # Buffered and flushed by a background thread, so it does not block the event loop
+    usage_aggregator.record(chosen_result.result_id, chosen_result.from_user.id)
+    event_log.record_chosen_result(chosen_result.from_user.id, chosen_result.result_id, chosen_result.query)
+
+@handler_timed
+async def admin_get_users(message):
+    """List all the users with reg dates, # of saved shortcuts and source of registration (only for admins)"""
+    if await async_is_admin(message.from_user.id):
+        chunker = MessageChunker(title=f'Users list, {await async_get_users_count()} in total')
+        activity = await asyncio.to_thread(get_user_activity, days=7)
+        async for user in async_iter_users_list():
+            for text in chunker.add(format_user_line(user, activity.get(user.telegram_user_id, 0))):
+                await sender.call('send_message', message.chat.id, text=text, parse_mode='markdown')
+        for text in chunker.flush():
+            await sender.call('send_message', message.chat.id, text=text, parse_mode='markdown')
+
+@handler_timed
+async def admin_registrations(message):
+    """Show numbers of users registered by each start param (only for admins)"""
+    if await async_is_admin(message.from_user.id):
+        await bot.reply_to(message=message, text=format_registrations(await async_get_registrations()))
+
+@handler_timed
+async def admin_top_shortcuts(message):
+    """Show the most used shortcuts of all users (only for admins)"""
+    if await async_is_admin(message.from_user.id):
+        await bot.reply_to(message=message, text=format_top_shortcuts(await async_get_top_shortcuts(get_command_number(message, 10))))
+
+@handler_timed
+async def admin_daily_active_users(message):
+    """Show numbers of daily active users for the last days (only for admins)"""
+    if await async_is_admin(message.from_user.id):
+        await bot.reply_to(message=message, text=format_daily_active_users(await async_get_daily_active_users(get_command_number(message, 7))))
+
+@handler_timed
+async def admin_rebuild_stats(message):
+    """Recount users and shortcuts stats from scratch (only for admins)"""
+    if await async_is_admin(message.from_user.id):
+        await asyncio.to_thread(rebuild_stats)
+        await bot.reply_to(message=message, text='Stats were rebuilt')
+
+@handler_timed
+async def admin_cache_stats(message):
+    """Show hit/miss/eviction counters of the shortcut cache (only for admins)"""
+    if await async_is_admin(message.from_user.id):
+        await bot.reply_to(message=message, text='\n'.join(f'{key}: {value}' for key, value in get_cache_stats().items()))
+
+@handler_timed
+async def admin_usage(message):
+    """Show daily usage aggregated from the event log for the last days (only for admins)"""
+    if await async_is_admin(message.from_user.id):
+        await bot.reply_to(message=message, text=format_daily_usage(await asyncio.to_thread(get_daily_usage, get_command_number(message, 7))))
+
+@handler_timed
+async def admin_top_queries(message):
+    """Show the most frequent inline queries of the last week and how often they find something (only for admins)"""
+    if await async_is_admin(message.from_user.id):
+        await bot.reply_to(message=message, text=format_top_queries(await asyncio.to_thread(get_top_queries, limit=get_command_number(message, 20))))
+
+@handler_timed
+async def admin_retention(message):
+    """Show how many users registered in the last days came back, by start param (only for admins)"""
+    if await async_is_admin(message.from_user.id):
+        await bot.reply_to(message=message, text=format_retention(await asyncio.to_thread(get_retention, get_command_number(message, 30, maximum=365))))
+
+@handler_timed
+async def admin_media_stats(message):
+    """Show numbers of validated and broken files of media shortcuts (only for admins)"""
+    if await async_is_admin(message.from_user.id):
+        await bot.reply_to(message=message, text='\n'.join(f'{key}: {value}' for key, value in (await asyncio.to_thread(get_media_stats)).items()))
+
+# Handle all other messages.
+@handler_timed
+async def catch_all(message):
+    if not await async_is_admin(message.from_user.id):
+        forwarder.add(message.chat.id, message.id)
+
+def register_handlers(bot):
+    """Registers all handlers in the order they are checked"""
+    bot.register_message_handler(process_next_step, func=lambda message: True, content_types=tb.util.content_type_media)
+    bot.register_message_handler(send_welcome, commands=['start', 'help'])
+    bot.register_message_handler(handle_add_shortcut, commands=['add'])
+    bot.register_message_handler(list_shortcuts_handler, commands=['list'])
+    bot.register_message_handler(delete_shortcut_handler, commands=['delete'])
+    bot.register_message_handler(export_handler, commands=['export'])
+    bot.register_message_handler(import_handler, commands=['import'])
+    bot.register_inline_handler(query_text, func=lambda query: True)
+    bot.register_chosen_inline_handler(handle_chosen_shortcut, func=lambda query: True)
+    bot.register_message_handler(admin_get_users, commands=['get_users'])
+    bot.register_message_handler(admin_registrations, commands=['registrations'])
+    bot.register_message_handler(admin_top_shortcuts, commands=['top_shortcuts'])
+    bot.register_message_handler(admin_daily_active_users, commands=['dau'])
+    bot.register_message_handler(admin_rebuild_stats, commands=['rebuild_stats'])
+    bot.register_message_handler(admin_cache_stats, commands=['cache_stats'])
+    bot.register_message_handler(admin_media_stats, commands=['media_stats'])
+    bot.register_message_handler(admin_usage, commands=['usage'])
+    bot.register_message_handler(admin_top_queries, commands=['top_queries'])
+    bot.register_message_handler(admin_retention, commands=['retention'])
+    bot.register_message_handler(catch_all, func=lambda message: True, content_types=['audio', 'photo', 'voice', 'video', 'document', 'text', 'location', 'contact', 'sticker'])
+
+def init() -> AsyncTeleBot:
+    """Application factory of the asyncio runtime, see bot.init()"""
+    global bot, sender, forwarder, state_store
+    check_environment()
+    setup_logging()
+    if getenv('TELEGRAM_API_URL'):
+        tb.asyncio_helper.API_URL = getenv('TELEGRAM_API_URL')
+        # Used by the media validator thread
+        tb.apihelper.API_URL = getenv('TELEGRAM_API_URL')
+    state_store = create_state_store()
+    instrument_telegram_api()
+    instrument_inline_results_cache()
+    bot = AsyncTeleBot(getenv('TGTOKEN').strip())
+    bot.setup_middleware(MetricsMiddleware())
+    bot.setup_middleware(ActivityMiddleware())
+    bot.setup_middleware(AnalyticsMiddleware())
+    register_handlers(bot)
+    sender = AsyncSender(bot, global_rate=float(getenv('SEND_GLOBAL_RATE', 30)), chat_rate=float(getenv('SEND_CHAT_RATE', 1)))
+    forwarder = AsyncForwardBatcher(
+        sender, log_chat_id, flush_interval=float(getenv('FORWARD_FLUSH_INTERVAL', 5)), max_pending=int(getenv('FORWARD_MAX_PENDING', 10000))
+    )
+    return bot
+
+def run():
+    """Start polling with the asyncio runtime"""
+    init()
+    # A thread with blocking getFile calls and DB access, off the event loop
+    start_media_validator(bot.token)
+    if getenv('METRICS_PORT'):
+        start_metrics_server(int(getenv('METRICS_PORT')), host=getenv('METRICS_HOST', '127.0.0.1'))
+    logging.info("Starting async bot polling...")
+
+    async def polling():
+        try:
+            await bot.infinity_polling(allowed_updates=ALLOWED_UPDATES)
+        finally:
+            await forwarder.stop()
+
+    asyncio.run(polling())
+
+if __name__ == '__main__':
+    run()
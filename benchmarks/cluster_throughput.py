@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+"""Throughput of inline query bursts with the multi-process runtime for different numbers of workers.
+
+Updates are handed to cluster.ClusterDispatcher as in CLUSTER_WORKERS mode, Telegram Bot API
+is replaced by the stub of load_test.py. Every run warms up caches of all users first,
+then measures a burst. On a machine with enough cores throughput should grow almost
+linearly with the number of workers, until the database or the stub becomes the limit.
+
+    python benchmarks/cluster_throughput.py --processes 1 --processes 2 --processes 4
+"""
+import argparse
+import os
+from tempfile import mkdtemp
+from time import perf_counter, sleep
+
+from load_test import Workload, start_fake_api
+
+
+def wait_processed(cluster, number: int, timeout: float = 600):
+    """Waits until workers have processed `number` updates in total"""
+    deadline = perf_counter() + timeout
+    while sum(worker.processed.value for worker in cluster.workers) < number:
+        if perf_counter() > deadline:
+            raise TimeoutError(f'Workers have not processed {number} updates in {timeout} s')
+        sleep(0.005)
+
+
+def run(cluster_module, processes: int, threads: int, workload: Workload, updates: int) -> dict:
+    cluster = cluster_module.ClusterDispatcher(processes, threads=threads, queue_size=0)
+    cluster.start()
+    try:
+        warmup = [workload.inline_query(user_id) for user_id in workload.user_ids]
+        for update in warmup:
+            cluster.put(update)
+        wait_processed(cluster, len(warmup))
+
+        burst = workload.updates('inline', updates)
+        start = perf_counter()
+        for update in burst:
+            cluster.put(update)
+        wait_processed(cluster, len(warmup) + len(burst))
+        elapsed = perf_counter() - start
+    finally:
+        cluster.stop()
+    return {'processes': processes, 'updates': len(burst), 'seconds': round(elapsed, 2), 'throughput': round(len(burst) / elapsed, 1)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--processes', type=int, action='append', help='numbers of worker processes, 1, 2 and 4 by default')
+    parser.add_argument('--threads', type=int, default=8, help='threads of every worker process')
+    parser.add_argument('--users', type=int, default=200, help='number of synthetic users')
+    parser.add_argument('--shortcuts', type=int, default=50, help='shortcuts per user')
+    parser.add_argument('--updates', type=int, default=5000, help='inline queries of a burst')
+    parser.add_argument('--api-latency', type=float, default=0, help='delay of every fake Telegram API call, ms')
+    parser.add_argument('--seed', type=int, default=1, help='random seed of the workload')
+    args = parser.parse_args()
+
+    # Environment of bot.py, inherited by worker processes
+    workdir = mkdtemp(prefix='shortcut_cluster_')
+    os.environ.setdefault('DATABASE_URL', f'sqlite:///{os.path.join(workdir, "bench.db")}')
+    os.environ.setdefault('TGTOKEN', '123456:BENCHMARK')
+    os.environ.setdefault('LOG_CHAT_ID', '-1')
+    os.environ['LOGPATH'] = workdir
+    # Handlers log every update at INFO level
+    os.environ.setdefault('LOG_LEVEL', 'WARNING')
+    os.environ['TELEGRAM_API_URL'] = f'http://127.0.0.1:{start_fake_api(args.api_latency / 1000)}/bot{{0}}/{{1}}'
+
+    import models
+    import cluster as cluster_module
+
+    models.migrate()
+    workload = Workload(args.users, args.shortcuts, args.seed)
+    workload.seed(models)
+
+    print(f'{"processes":>10}{"updates":>10}{"seconds":>10}{"throughput":>12}')
+    for processes in args.processes or [1, 2, 4]:
+        result = run(cluster_module, processes, args.threads, workload, args.updates)
+        print(f'{result["processes"]:>10}{result["updates"]:>10}{result["seconds"]:>10}{result["throughput"]:>12}')
+
+
+if __name__ == '__main__':
+    main()
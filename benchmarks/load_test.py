@@ -0,0 +1,424 @@
+#!/usr/bin/env python3
+"""Load test of the bot handlers against a fake Telegram API.
+
+Synthetic streams of updates are processed by the real handlers of bot.py:
+inline queries, chosen inline results, /add flows and /list. Telegram Bot API
+is replaced by a local stub HTTP server and the database by a fresh SQLite file,
+unless DATABASE_URL points to another database, e.g. a local Postgres.
+
+Updates are dispatched as in webhook mode: by user id to a pool of workers.
+For every scenario it reports throughput, p50/p95/p99 latency of an update and
+DB statements per update. Functions on the inline and /list paths
+(get_shortcuts, search_shortcuts, get_shortcuts_by_ids, get_input_content) are measured separately.
+
+    python benchmarks/load_test.py --users 500 --shortcuts 100 --updates 5000
+    python benchmarks/load_test.py --scenario inline --scenario list --cold
+    python benchmarks/load_test.py --output before.json
+    python benchmarks/load_test.py --baseline before.json --tolerance 0.2
+
+With --baseline the script exits with code 1 if p95 latency or DB statements
+per update of any scenario got worse than in the baseline by more than the tolerance.
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+from datetime import datetime as dt, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from itertools import count
+from multiprocessing import Process, Queue
+from random import Random
+from tempfile import mkdtemp
+from threading import local
+from time import perf_counter, sleep, time
+from urllib.parse import parse_qsl, urlsplit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+SCENARIOS = ['inline', 'chosen', 'add', 'list']
+WORDS = ['hello', 'address', 'invoice', 'meeting', 'thanks', 'schedule', 'phone', 'wifi', 'card', 'promo',
+         'welcome', 'price', 'delivery', 'support', 'refund', 'password', 'menu', 'location', 'sorry', 'link']
+# Share of each content type among generated shortcuts. Audio and location are left out:
+# inline results of them cannot be built with the current pyTelegramBotAPI and are skipped
+CONTENT_TYPES = [('text', 0.7), ('photo', 0.15), ('document', 0.1), ('video', 0.05)]
+
+
+class FakeTelegramAPI(BaseHTTPRequestHandler):
+    """Answers Bot API calls with minimal valid results, optionally after a delay"""
+    protocol_version = 'HTTP/1.1'
+    # Headers and body are written separately, Nagle's algorithm would delay every response
+    disable_nagle_algorithm = True
+    latency = 0
+    message_ids = count(1)
+
+    def do_POST(self):
+        url = urlsplit(self.path)
+        method_name = url.path.rsplit('/', 1)[-1]
+        params = dict(parse_qsl(url.query))
+        length = int(self.headers.get('Content-Length') or 0)
+        if length:
+            body = self.rfile.read(length)
+            if self.headers.get('Content-Type', '').startswith('application/x-www-form-urlencoded'):
+                params.update(parse_qsl(body.decode('utf-8')))
+        if self.latency:
+            sleep(self.latency)
+        data = json.dumps({'ok': True, 'result': self.result(method_name, params)}).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    do_GET = do_POST
+
+    def result(self, method_name: str, params: dict):
+        if method_name == 'getMe':
+            return {'id': 1, 'is_bot': True, 'first_name': 'Shortcut Holder', 'username': 'shortcut_robot'}
+        if method_name.startswith(('answer', 'set', 'delete')):
+            return True
+        chat = {'id': int(params.get('chat_id', 0)), 'type': 'private'}
+        if method_name == 'sendMediaGroup':
+            return [
+                {'message_id': next(self.message_ids), 'date': int(time()), 'chat': chat}
+                for _ in json.loads(params.get('media', '[]'))
+            ]
+        if method_name == 'forwardMessages':
+            return [{'message_id': next(self.message_ids)} for _ in json.loads(params.get('message_ids', '[]'))]
+        return {'message_id': next(self.message_ids), 'date': int(time()), 'chat': chat, 'text': params.get('text', '')}
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve_fake_api(latency: float, ports: Queue):
+    FakeTelegramAPI.latency = latency
+    server = ThreadingHTTPServer(('127.0.0.1', 0), FakeTelegramAPI)
+    server.daemon_threads = True
+    ports.put(server.server_address[1])
+    server.serve_forever()
+
+
+def start_fake_api(latency: float) -> int:
+    """Runs the stub in another process, so it does not compete with the bot for GIL. Returns its port"""
+    ports = Queue()
+    Process(target=serve_fake_api, args=(latency, ports), name='fake-telegram-api', daemon=True).start()
+    return ports.get(timeout=10)
+
+
+def percentile(values: list, p: float):
+    values = sorted(values)
+    return values[min(int(len(values) * p), len(values) - 1)] if values else None
+
+
+def summary(latencies: list, queries: list = None, elapsed: float = None) -> dict:
+    """Latencies in milliseconds, throughput in updates per second"""
+    result = {
+        'count': len(latencies),
+        'p50_ms': round(percentile(latencies, 0.5) * 1000, 3),
+        'p95_ms': round(percentile(latencies, 0.95) * 1000, 3),
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 3),
+        'max_ms': round(max(latencies) * 1000, 3),
+    }
+    if elapsed is not None:
+        result['throughput'] = round(len(latencies) / elapsed, 1)
+    if queries is not None:
+        result['db_queries_per_update'] = round(sum(queries) / len(queries), 2)
+        result['db_queries_max'] = max(queries)
+    return result
+
+
+def _insert(model, row: dict):
+    """Insert statement of a model's table limited to the columns of a row"""
+    from sqlalchemy import column, insert, table
+    columns = model.__table__.c
+    return insert(table(model.__tablename__, *(column(name, columns[name].type) for name in row)))
+
+
+class Workload:
+    """Seeds the database and generates updates of synthetic users"""
+
+    def __init__(self, users: int, shortcuts: int, seed: int):
+        self.rng = Random(seed)
+        self.user_ids = [1000 + i for i in range(users)]
+        self.shortcuts_per_user = shortcuts
+        self.shortcuts = {}     # user id -> [(shortcut id, name)]
+        self.update_ids = count(1)
+        self.message_ids = count(1)
+
+    def shortcut_rows(self):
+        now = dt.now()
+        content_types, weights = zip(*CONTENT_TYPES)
+        shortcut_id = count(1)
+        for user_id in self.user_ids:
+            rows = self.shortcuts[user_id] = []
+            for i in range(self.shortcuts_per_user):
+                content_type = self.rng.choices(content_types, weights)[0]
+                name = f'{self.rng.choice(WORDS)} {self.rng.choice(WORDS)} {i}'
+                text = ' '.join(self.rng.choices(WORDS, k=self.rng.randint(3, 60)))
+                row = {
+                    'id': next(shortcut_id),
+                    'telegram_user_id': user_id,
+                    'shortcut_name': name,
+                    'content_type': content_type,
+                    'text': text,
+                    'content': None,
+                    'entities': [{'type': 'bold', 'offset': 0, 'length': 5}] if content_type == 'text' and i % 3 == 0 else [],
+                    'add_dt': now - timedelta(days=i),
+                    'update_dt': now - timedelta(days=i),
+                    'num_of_uses': self.rng.randint(0, 100),
+                    'last_use_dt': now - timedelta(minutes=self.rng.randint(0, 10000)),
+                }
+                if content_type != 'text':
+                    row['content'] = f'{content_type}-file-{row["id"]}'
+                rows.append((row['id'], name))
+                yield row
+
+    def seed(self, models, batch_size: int = 5000):
+        """Inserts users and their shortcuts with bulk statements and recounts stats
+
+        Only the columns of the rows are inserted, so a database at an older revision can be seeded too.
+        """
+        now = dt.now()
+        with models.get_engine().begin() as connection:
+            users = [
+                {'telegram_user_id': user_id, 'username': f'user{user_id}', 'created_at': now, 'start_param': None}
+                for user_id in self.user_ids
+            ]
+            connection.execute(_insert(models.User, users[0]), users)
+            batch = []
+            for row in self.shortcut_rows():
+                batch.append(row)
+                if len(batch) >= batch_size:
+                    connection.execute(_insert(models.Shortcut, batch[0]), batch)
+                    batch = []
+            if batch:
+                connection.execute(_insert(models.Shortcut, batch[0]), batch)
+        models.rebuild_stats()
+
+    def _user(self, user_id: int) -> dict:
+        return {'id': user_id, 'is_bot': False, 'first_name': 'Load', 'last_name': 'Test', 'username': f'user{user_id}'}
+
+    def message(self, user_id: int, text: str) -> dict:
+        message = {
+            'message_id': next(self.message_ids),
+            'date': int(time()),
+            'chat': {'id': user_id, 'type': 'private'},
+            'from': self._user(user_id),
+            'text': text,
+        }
+        if text.startswith('/'):
+            message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+        return {'update_id': next(self.update_ids), 'message': message}
+
+    def inline_query(self, user_id: int) -> dict:
+        roll = self.rng.random()
+        if roll < 0.3 or not self.shortcuts[user_id]:
+            query = ''
+        elif roll < 0.8:
+            name = self.rng.choice(self.shortcuts[user_id])[1]
+            query = name[:self.rng.randint(1, len(name))]
+        else:
+            query = self.rng.choice(WORDS)[:-1] + 'x'
+        return {'update_id': next(self.update_ids), 'inline_query': {
+            'id': str(next(self.update_ids)), 'from': self._user(user_id), 'query': query, 'offset': ''
+        }}
+
+    def chosen_result(self, user_id: int) -> dict:
+        shortcut_id = self.rng.choice(self.shortcuts[user_id])[0]
+        return {'update_id': next(self.update_ids), 'chosen_inline_result': {
+            'result_id': str(shortcut_id), 'from': self._user(user_id), 'query': ''
+        }}
+
+    def updates(self, scenario: str, number: int) -> list:
+        """Returns about `number` updates, an /add flow takes three of them"""
+        updates = []
+        while len(updates) < number:
+            user_id = self.rng.choice(self.user_ids)
+            if scenario == 'inline':
+                updates.append(self.inline_query(user_id))
+            elif scenario == 'chosen':
+                updates.append(self.chosen_result(user_id))
+            elif scenario == 'list':
+                page = self.rng.randint(1, 3)
+                updates.append(self.message(user_id, '/list' if page == 1 else f'/list {page}'))
+            elif scenario == 'add':
+                updates.append(self.message(user_id, '/add'))
+                updates.append(self.message(user_id, ' '.join(self.rng.choices(WORDS, k=20))))
+                updates.append(self.message(user_id, f'new {self.rng.choice(WORDS)} {next(self.update_ids)}'))
+        return updates
+
+
+class Runner:
+    """Feeds updates to the bot through webhook's per-user worker pool and measures them"""
+
+    def __init__(self, bot_module, models, workers: int):
+        from sqlalchemy import event
+        from webhook import UpdateDispatcher
+
+        self.bot = bot_module.bot
+        self.sender = bot_module.sender
+        self._counter = local()
+        self._results = []
+        self.total_queries = 0
+
+        @event.listens_for(models.get_engine(), 'before_cursor_execute')
+        def count_query(conn, cursor, statement, parameters, context, executemany):
+            self._counter.queries = getattr(self._counter, 'queries', 0) + 1
+            self.total_queries += 1
+
+        self.dispatcher = UpdateDispatcher(self._process, workers=workers, queue_size=0)
+        self.dispatcher.start()
+
+    def _process(self, update):
+        self._counter.queries = 0
+        start = perf_counter()
+        self.bot.process_new_updates([update])
+        # list.append is atomic, workers do not need a lock here
+        self._results.append((perf_counter() - start, self._counter.queries))
+
+    def run(self, updates: list, rate: float = 0) -> dict:
+        """Processes updates, all at once or `rate` per second, and waits for them"""
+        import telebot as tb
+        updates = [tb.types.Update.de_json(update) for update in updates]
+        self._results = []
+        start = perf_counter()
+        for i, update in enumerate(updates):
+            if rate:
+                delay = start + i / rate - perf_counter()
+                if delay > 0:
+                    sleep(delay)
+            self.dispatcher.submit(update)
+        for queue in self.dispatcher.queues:
+            queue.join()
+        # Messages in bulk are sent after their handlers return
+        self.sender.join()
+        elapsed = perf_counter() - start
+        latencies, queries = zip(*self._results)
+        return summary(list(latencies), list(queries), elapsed)
+
+
+def measure(function, arguments: list, repeat: int = 1) -> dict:
+    latencies = []
+    for _ in range(repeat):
+        for args in arguments:
+            start = perf_counter()
+            function(*args)
+            latencies.append(perf_counter() - start)
+    return summary(latencies)
+
+
+def benchmark_functions(bot_module, models, workload: Workload, rng: Random) -> dict:
+    """Latency of functions on the inline and /list paths, with a cold and a warm cache"""
+    user_ids = rng.sample(workload.user_ids, min(len(workload.user_ids), 200))
+    models.shortcut_cache.clear()
+    results = {'get_shortcuts (cold)': measure(models.get_shortcuts, [(user_id,) for user_id in user_ids])}
+    results['get_shortcuts (warm)'] = measure(models.get_shortcuts, [(user_id,) for user_id in user_ids])
+    queries = [(user_id, rng.choice(workload.shortcuts[user_id])[1][:3]) for user_id in user_ids]
+    results['search_shortcuts'] = measure(models.search_shortcuts, queries)
+    results['search_shortcuts (empty query)'] = measure(models.search_shortcuts, [(user_id, '') for user_id in user_ids])
+    top = [(user_id, [x.id for x in models.search_shortcuts(user_id, '', limit=50)]) for user_id in user_ids]
+    results['get_shortcuts_by_ids (top 50)'] = measure(models.get_shortcuts_by_ids, top)
+    shortcuts = [
+        (shortcut,) for user_id in user_ids[:20]
+        for shortcut in models.get_shortcuts_by_ids(user_id, [x.id for x in models.get_shortcuts(user_id)])
+    ]
+    results['get_input_content'] = measure(bot_module.get_input_content, shortcuts)
+    bot_module.inline_results_cache.clear()
+    results['get_precompiled_content (cold)'] = measure(bot_module.get_precompiled_content, shortcuts)
+    results['get_precompiled_content (warm)'] = measure(bot_module.get_precompiled_content, shortcuts)
+    return results
+
+
+def print_results(results: dict):
+    columns = ['count', 'throughput', 'p50_ms', 'p95_ms', 'p99_ms', 'max_ms', 'db_queries_per_update', 'db_queries_max']
+    print(f'{"":32}' + ''.join(f'{column:>22}' for column in columns))
+    for name, result in results.items():
+        print(f'{name:32}' + ''.join(f'{str(result.get(column, "")):>22}' for column in columns))
+
+
+def find_regressions(results: dict, baseline: dict, tolerance: float) -> list:
+    regressions = []
+    for name, result in results.items():
+        for key in ('p95_ms', 'db_queries_per_update'):
+            old, new = (baseline.get(name) or {}).get(key), result.get(key)
+            if old is not None and new is not None and new > old * (1 + tolerance) and new - old > 0.01:
+                regressions.append(f'{name}: {key} {old} -> {new}')
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--users', type=int, default=200, help='number of synthetic users')
+    parser.add_argument('--shortcuts', type=int, default=50, help='shortcuts per user')
+    parser.add_argument('--updates', type=int, default=2000, help='updates per scenario')
+    parser.add_argument('--scenario', action='append', choices=SCENARIOS, help='scenarios to run, all by default')
+    parser.add_argument('--workers', type=int, default=8, help='worker threads processing updates')
+    parser.add_argument('--rate', type=float, default=0, help='updates per second, 0 sends each scenario as one burst')
+    parser.add_argument('--api-latency', type=float, default=0, help='delay of every fake Telegram API call, ms')
+    parser.add_argument('--cold', action='store_true', help='clear caches before every scenario')
+    parser.add_argument('--seed', type=int, default=1, help='random seed of the workload')
+    parser.add_argument('--output', help='save results as JSON')
+    parser.add_argument('--baseline', help='JSON results of a previous run to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed relative slowdown against the baseline')
+    args = parser.parse_args()
+
+    # Environment of bot.py, set before it is imported
+    workdir = mkdtemp(prefix='shortcut_bench_')
+    os.environ.setdefault('DATABASE_URL', f'sqlite:///{os.path.join(workdir, "bench.db")}')
+    os.environ.setdefault('TGTOKEN', '123456:BENCHMARK')
+    os.environ.setdefault('LOG_CHAT_ID', '-1')
+    os.environ['LOGPATH'] = workdir
+    # The stub has no flood control, so outgoing messages are not throttled
+    os.environ.setdefault('SEND_GLOBAL_RATE', '1000000')
+    os.environ.setdefault('SEND_CHAT_RATE', '1000000')
+
+    port = start_fake_api(args.api_latency / 1000)
+    import telebot as tb
+    tb.apihelper.API_URL = f'http://127.0.0.1:{port}/bot{{0}}/{{1}}'
+
+    import models
+    import bot as bot_module
+    from usage import usage_aggregator
+    bot_module.init()
+    # Handlers log every update at INFO level
+    logging.getLogger().setLevel(logging.WARNING)
+    # Updates are processed by the runner's workers
+    bot_module.bot.threaded = False
+
+    models.migrate()
+    workload = Workload(args.users, args.shortcuts, args.seed)
+    start = perf_counter()
+    workload.seed(models)
+    print(f'Seeded {args.users} users with {args.shortcuts} shortcuts each in {perf_counter() - start:.1f} s '
+          f'({models.get_engine().url.get_backend_name()})')
+
+    runner = Runner(bot_module, models, args.workers)
+    results = {}
+    for scenario in args.scenario or SCENARIOS:
+        if args.cold:
+            models.shortcut_cache.clear()
+            bot_module.inline_results_cache.clear()
+        results[scenario] = runner.run(workload.updates(scenario, args.updates), args.rate)
+        if scenario == 'chosen':
+            # Buffered usage counters are a part of the scenario
+            queries = runner.total_queries
+            usage_aggregator.flush()
+            results[scenario]['flush_queries'] = runner.total_queries - queries
+    results.update(benchmark_functions(bot_module, models, workload, Random(args.seed)))
+    print_results(results)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = find_regressions(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f'Regression: {regression}')
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+"""Query plans and latency of hot shortcut lookups before and after the composite indexes.
+
+A database is created at migration 0001, filled with synthetic users and shortcuts,
+and the lookups are explained and timed. Then it is upgraded to the latest migration
+and the same lookups are measured again.
+
+    python benchmarks/query_plans.py --users 5000 --shortcuts 100
+    DATABASE_URL=postgresql://localhost/bench python benchmarks/query_plans.py
+
+DATABASE_URL must point to an empty database, a fresh SQLite file is used by default.
+"""
+import argparse
+import os
+import sys
+from random import Random
+from tempfile import mkdtemp
+from time import perf_counter
+
+from load_test import Workload, percentile
+
+
+def hot_queries(models, workload: Workload, rng: Random, number: int) -> dict:
+    """Returns lookup name -> list of statements with random users, as executed by models.py
+
+    Columns added by later migrations are left out, so the same statements run before and after the upgrade.
+    """
+    from sqlalchemy import inspect, select
+    Shortcut = models.Shortcut
+    existing = {column['name'] for column in inspect(models.get_engine()).get_columns(Shortcut.__tablename__)}
+
+    def at_seeded_revision(statement):
+        return statement.with_only_columns(*(
+            column for column in statement.selected_columns
+            if getattr(column, 'table', None) is not Shortcut.__table__ or column.name in existing
+        ))
+
+    queries = {'user shortcuts': [], 'shortcut by name': [], 'top used of a user': [], 'shortcuts by ids': []}
+    for _ in range(number):
+        user_id = rng.choice(workload.user_ids)
+        shortcuts = workload.shortcuts[user_id]
+        queries['user shortcuts'].append(at_seeded_revision(
+            models._shortcut_infos_query().where(Shortcut.telegram_user_id == user_id).order_by(Shortcut.id)
+        ))
+        queries['shortcut by name'].append(at_seeded_revision(models._shortcut_infos_query().where(
+            Shortcut.telegram_user_id == user_id,
+            Shortcut.shortcut_name == rng.choice(shortcuts)[1]
+        ).limit(1)))
+        queries['top used of a user'].append(
+            select(Shortcut.id).where(Shortcut.telegram_user_id == user_id).order_by(Shortcut.num_of_uses.desc()).limit(50)
+        )
+        queries['shortcuts by ids'].append(at_seeded_revision(
+            models._shortcuts_by_ids_query(user_id, [x[0] for x in rng.sample(shortcuts, min(len(shortcuts), 50))])
+        ))
+    return queries
+
+
+def explain(connection, statement) -> str:
+    dialect = connection.dialect.name
+    sql = str(statement.compile(dialect=connection.dialect, compile_kwargs={'literal_binds': True}))
+    if dialect == 'sqlite':
+        return '\n'.join(row[-1] for row in connection.exec_driver_sql(f'EXPLAIN QUERY PLAN {sql}'))
+    if dialect == 'postgresql':
+        return '\n'.join(row[0] for row in connection.exec_driver_sql(f'EXPLAIN ANALYZE {sql}'))
+    return '\n'.join(str(row) for row in connection.exec_driver_sql(f'EXPLAIN {sql}'))
+
+
+def measure(models, queries: dict) -> dict:
+    results = {}
+    with models.get_engine().connect() as connection:
+        for name, statements in queries.items():
+            latencies = []
+            for statement in statements:
+                start = perf_counter()
+                connection.execute(statement).all()
+                latencies.append(perf_counter() - start)
+            results[name] = {
+                'plan': explain(connection, statements[0]),
+                'p50_ms': round(percentile(latencies, 0.5) * 1000, 3),
+                'p95_ms': round(percentile(latencies, 0.95) * 1000, 3),
+            }
+    return results
+
+
+def analyze(models):
+    """Refreshes planner statistics after bulk inserts and new indexes"""
+    with models.get_engine().begin() as connection:
+        if connection.dialect.name in ('sqlite', 'postgresql'):
+            connection.exec_driver_sql('ANALYZE')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--users', type=int, default=2000, help='number of synthetic users')
+    parser.add_argument('--shortcuts', type=int, default=100, help='shortcuts per user')
+    parser.add_argument('--queries', type=int, default=500, help='executions of every lookup')
+    parser.add_argument('--seed', type=int, default=1, help='random seed of the data and lookups')
+    args = parser.parse_args()
+
+    workdir = mkdtemp(prefix='shortcut_plans_')
+    os.environ.setdefault('DATABASE_URL', f'sqlite:///{os.path.join(workdir, "plans.db")}')
+    import models
+
+    models.migrate('0001')
+    workload = Workload(args.users, args.shortcuts, args.seed)
+    start = perf_counter()
+    workload.seed(models)
+    print(f'Seeded {args.users} users with {args.shortcuts} shortcuts each in {perf_counter() - start:.1f} s '
+          f'({models.get_engine().url.get_backend_name()})')
+    queries = hot_queries(models, workload, Random(args.seed), args.queries)
+
+    analyze(models)
+    before = measure(models, queries)
+    models.migrate()
+    analyze(models)
+    after = measure(models, queries)
+
+    for name in queries:
+        print(f'\n== {name}: p50 {before[name]["p50_ms"]} -> {after[name]["p50_ms"]} ms, '
+              f'p95 {before[name]["p95_ms"]} -> {after[name]["p95_ms"]} ms')
+        print('-- before:')
+        print(before[name]['plan'])
+        print('-- after:')
+        print(after[name]['plan'])
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,45 +1,62 @@
 #!/usr/bin/env python3
-from datetime import datetime as dt
+from datetime import datetime as dt, timedelta
 from os import getenv, makedirs
+from signal import signal, SIGTERM
 from os.path import join, exists
-from models import create_user, add_shortcut, get_user, get_shortcuts, delete_shortcut, get_shortcut, is_admin, get_users_list, increase_chosen_result_counter
+from cache import LRUCache
+from models import create_user, add_shortcut, get_user, get_shortcuts, get_shortcut_names, search_shortcuts_page, get_shortcuts_by_ids, delete_shortcut, get_shortcut, is_admin, get_cache_stats, \
+    iter_users_list, get_users_count, get_registrations, get_top_shortcuts, get_daily_active_users, record_activity, rebuild_stats, get_media_stats
+from usage import usage_aggregator
+from sender import Sender, ForwardBatcher, shortcuts_plan
+from state import create_state_store
+from transfer import export_file, import_url
+from media import get_media_metadata, start_media_validator
+from analytics import event_log, get_daily_usage, get_top_queries, get_retention, get_user_activity
+from logs import JsonFormatter, start_queue_logging
+from metrics import handler_timed, instrument_telegram_api, start_update, finish_update, start_metrics_server, Gauge
+from math import ceil
+from operator import attrgetter
 from random import sample
 from traceback import print_exception, format_exc
-from json import loads, JSONDecodeError
+from json import loads
 from dotenv import load_dotenv
+from sqlalchemy.exc import IntegrityError
 import logging
 from logging.handlers import RotatingFileHandler
 import telebot as tb
+from telebot.handler_backends import BaseMiddleware, ContinueHandling
 
 # Load environment variables from .env file
 load_dotenv()
 
-# Validate required environment variables
-required_vars = ['TGTOKEN', 'LOGPATH', 'DATABASE_URL', 'LOG_CHAT_ID']
-missing_vars = [var for var in required_vars if not getenv(var)]
-if missing_vars:
-    raise ValueError(f"Missing required environment variables: {', '.join(missing_vars)}")
-
 # Get log chat ID
 log_chat_id = getenv('LOG_CHAT_ID')
 
-# Set log directory
-log_directory = getenv('LOGPATH', '/tmp') + f'/{dt.today().date().isoformat()}'
-if not exists(log_directory):
-    makedirs(log_directory)
-
-# Set name of log-file
-log_file_name = "error.log"
-
-# Set full name of log-file
-log_file_path = join(log_directory, log_file_name)
-
-# Setting of logger with rotation
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    datefmt='%Y-%m-%d %H:%M:%S',
-    handlers=[
+# Created by init(), handlers use these globals
+bot = None
+sender = None
+forwarder = None
+state_store = None
+
+def check_environment():
+    """Validate required environment variables"""
+    required_vars = ['TGTOKEN', 'LOGPATH', 'DATABASE_URL', 'LOG_CHAT_ID']
+    missing_vars = [var for var in required_vars if not getenv(var)]
+    if missing_vars:
+        raise ValueError(f"Missing required environment variables: {', '.join(missing_vars)}")
+
+def setup_logging(file_name: str = 'error.log'):
+    """Log to a daily directory in LOGPATH with rotation and to stderr"""
+    # Set log directory
+    log_directory = getenv('LOGPATH', '/tmp') + f'/{dt.today().date().isoformat()}'
+    if not exists(log_directory):
+        makedirs(log_directory)
+
+    # Set full name of log-file
+    log_file_path = join(log_directory, file_name)
+
+    # Setting of logger with rotation
+    handlers = [
         RotatingFileHandler(
             log_file_path,
             maxBytes=10*1024*1024,  # 10MB per file
@@ -48,20 +65,130 @@ logging.basicConfig(
         ),
         logging.StreamHandler()
     ]
-)
+    if getenv('LOG_FORMAT') == 'json':
+        formatter = JsonFormatter(datefmt='%Y-%m-%dT%H:%M:%S')
+    else:
+        formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
+    for handler in handlers:
+        handler.setFormatter(formatter)
+
+    # Handlers write in a background thread, so disk I/O is not on the path of updates
+    start_queue_logging(
+        handlers,
+        level=getenv('LOG_LEVEL', 'INFO'),
+        queue_size=int(getenv('LOG_QUEUE_SIZE', 10000))     # Records waiting to be written, the others are dropped
+    )
+
+class ActivityMiddleware(BaseMiddleware):
+    """Records users active today for daily active users stats"""
+    def __init__(self):
+        self.update_types = ['message', 'inline_query', 'chosen_inline_result']
+
+    def pre_process(self, message, data):
+        try:
+            record_activity(message.from_user.id)
+        except Exception:
+            logging.error(format_exc())
+
+    def post_process(self, message, data, exception):
+        pass
+
+class AnalyticsMiddleware(BaseMiddleware):
+    """Records commands in the usage event log"""
+    def __init__(self):
+        self.update_types = ['message']
 
-bot = tb.TeleBot(getenv('TGTOKEN').strip())
+    def pre_process(self, message, data):
+        if (message.text or '').startswith('/'):
+            event_log.record_command(message.from_user.id, message.text)
+
+    def post_process(self, message, data, exception):
+        pass
+
+class MetricsMiddleware(BaseMiddleware):
+    """Counts DB round-trips per update"""
+    def __init__(self):
+        self.update_types = ['message', 'inline_query', 'chosen_inline_result']
+
+    def pre_process(self, message, data):
+        start_update()
+
+    def post_process(self, message, data, exception):
+        finish_update(type(message).__name__)
 
 help_message = '''Here are methods you can use:
 /help - send this message
-/list - list all existing shortcuts
+/list - list all existing shortcuts (/list 2 for the second page and so on)
 /add - add a new shortcut
 /delete - delete an existing shortcut by its name
+/export - get all your shortcuts as a file
+/import - add shortcuts from a file
 
 Send any feedback (questions, feature requests) to @tolord'''
 
+add_message = r'''Send me any one message you want\. It can be a text and/or one of the following media types audio, document, video, voice message, location or poll\. Also, you can use formatting styles in your shortcuts: _italic_, *bold*, __underlined__, ~striked~, `code` and [links](https://core\.telegram\.org/api/entities)\.
+To begin with, *you* can send me your _business_ card like this one:
+```Name: Shortcut Holder
+Position: Telegram Bot
+Company: Shortcut Holder LLC
+Email: i@t010rd\.ru```'''
+
+welcome_message = '''Hi, {first_name} {last_name}! I'm Shortcut Holder, and I will help you to quickly send any frequently used information (I call it Shortcut) to whoever you want very easy. I'll show you how to do it real quick. Just click here right now: /add'''
+
+no_shortcuts_msg = '''You don't have any shortcuts, but you can simply add one by clicking here: /add'''
+
 error_msg = 'Sorry, something went wrong. If you see this message, text to my creator please: @tolord'
 
+import_message = '''Send me a file with shortcuts in JSON Lines format, one shortcut per line, like the one /export sends. Shortcuts with names you already have will be skipped.'''
+
+import_result_msg = '''Imported {imported} shortcuts, skipped {duplicates} with existing names and {invalid} invalid lines.'''
+
+duplicate_name_msg = '''You already have a shortcut named "{name}". Please, send me another name:'''
+
+text_name_msg = '''A name of a shortcut must be a text. Please, send me a name:'''
+
+broken_shortcuts_msg = '''{broken} of your shortcuts are hidden, as Telegram no longer has their files. Add them again or /delete them.'''
+
+# Types of updates the bot receives
+ALLOWED_UPDATES = ['message', 'inline_query', 'chosen_inline_result']
+
+# Number of shortcuts sent by /list at once
+LIST_PAGE_SIZE = int(getenv('LIST_PAGE_SIZE', 10))
+
+# Bots can download files up to 20 MB
+DOWNLOAD_SIZE_LIMIT = 20 * 1024 * 1024
+
+# Telegram accepts at most 50 results per inline query answer
+INLINE_RESULTS_LIMIT = 50
+
+# Inline results sent at once, the next ones are requested when the user scrolls
+INLINE_PAGE_SIZE = min(int(getenv('INLINE_PAGE_SIZE', 20)), INLINE_RESULTS_LIMIT)
+
+# Marks offsets of pages of all shortcuts, which are shown when a query matches none
+ALL_SHORTCUTS_OFFSET = '*'
+
+EPOCH = dt(1970, 1, 1)
+MICROSECOND = timedelta(microseconds=1)
+
+# Serialized inline results keyed by (shortcut id, update datetime)
+inline_results_cache = LRUCache(maxsize=int(getenv('INLINE_RESULTS_CACHE_SIZE', 50000)))
+_inline_results_cache_instrumented = False
+
+def instrument_inline_results_cache():
+    """Registers metrics of the inline results cache, once per process
+
+    Not at import, as a spawned cluster worker imports this module twice, as __mp_main__ and as bot.
+    """
+    global _inline_results_cache_instrumented
+    if _inline_results_cache_instrumented:
+        return
+    _inline_results_cache_instrumented = True
+    Gauge('inline_results_cache_hits', 'Inline results found in the cache', lambda: inline_results_cache.hits)
+    Gauge('inline_results_cache_misses', 'Inline results built from scratch', lambda: inline_results_cache.misses)
+
+# Marks shortcuts which could not be converted to an inline result
+BROKEN_SHORTCUT = object()
+
 def get_first_or_obj(obj):
     """Returns first element of an object if it is a collection else the same object"""
     try:
@@ -108,7 +235,153 @@ def get_input_content(shortcut):
     
     return content_class(**params)
 
-@bot.message_handler(commands=['start', 'help'])
+class PrecompiledResult(tb.types.JsonSerializable):
+    """Inline query result serialized once and reused across answers"""
+    def __init__(self, result):
+        self.json = result.to_json()
+
+    def to_json(self):
+        return self.json
+
+def compile_content(shortcut):
+    """Serializes an inline result for a complete Shortcut and caches it, BROKEN_SHORTCUT if the Shortcut is malformed"""
+    try:
+        result = PrecompiledResult(get_input_content(shortcut))
+    except Exception:
+        # Logged only once per shortcut version
+        logging.error(f"Failed to process shortcut {shortcut.id}: {shortcut.content_type}")
+        logging.error(f"Content: {shortcut.content}")
+        logging.error(format_exc())
+        result = BROKEN_SHORTCUT
+    inline_results_cache.put((shortcut.id, shortcut.update_dt), result)
+    return result
+
+def get_precompiled_content(shortcut):
+    """Returns a cached serialized inline result for a complete Shortcut or None if the Shortcut is malformed"""
+    result = inline_results_cache.get((shortcut.id, shortcut.update_dt)) or compile_content(shortcut)
+    return None if result is BROKEN_SHORTCUT else result
+
+def get_cached_results(shortcuts) -> dict:
+    """Returns id -> cached inline result of ShortcutInfos, None where a complete Shortcut has to be loaded"""
+    return {shortcut.id: inline_results_cache.get((shortcut.id, shortcut.update_dt)) for shortcut in shortcuts}
+
+def complete_results(results: dict, loaded_shortcuts) -> list:
+    """Fills missing results from loaded complete Shortcuts, returns results without broken ones"""
+    for shortcut in loaded_shortcuts:
+        results[shortcut.id] = compile_content(shortcut)
+    return [result for result in results.values() if result is not None and result is not BROKEN_SHORTCUT]
+
+def format_inline_offset(key: tuple, all_shortcuts: bool) -> str:
+    """Encodes the position of the last result of a page as next_offset, which Telegram limits to 64 bytes"""
+    tier, recent_uses, num_of_uses, last_use_dt, shortcut_id = key
+    last_use = '' if last_use_dt == dt.min else (last_use_dt - EPOCH) // MICROSECOND
+    return f'{ALL_SHORTCUTS_OFFSET if all_shortcuts else ""}{tier}:{recent_uses}:{num_of_uses}:{last_use}:{shortcut_id}'
+
+def parse_inline_offset(offset: str) -> tuple:
+    """Returns the position after which the page starts and whether it is a page of all shortcuts, (None, False) for the first page"""
+    try:
+        tier, recent_uses, num_of_uses, last_use, shortcut_id = (offset or '').removeprefix(ALL_SHORTCUTS_OFFSET).split(':')
+        last_use_dt = EPOCH + int(last_use) * MICROSECOND if last_use else dt.min
+        return (int(tier), int(recent_uses), int(num_of_uses), last_use_dt, int(shortcut_id)), offset.startswith(ALL_SHORTCUTS_OFFSET)
+    except ValueError:
+        # The first page or an offset of an older version
+        return None, False
+
+def get_list_page(message, total: int) -> tuple:
+    """Returns a page number requested by `/list <page>` and the number of pages"""
+    pages = max(ceil(total / LIST_PAGE_SIZE), 1)
+    params = (message.text or '').split(maxsplit=1)
+    page = int(params[1]) if len(params) > 1 and params[1].strip().isdigit() else 1
+    return min(max(page, 1), pages), pages
+
+def get_list_header(total: int, page: int, pages: int, broken: int=0) -> str:
+    header = f'You have {total} in total, here they are:' if pages == 1 else f'You have {total} in total, here is page {page} of {pages}:'
+    if broken:
+        header = broken_shortcuts_msg.format(broken=broken) + '\n' + header
+    return header
+
+def get_command_number(message, default: int, maximum: int=100) -> int:
+    """Returns a number passed after a command, e.g. 5 for `/top_shortcuts 5`"""
+    params = (message.text or '').split(maxsplit=1)
+    return min(int(params[1]), maximum) if len(params) > 1 and params[1].strip().isdigit() else default
+
+def format_registrations(registrations) -> str:
+    return '\n'.join(f'{start_param or "-"}: {num_users}' for start_param, num_users in registrations) or 'No users yet'
+
+def format_top_shortcuts(shortcuts) -> str:
+    return '\n'.join(
+        f'{i}. {shortcut.shortcut_name} ({shortcut.num_of_uses}) by {shortcut.username or shortcut.telegram_user_id}'
+        for i, shortcut in enumerate(shortcuts, start=1)
+    ) or 'No shortcuts yet'
+
+def format_daily_active_users(days) -> str:
+    return '\n'.join(f'{day}: {num_users}' for day, num_users in days) or 'No activity yet'
+
+def format_user_line(user, events: int=None) -> str:
+    """Formats a user with reg date, # of saved shortcuts, source of registration and # of events in a week if known"""
+    user_id = user.username or str(user.telegram_user_id)
+    line = f'''`{str(user.created_at).split(".")[0]}`: \t ({user.num_shortcuts}) {("" if user_id[0].isdigit() else "@") + user_id} [{user.start_param or ''}]'''
+    return line if events is None else f'{line} {events}/week'
+
+def format_daily_usage(days) -> str:
+    return '\n'.join(
+        f'{day}: {users} users, {queries} queries ({hits / max(queries, 1):.0%} found), {chosen} chosen, {commands} commands, {registrations} new'
+        for day, users, queries, hits, chosen, commands, registrations in days
+    ) or 'No usage yet, run `python manage.py rollup`'
+
+def format_top_queries(queries) -> str:
+    return '\n'.join(
+        f'{i}. {query}: {total} ({hits / max(total, 1):.0%} found), {chosen} chosen'
+        for i, (query, total, hits, chosen) in enumerate(queries, start=1)
+    ) or 'No queries yet'
+
+def format_retention(cohorts) -> str:
+    return '\n'.join(
+        f'{start_param or "-"}: {users} users, {day_later / users:.0%} back a day later, {week_later / users:.0%} a week later'
+        for start_param, users, day_later, week_later in cohorts
+    ) or 'No registrations yet'
+
+class MessageChunker:
+    """Joins lines into Markdown messages that fit into Telegram's 4096 character limit"""
+    MAX_LENGTH = 3800  # Leave some margin
+
+    def __init__(self, title: str):
+        self.title = title
+        self.part = 0
+        self.lines = []
+        self.length = 0
+
+    def add(self, line: str) -> list:
+        """Adds a line and returns messages which are complete"""
+        line_length = len(line) + 1  # +1 for newline
+        messages = self.flush() if self.length + line_length > self.MAX_LENGTH else []
+        self.lines.append(line)
+        self.length += line_length
+        return messages
+
+    def flush(self) -> list:
+        """Returns the last incomplete message"""
+        if not self.lines:
+            return []
+        self.part += 1
+        text = f"{self.title} (part {self.part}):\n" + '\n'.join(self.lines).replace('_', r'\_')
+        self.lines, self.length = [], 0
+        return [text]
+
+def register_next_step(message, handler, **context):
+    """Route the next message of the chat to the handler, `context` must be JSON serializable"""
+    state_store.set(message.chat.id, handler.__name__, context)
+
+@handler_timed
+def process_next_step(message):
+    """Call a pending step handler of the chat instead of regular handlers"""
+    state = state_store.pop(message.chat.id)
+    if state is None or state[0] not in next_step_handlers:
+        return ContinueHandling()
+    step, context = state
+    next_step_handlers[step](message, **context)
+
+@handler_timed
 def send_welcome(message):
     """Send welcome-message when a user send a command at the first time else help-message with a list of available commands."""
     logging.info(f'''{message.from_user.username or message.from_user.id}: {message.text}''')
@@ -118,116 +391,109 @@ def send_welcome(message):
         params = message.text.split(maxsplit=1)
         start_param = params[1] if len(params) > 1 else None
         create_user(telegram_user_id=message.from_user.id, username=message.from_user.username, start_param=start_param)
-        bot.reply_to(message=message, text=f'''Hi, {message.from_user.first_name} {message.from_user.last_name}! I'm Shortcut Holder, and I will help you to quickly send any frequently used information (I call it Shortcut) to whoever you want very easy. I'll show you how to do it real quick. Just click here right now: /add''')
+        event_log.record_registration(message.from_user.id, start_param)
+        bot.reply_to(message=message, text=welcome_message.format(first_name=message.from_user.first_name, last_name=message.from_user.last_name))
 
 
-@bot.message_handler(commands=['add'])
+@handler_timed
 def handle_add_shortcut(message):
     """Ask a content for a new Shortcut, then a name for it. Create a corresponding object in DB"""
     logging.info(f'''{message.from_user.username or message.from_user.id}: add''')
     msg = bot.reply_to(
         message=message,
-        text=r'''Send me any one message you want\. It can be a text and/or one of the following media types audio, document, video, voice message, location or poll\. Also, you can use formatting styles in your shortcuts: _italic_, *bold*, __underlined__, ~striked~, `code` and [links](https://core\.telegram\.org/api/entities)\.
-To begin with, *you* can send me your _business_ card like this one:
-```Name: Shortcut Holder
-Position: Telegram Bot
-Company: Shortcut Holder LLC
-Email: i@t010rd\.ru```''',
+        text=add_message,
         parse_mode='MarkdownV2'
     )
-    bot.register_next_step_handler(msg, process_add_shortcut_content)
+    register_next_step(msg, process_add_shortcut_content)
 
+@handler_timed
 def process_add_shortcut_content(message):
     """Ask for a name for a new shortcut"""
     try:
         msg = bot.reply_to(message, f'''{sample(['Great', 'Magnificent', 'Fantastic', 'Wonderful'], k=1)[0]}! Now give me a short name for your shortcut:''')
-        bot.register_next_step_handler(msg, process_add_shortcut_name(message))
+        register_next_step(msg, process_add_shortcut_name, context=get_shortcut_context(message))
     except Exception as e:
         print_exception(e)
         bot.reply_to(message=message, text=error_msg)
 
-def process_add_shortcut_name(prev_message):
+def get_shortcut_context(prev_message) -> dict:
     """Parse message for a Shortcut parameters"""
-    context = {
+    return {
         'text': prev_message.text if prev_message.content_type == 'text' else prev_message.caption,
         'content_type': prev_message.content_type,
         'content': get_first_or_obj(getattr(prev_message, prev_message.content_type)).file_id if prev_message.content_type not in ('text', 'location') \
                     else prev_message.location.to_json() if prev_message.content_type == 'location' \
                     else None,
-        'entities': [x.to_json() for x in prev_message.entities or []]
+        'entities': [x.to_json() for x in prev_message.entities or []],
+        'media': get_media_metadata(prev_message)
     }
-    def inner(message):
-        """Save a Shortcut to BD"""
-        try:
-            context['telegram_user_id'] = message.from_user.id
-            context['shortcut_name'] = message.text
-            add_shortcut(**context)
-            bot.reply_to(message=message, text=f'Shortcut "{message.text}" was successfully saved!')
-            logging.info(f'''{message.from_user.username or message.from_user.id}: added {context['content_type']} shortcut''')
-        except Exception as e:
+
+@handler_timed
+def process_add_shortcut_name(message, context):
+    """Save a Shortcut described by a previous message (`context`) under a name from this one"""
+    if not message.text:
+        msg = bot.reply_to(message=message, text=text_name_msg)
+        register_next_step(msg, process_add_shortcut_name, context=context)
+        return
+    try:
+        add_shortcut(**context, telegram_user_id=message.from_user.id, shortcut_name=message.text)
+        bot.reply_to(message=message, text=f'Shortcut "{message.text}" was successfully saved!')
+        logging.info(f'''{message.from_user.username or message.from_user.id}: added {context['content_type']} shortcut''')
+    except IntegrityError as e:
+        if get_shortcut(message.from_user.id, message.text) is None:
             print_exception(e)
             bot.reply_to(message=message, text=error_msg)
-    return inner
+            return
+        # Names are unique per user, ask for another one
+        msg = bot.reply_to(message=message, text=duplicate_name_msg.format(name=message.text))
+        register_next_step(msg, process_add_shortcut_name, context=context)
+    except Exception as e:
+        print_exception(e)
+        bot.reply_to(message=message, text=error_msg)
 
-@bot.message_handler(commands=['list'])
+@handler_timed
 def list_shortcuts_handler(message):
-    """List all stored Shortcuts of a user"""
+    """List stored Shortcuts of a user, one page at a time"""
     logging.info(f'''{message.from_user.username or message.from_user.id}: list''')
     shortcuts = get_shortcuts(message.from_user.id)
+    # Shortcuts with files Telegram rejected would fail to send. Pages are ordered by id,
+    # as the cached index moves updated shortcuts to its end
+    sendable = sorted((x for x in shortcuts if not x.is_broken), key=attrgetter('id'))
+    broken, shortcuts = len(shortcuts) - len(sendable), sendable
     if shortcuts:
-        bot.reply_to(message=message, text=f'You have {len(shortcuts)} in total, here they are:')
-        for i, shortcut in enumerate(shortcuts, start=1):
-            prev_message = bot.send_message(chat_id=message.from_user.id, text=f'{i}. `{shortcut.shortcut_name}`:', parse_mode='Markdown')
-            if shortcut.content_type == 'text':
-                bot.reply_to(
-                    message=prev_message, 
-                    text=shortcut.text, 
-                    parse_mode='', 
-                    entities=prev_message.parse_entities(shortcut.entities or [])
-                )
-            elif shortcut.content_type == 'location':
-                try:
-                    bot.send_location(
-                        reply_to_message_id=prev_message.id,
-                        chat_id=message.from_user.id,
-                        **loads(shortcut.content)
-                    )
-                except JSONDecodeError as e:
-                    logging.error(shortcut.content_type)
-                    logging.error(shortcut.content)
-                    logging.error(format_exc(), exc_info=True)
-            else:
-                getattr(bot, f'send_{shortcut.content_type}')(
-                    **{
-                        shortcut.content_type: shortcut.content, 
-                        'caption': shortcut.text, 
-                        'reply_to_message_id': prev_message.id,
-                        'chat_id': message.from_user.id,
-                        'caption_entities': message.parse_entities(shortcut.entities or []),
-                        'parse_mode': ''
-                    }
-                )
+        page, pages = get_list_page(message, len(shortcuts))
+        bot.reply_to(message=message, text=get_list_header(len(shortcuts), page, pages, broken))
+        start = (page - 1) * LIST_PAGE_SIZE
+        page_shortcuts = get_shortcuts_by_ids(message.from_user.id, [x.id for x in shortcuts[start: start + LIST_PAGE_SIZE]])
+        plan = shortcuts_plan(page_shortcuts, start=start + 1)
+        if page < pages:
+            plan.append(('send_message', {'text': f'Send /list {page + 1} for the next page'}, False))
+        # Sent within rate limits by a background thread, so other users' updates do not wait
+        sender.submit(message.from_user.id, plan)
+    elif broken:
+        bot.reply_to(message=message, text=broken_shortcuts_msg.format(broken=broken))
     else:
-        bot.reply_to(message=message, text='''You don't have any shortcuts, but you can simply add one by clicking here: /add''')
+        bot.reply_to(message=message, text=no_shortcuts_msg)
 
-@bot.message_handler(commands=['delete'])
+@handler_timed
 def delete_shortcut_handler(message):
     """Ask which Shortcut from list of available Shortcuts to delete"""
     logging.info(f'''{message.from_user.username or message.from_user.id}: delete''')
-    shortcuts = get_shortcuts(message.from_user.id)
-    if shortcuts:
+    names = get_shortcut_names(message.from_user.id)
+    if names:
         kb = tb.types.ReplyKeyboardMarkup(one_time_keyboard=True)
-        for i in range(0, len(shortcuts), 2):
-            kb.add(*[f'"{x.shortcut_name}"' for x in shortcuts[i: i + 2]])
+        for i in range(0, len(names), 2):
+            kb.add(*[f'"{name}"' for name in names[i: i + 2]])
         kb.add('Cancel')
         msg = bot.reply_to(message=message, text='''Which shortcut do you want to delete?''', reply_markup=kb)
-        bot.register_next_step_handler(msg, process_delete_shortcut)
+        register_next_step(msg, process_delete_shortcut)
     else:
-        bot.reply_to(message=message, text='''You don't have any shortcuts, but you can simply add one by clicking here: /add''')
+        bot.reply_to(message=message, text=no_shortcuts_msg)
 
+@handler_timed
 def process_delete_shortcut(msg):
     """Delete chosen Shortcut or cancel if 'Cancel' option was chosed"""
-    shortcut = get_shortcut(telegram_user_id=msg.from_user.id, shortcut_name=msg.text[1:-1])
+    shortcut = get_shortcut(telegram_user_id=msg.from_user.id, shortcut_name=(msg.text or '')[1:-1])
     if shortcut:
         delete_shortcut(shortcut.id)
         bot.reply_to(message=msg, text=f'''Shortcut `{shortcut.shortcut_name}` was successfully deleted!''', reply_markup=tb.types.ReplyKeyboardRemove())
@@ -237,24 +503,67 @@ def process_delete_shortcut(msg):
         bot.reply_to(message=msg, text='Please, use the Telegram keyboard')
 
 
-@bot.inline_handler(lambda query: True)
+@handler_timed
+def export_handler(message):
+    """Send all Shortcuts of a user as a JSON Lines file"""
+    logging.info(f'''{message.from_user.username or message.from_user.id}: export''')
+    shortcuts = get_shortcuts(message.from_user.id)
+    if not shortcuts:
+        bot.reply_to(message=message, text=no_shortcuts_msg)
+        return
+    with export_file(message.from_user.id) as file:
+        bot.send_document(message.chat.id, file, visible_file_name='shortcuts.jsonl', caption=f'{len(shortcuts)} shortcuts')
+
+@handler_timed
+def import_handler(message):
+    """Ask for a JSON Lines file with Shortcuts to import"""
+    logging.info(f'''{message.from_user.username or message.from_user.id}: import''')
+    msg = bot.reply_to(message=message, text=import_message)
+    register_next_step(msg, process_import_file)
+
+@handler_timed
+def process_import_file(message):
+    """Import Shortcuts from a sent file, streaming it line by line"""
+    if message.content_type != 'document':
+        bot.reply_to(message=message, text='Import was cancelled, send /import and then a file')
+        return
+    if (message.document.file_size or 0) > DOWNLOAD_SIZE_LIMIT:
+        bot.reply_to(message=message, text='Sorry, the file is too big, I can read files up to 20 MB')
+        return
+    try:
+        result = import_url(message.from_user.id, bot.get_file_url(message.document.file_id))
+        bot.reply_to(message=message, text=import_result_msg.format(**result))
+        logging.info(f'''{message.from_user.username or message.from_user.id}: imported {result['imported']} shortcuts''')
+    except Exception as e:
+        print_exception(e)
+        bot.reply_to(message=message, text=error_msg)
+
+# Handlers which can be a pending step, by the names kept in the state store
+next_step_handlers = {handler.__name__: handler for handler in (
+    process_add_shortcut_content, process_add_shortcut_name, process_delete_shortcut, process_import_file
+)}
+
+
+@handler_timed
 def query_text(inline_query):
-    """List all shortcuts filtered by text and sorted by use"""
+    """List shortcuts matching the text and ranked by use, a page at a time"""
     logging.info(f'''{inline_query.from_user.username or inline_query.from_user.id}: inline ({inline_query.query})''')
-    shortcuts = get_shortcuts(telegram_user_id=inline_query.from_user.id)
-    found_shortcuts = [shortcut for shortcut in shortcuts if inline_query.query in shortcut.shortcut_name] or shortcuts
-    results = []
-    for shortcut in sorted(found_shortcuts, key=lambda shortcut: shortcut.num_of_uses)[::-1]:
-        try:
-            r = get_input_content(shortcut)
-            results.append(r)
-        except JSONDecodeError as e:
-            logging.error(f"Failed to process shortcut {shortcut.id}: {shortcut.content_type}")
-            logging.error(f"Content: {shortcut.content}")
-            logging.error(format_exc())
-            # Skip this broken shortcut
-            continue
-    if not found_shortcuts:
+    after, all_shortcuts = parse_inline_offset(inline_query.offset)
+    found_shortcuts, last_key = [], None
+    if not all_shortcuts:
+        found_shortcuts, last_key = search_shortcuts_page(inline_query.from_user.id, inline_query.query, limit=INLINE_PAGE_SIZE, after=after)
+    if not found_shortcuts and (all_shortcuts or after is None):
+        # Nothing matches the query, all shortcuts are shown instead
+        all_shortcuts = True
+        found_shortcuts, last_key = search_shortcuts_page(inline_query.from_user.id, '', limit=INLINE_PAGE_SIZE, after=after)
+    if after is None:
+        # Scrolling to the next pages is not another query
+        event_log.record_inline_query(inline_query.from_user.id, inline_query.query, 0 if all_shortcuts else len(found_shortcuts))
+    results = get_cached_results(found_shortcuts)
+    # Heavy columns are loaded only for results which are not cached yet
+    missing = [shortcut_id for shortcut_id, result in results.items() if result is None]
+    results = complete_results(results, get_shortcuts_by_ids(inline_query.from_user.id, missing))
+    if not found_shortcuts and after is None:
         results.append(
             tb.types.InlineQueryResultArticle(
                 id='1',
@@ -269,63 +578,179 @@ def query_text(inline_query):
         results, 
         cache_time=1, 
         is_personal=True,
+        next_offset=format_inline_offset(last_key, all_shortcuts) if last_key else '',
         switch_pm_parameter='from_menu',
         switch_pm_text='Add a new shortcut' if found_shortcuts else 'Add your own shortcut'
     )
 
-@bot.chosen_inline_handler(lambda query: True)
+@handler_timed
 def handle_chosen_shortcut(chosen_result):
     """Increase number of uses of a Shortcut and update last use datetime"""
-    increase_chosen_result_counter(chosen_result.result_id)
+    usage_aggregator.record(chosen_result.result_id, chosen_result.from_user.id)
+    event_log.record_chosen_result(chosen_result.from_user.id, chosen_result.result_id, chosen_result.query)
     
 
-@bot.message_handler(commands=['get_users'])
+@handler_timed
 def admin_get_users(message):
     """List all the users with reg dates, # of saved shortcuts and source of registration (only for admins)"""
     if is_admin(message.from_user.id):
-        users_data = get_users_list()
-        lines = [f'''`{str(values[0]).split(".")[0]}`: \t ({values[1]}) {("" if user_id[0].isdigit() else "@") + user_id} [{values[2] or ''}]'''
-                 for user_id, values in users_data.items()]
-
-        # Split into chunks to avoid Telegram's 4096 character limit
-        MAX_LENGTH = 3800  # Leave some margin
-        current_chunk = []
-        current_length = 0
-        chunks = []
-
-        for line in lines:
-            line_length = len(line) + 1  # +1 for newline
-            if current_length + line_length > MAX_LENGTH:
-                chunks.append('\n'.join(current_chunk))
-                current_chunk = [line]
-                current_length = line_length
-            else:
-                current_chunk.append(line)
-                current_length += line_length
-
-        if current_chunk:
-            chunks.append('\n'.join(current_chunk))
-
-        # Send chunks
-        for i, chunk in enumerate(chunks):
-            header = f"Users list (part {i+1}/{len(chunks)}):\n" if len(chunks) > 1 else "Users list:\n"
-            bot.send_message(
-                chat_id=message.chat.id,
-                text=header + chunk.replace('_', r'\_'),
-                parse_mode='markdown'
-            )
+        chunker = MessageChunker(title=f'Users list, {get_users_count()} in total')
+        activity = get_user_activity(days=7)
+        # Users are streamed from DB and sent chunk by chunk
+        for user in iter_users_list():
+            for text in chunker.add(format_user_line(user, activity.get(user.telegram_user_id, 0))):
+                sender.submit(message.chat.id, [('send_message', {'text': text, 'parse_mode': 'markdown'}, False)])
+        for text in chunker.flush():
+            sender.submit(message.chat.id, [('send_message', {'text': text, 'parse_mode': 'markdown'}, False)])
+
+@handler_timed
+def admin_registrations(message):
+    """Show numbers of users registered by each start param (only for admins)"""
+    if is_admin(message.from_user.id):
+        bot.reply_to(message=message, text=format_registrations(get_registrations()))
+
+@handler_timed
+def admin_top_shortcuts(message):
+    """Show the most used shortcuts of all users (only for admins)"""
+    if is_admin(message.from_user.id):
+        bot.reply_to(message=message, text=format_top_shortcuts(get_top_shortcuts(get_command_number(message, 10))))
+
+@handler_timed
+def admin_daily_active_users(message):
+    """Show numbers of daily active users for the last days (only for admins)"""
+    if is_admin(message.from_user.id):
+        bot.reply_to(message=message, text=format_daily_active_users(get_daily_active_users(get_command_number(message, 7))))
+
+@handler_timed
+def admin_rebuild_stats(message):
+    """Recount users and shortcuts stats from scratch (only for admins)"""
+    if is_admin(message.from_user.id):
+        rebuild_stats()
+        bot.reply_to(message=message, text='Stats were rebuilt')
+
+@handler_timed
+def admin_cache_stats(message):
+    """Show hit/miss/eviction counters of the shortcut cache (only for admins)"""
+    if is_admin(message.from_user.id):
+        stats = get_cache_stats()
+        bot.reply_to(message=message, text='\n'.join(f'{key}: {value}' for key, value in stats.items()))
+
+@handler_timed
+def admin_usage(message):
+    """Show daily usage aggregated from the event log for the last days (only for admins)"""
+    if is_admin(message.from_user.id):
+        bot.reply_to(message=message, text=format_daily_usage(get_daily_usage(get_command_number(message, 7))))
+
+@handler_timed
+def admin_top_queries(message):
+    """Show the most frequent inline queries of the last week and how often they find something (only for admins)"""
+    if is_admin(message.from_user.id):
+        bot.reply_to(message=message, text=format_top_queries(get_top_queries(limit=get_command_number(message, 20))))
+
+@handler_timed
+def admin_retention(message):
+    """Show how many users registered in the last days came back, by start param (only for admins)"""
+    if is_admin(message.from_user.id):
+        bot.reply_to(message=message, text=format_retention(get_retention(get_command_number(message, 30, maximum=365))))
+
+@handler_timed
+def admin_media_stats(message):
+    """Show numbers of validated and broken files of media shortcuts (only for admins)"""
+    if is_admin(message.from_user.id):
+        bot.reply_to(message=message, text='\n'.join(f'{key}: {value}' for key, value in get_media_stats().items()))
 
 # Handle all other messages.
-@bot.message_handler(func=lambda message: True, content_types=['audio', 'photo', 'voice', 'video', 'document', 'text', 'location', 'contact', 'sticker'])
+@handler_timed
 def catch_all(message):
     if not is_admin(message.from_user.id):
-        try:
-            bot.forward_message(chat_id=log_chat_id, from_chat_id=message.chat.id, message_id=message.id)
-        except Exception as e:
-            logging.error(f'''{message.chat.id}: {message.text}''', e)
+        # Forwarded to the log chat in batches by a background thread
+        forwarder.add(message.chat.id, message.id)
+
+def register_handlers(bot):
+    """Registers all handlers in the order they are checked"""
+    bot.register_message_handler(process_next_step, func=lambda message: True, content_types=tb.util.content_type_media)
+    bot.register_message_handler(send_welcome, commands=['start', 'help'])
+    bot.register_message_handler(handle_add_shortcut, commands=['add'])
+    bot.register_message_handler(list_shortcuts_handler, commands=['list'])
+    bot.register_message_handler(delete_shortcut_handler, commands=['delete'])
+    bot.register_message_handler(export_handler, commands=['export'])
+    bot.register_message_handler(import_handler, commands=['import'])
+    bot.register_inline_handler(query_text, func=lambda query: True)
+    bot.register_chosen_inline_handler(handle_chosen_shortcut, func=lambda query: True)
+    bot.register_message_handler(admin_get_users, commands=['get_users'])
+    bot.register_message_handler(admin_registrations, commands=['registrations'])
+    bot.register_message_handler(admin_top_shortcuts, commands=['top_shortcuts'])
+    bot.register_message_handler(admin_daily_active_users, commands=['dau'])
+    bot.register_message_handler(admin_rebuild_stats, commands=['rebuild_stats'])
+    bot.register_message_handler(admin_cache_stats, commands=['cache_stats'])
+    bot.register_message_handler(admin_media_stats, commands=['media_stats'])
+    bot.register_message_handler(admin_usage, commands=['usage'])
+    bot.register_message_handler(admin_top_queries, commands=['top_queries'])
+    bot.register_message_handler(admin_retention, commands=['retention'])
+    bot.register_message_handler(catch_all, func=lambda message: True, content_types=['audio', 'photo', 'voice', 'video', 'document', 'text', 'location', 'contact', 'sticker'])
+
+def init(log_file_name: str = 'error.log') -> tb.TeleBot:
+    """Application factory: validates environment, sets up logging and creates the bot with its handlers
+
+    The database engine is created on first use, the schema by `python manage.py migrate`.
+    Processes of one cluster write separate log files, as rotation of a shared file is not safe.
+    """
+    global bot, sender, forwarder, state_store
+    check_environment()
+    setup_logging(log_file_name)
+    # A local Bot API server or a stub, e.g. http://localhost:8081/bot{0}/{1}
+    if getenv('TELEGRAM_API_URL'):
+        tb.apihelper.API_URL = getenv('TELEGRAM_API_URL')
+    # Pending steps of /add and /delete, shared by bot processes unless kept in memory
+    state_store = create_state_store()
+
+    bot = tb.TeleBot(getenv('TGTOKEN').strip(), use_class_middlewares=True)
+    bot.setup_middleware(MetricsMiddleware())
+    bot.setup_middleware(ActivityMiddleware())
+    bot.setup_middleware(AnalyticsMiddleware())
+    register_handlers(bot)
+
+    # Record latency and errors of every Telegram API call
+    instrument_telegram_api()
+    instrument_inline_results_cache()
+
+    # Rate limited sender for messages in bulk
+    sender = Sender(
+        bot,
+        global_rate=float(getenv('SEND_GLOBAL_RATE', 30)),  # Messages per second to all chats
+        chat_rate=float(getenv('SEND_CHAT_RATE', 1)),       # Messages per second to one chat
+        workers=int(getenv('SEND_WORKERS', 4))              # Threads sending /list and other messages in bulk
+    )
+    forwarder = ForwardBatcher(
+        sender,
+        log_chat_id,
+        flush_interval=float(getenv('FORWARD_FLUSH_INTERVAL', 5)),  # Seconds between forwards to the log chat
+        max_pending=int(getenv('FORWARD_MAX_PENDING', 10000))       # Messages waiting to be forwarded, the others are dropped
+    )
+    return bot
 
 if __name__ == '__main__':
-    logging.info("Starting bot polling...")
+    # Exit normally on SIGTERM so buffered usage counters are flushed
+    signal(SIGTERM, lambda signum, frame: exit())
+    if getenv('BOT_RUNTIME', 'sync') == 'async':
+        from async_bot import run
+        run()
+        exit()
+    if int(getenv('CLUSTER_WORKERS', 0)) > 1:
+        from cluster import run_cluster
+        run_cluster(allowed_updates=ALLOWED_UPDATES)
+        exit()
+    init()
+    # Checks files of media shortcuts in the background
+    start_media_validator(bot.token)
+    if getenv('METRICS_PORT'):
+        start_metrics_server(int(getenv('METRICS_PORT')), host=getenv('METRICS_HOST', '127.0.0.1'))
     logging.info(f"Bot username: @shortcut_robot")
     logging.info(f"Inline mode enabled: True")
-    bot.infinity_polling(allowed_updates=['message', 'inline_query', 'chosen_inline_result'])
+    if getenv('BOT_MODE', 'polling') == 'webhook':
+        from webhook import run_webhook
+        logging.info("Starting bot webhook server...")
+        run_webhook(bot, allowed_updates=ALLOWED_UPDATES)
+    else:
+        logging.info("Starting bot polling...")
+        bot.infinity_polling(allowed_updates=ALLOWED_UPDATES)
@@ -0,0 +1,75 @@
+from collections import OrderedDict
+from threading import RLock
+from time import monotonic
+
+
+class LRUCache:
+    """Thread-safe LRU cache with an optional TTL and hit/miss/eviction counters"""
+
+    def __init__(self, maxsize: int = 1024, ttl: float = None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data = OrderedDict()
+        self._lock = RLock()
+
+    def get(self, key, default=None):
+        """Returns a cached value and marks it as recently used"""
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                self.misses += 1
+                return default
+            value, expires_at = item
+            if expires_at is not None and expires_at < monotonic():
+                del self._data[key]
+                self.misses += 1
+                self.evictions += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        """Stores a value, evicting the least recently used ones over the size limit"""
+        with self._lock:
+            expires_at = monotonic() + self.ttl if self.ttl else None
+            self._data[key] = (value, expires_at)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def peek(self, key, default=None):
+        """Returns a cached value without touching counters or LRU order"""
+        with self._lock:
+            item = self._data.get(key)
+            if item is None or (item[1] is not None and item[1] < monotonic()):
+                return default
+            return item[0]
+
+    def pop(self, key, default=None):
+        """Removes a value from the cache"""
+        with self._lock:
+            item = self._data.pop(key, None)
+            return default if item is None else item[0]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self) -> dict:
+        """Returns cache counters"""
+        with self._lock:
+            return {
+                'size': len(self._data),
+                'maxsize': self.maxsize,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
@@ -0,0 +1,290 @@
+"""Multi-process runtime: a dispatcher process routes updates to worker processes by user id.
+
+Updates of one user always go to the same worker process, so its caches of the user's
+shortcuts stay consistent, and there to the same thread, so they are processed in order.
+Every worker is a complete bot with its own connection pool, the pools of all workers
+together have DB_POOL_SIZE and DB_MAX_OVERFLOW connections.
+
+Workers which died or stopped sending heartbeats are restarted, SIGHUP gracefully
+restarts all workers one by one. Selected with CLUSTER_WORKERS=N, see bot.py.
+"""
+import json
+import logging
+import multiprocessing
+from math import ceil
+from os import getenv
+from queue import Empty, Full
+from signal import signal, SIGHUP, SIGINT, SIGTERM, SIG_IGN
+from threading import Thread, Event, Lock
+from time import sleep, time
+from zlib import crc32
+
+import telebot as tb
+
+import metrics
+import models
+from media import start_media_validator
+from webhook import USER_UPDATE_TYPES, UpdateDispatcher, serve_webhook
+
+HEARTBEAT_INTERVAL = 1                                                      # Seconds between heartbeats of a worker
+HEALTH_CHECK_INTERVAL = float(getenv('CLUSTER_HEALTH_CHECK_INTERVAL', 5))   # Seconds between checks of workers
+HEARTBEAT_TIMEOUT = float(getenv('CLUSTER_HEARTBEAT_TIMEOUT', 60))          # Seconds without a heartbeat before a worker is killed
+STOP_TIMEOUT = float(getenv('CLUSTER_STOP_TIMEOUT', 30))                    # Seconds a stopping worker may spend on its queued updates
+
+worker_restarts = metrics.Counter('cluster_worker_restarts_total', 'Worker processes restarted', ['reason'])
+
+
+def get_raw_update_user_id(update: dict) -> int:
+    """Returns id of a user who caused an update as parsed from JSON, or 0 for updates without one"""
+    for kind in USER_UPDATE_TYPES:
+        event = update.get(kind)
+        if event is not None and 'from' in event:
+            return event['from']['id']
+    return 0
+
+
+def worker_main(index: int, updates, heartbeat, processed, pool_size: int, max_overflow: int, threads: int, queue_size: int):
+    """Entry point of a worker process: a bot processing updates from its queue until None"""
+    # The dispatcher stops workers itself, after Ctrl+C of the whole process group too
+    signal(SIGINT, SIG_IGN)
+    signal(SIGTERM, lambda signum, frame: exit())
+    import bot
+
+    models.init(pool_size=pool_size, max_overflow=max_overflow)
+    bot.init(log_file_name=f'worker-{index}.log')
+    if getenv('METRICS_PORT'):
+        metrics.start_metrics_server(int(getenv('METRICS_PORT')) + 1 + index, host=getenv('METRICS_HOST', '127.0.0.1'))
+    bot.bot.threaded = False
+
+    def process(update):
+        bot.bot.process_new_updates([update])
+        with processed.get_lock():
+            processed.value += 1
+
+    dispatcher = UpdateDispatcher(process, workers=threads, queue_size=queue_size)
+    dispatcher.start()
+    while True:
+        heartbeat.value = time()
+        try:
+            update = updates.get(timeout=HEARTBEAT_INTERVAL)
+        except Empty:
+            continue
+        if update is None:
+            break
+        update = tb.types.Update.de_json(update)
+        # No heartbeats while all threads are stuck, so the worker is restarted
+        while not dispatcher.submit(update):
+            sleep(0.01)
+    # Buffered usage counters are flushed by atexit, spawned processes exit through sys.exit()
+    dispatcher.join()
+
+
+class Worker:
+    """A worker process and what the dispatcher shares with it"""
+
+    def __init__(self, context, index: int, queue_size: int):
+        self.index = index
+        self.updates = context.Queue(maxsize=queue_size)
+        self.heartbeat = context.Value('d', 0, lock=False)
+        self.processed = context.Value('q', 0)
+        self.process = None
+        self.restarts = 0
+        self.restarting = False
+
+
+class ClusterDispatcher:
+    """Routes updates to worker processes by a hash of user id and keeps the workers running"""
+
+    def __init__(self, workers: int, threads: int = 8, queue_size: int = 1000):
+        self.context = multiprocessing.get_context('spawn')
+        self.threads = threads
+        self.queue_size = queue_size
+        # Connections of the whole cluster stay within the limits of one process
+        self.pool_size = ceil(models.DB_POOL_SIZE / workers)
+        self.max_overflow = ceil(models.DB_MAX_OVERFLOW / workers)
+        self.workers = [Worker(self.context, i, queue_size) for i in range(workers)]
+        self.rejected = 0
+        self._lock = Lock()
+        self._stopped = Event()
+        self._supervisor = Thread(target=self._supervise, name='cluster-supervisor', daemon=True)
+        metrics.Gauge('cluster_workers_alive', 'Worker processes running', lambda: sum(self._is_alive(w) for w in self.workers))
+        metrics.Gauge('cluster_queue_depth', 'Updates waiting in queues of worker processes', lambda: sum(self._queue_depth(w) for w in self.workers))
+
+    def start(self):
+        for worker in self.workers:
+            self._spawn(worker)
+        self._supervisor.start()
+
+    def _spawn(self, worker: Worker):
+        worker.heartbeat.value = time()
+        worker.process = self.context.Process(
+            target=worker_main,
+            args=(worker.index, worker.updates, worker.heartbeat, worker.processed,
+                  self.pool_size, self.max_overflow, self.threads, self.queue_size),
+            name=f'bot-worker-{worker.index}',
+            daemon=True
+        )
+        worker.process.start()
+        logging.info(f'Started worker {worker.index}, pid {worker.process.pid}')
+
+    def _route(self, update: dict) -> Worker:
+        # Not the plain modulo of workers' threads, so all threads of a worker get users
+        return self.workers[crc32(str(get_raw_update_user_id(update)).encode()) % len(self.workers)]
+
+    def submit(self, update: dict) -> bool:
+        """Queue an update parsed from JSON, returns False if the worker's queue is full"""
+        try:
+            self._route(update).updates.put_nowait(update)
+            return True
+        except Full:
+            with self._lock:
+                self.rejected += 1
+            return False
+
+    def put(self, update: dict):
+        """Queue an update parsed from JSON, waiting while the worker's queue is full"""
+        worker = self._route(update)
+        while True:
+            # A restart may replace the queue of a killed worker, which nobody reads anymore
+            try:
+                worker.updates.put(update, timeout=HEARTBEAT_INTERVAL)
+                return
+            except Full:
+                continue
+
+    def restart(self, worker: Worker, reason: str = 'requested'):
+        """Stops a worker after its queued updates and starts a new one on the same queue"""
+        with self._lock:
+            if worker.restarting:
+                return
+            worker.restarting = True
+        try:
+            if self._is_alive(worker) and reason == 'requested':
+                self._send_stop(worker)
+                worker.process.join(STOP_TIMEOUT)
+            if self._is_alive(worker):
+                worker.process.kill()
+                worker.process.join()
+            if worker.process.exitcode != 0:
+                # A killed process may hold the lock of its queue, the updates left there are lost
+                if self._queue_depth(worker):
+                    logging.error(f'Dropped {self._queue_depth(worker)} updates queued for worker {worker.index}')
+                worker.updates = self.context.Queue(maxsize=self.queue_size)
+            if not self._stopped.is_set():
+                worker.restarts += 1
+                worker_restarts.inc(reason)
+                self._spawn(worker)
+        finally:
+            worker.restarting = False
+
+    def restart_all(self):
+        """Gracefully restarts workers one by one, e.g. to apply a new release"""
+        for worker in self.workers:
+            self.restart(worker)
+
+    def _supervise(self):
+        while not self._stopped.wait(HEALTH_CHECK_INTERVAL):
+            for worker in self.workers:
+                if worker.restarting:
+                    continue
+                if not self._is_alive(worker):
+                    logging.error(f'Worker {worker.index} exited with code {worker.process.exitcode}, restarting')
+                    self.restart(worker, 'died')
+                elif time() - worker.heartbeat.value > HEARTBEAT_TIMEOUT:
+                    logging.error(f'Worker {worker.index} sent no heartbeats for {HEARTBEAT_TIMEOUT} s, restarting')
+                    self.restart(worker, 'unresponsive')
+
+    def stop(self):
+        """Stops all workers after their queued updates"""
+        self._stopped.set()
+        for worker in self.workers:
+            if self._is_alive(worker):
+                self._send_stop(worker)
+        for worker in self.workers:
+            if worker.process is not None:
+                worker.process.join(STOP_TIMEOUT)
+                if worker.process.is_alive():
+                    worker.process.kill()
+
+    @staticmethod
+    def _send_stop(worker: Worker):
+        try:
+            worker.updates.put(None, timeout=STOP_TIMEOUT)
+        except Full:
+            # The worker is killed after STOP_TIMEOUT anyway
+            pass
+
+    @staticmethod
+    def _is_alive(worker: Worker) -> bool:
+        return worker.process is not None and worker.process.is_alive()
+
+    @staticmethod
+    def _queue_depth(worker: Worker) -> int:
+        try:
+            return worker.updates.qsize()
+        except NotImplementedError:
+            # Not available on macOS
+            return 0
+
+    def stats(self) -> dict:
+        """Returns health, queue depth and processed updates of every worker"""
+        now = time()
+        return {
+            'rejected': self.rejected,
+            'workers': [{
+                'pid': worker.process.pid if worker.process else None,
+                'alive': self._is_alive(worker),
+                'heartbeat_age': round(now - worker.heartbeat.value, 1),
+                'queue_depth': self._queue_depth(worker),
+                'processed': worker.processed.value,
+                'restarts': worker.restarts,
+            } for worker in self.workers]
+        }
+
+
+def poll(bot: tb.TeleBot, cluster: ClusterDispatcher, allowed_updates: list = None):
+    """Long polling which hands raw updates to the cluster until interrupted"""
+    offset = None
+    while True:
+        try:
+            updates = tb.apihelper.get_updates(bot.token, offset=offset, timeout=20, long_polling_timeout=20, allowed_updates=allowed_updates)
+        except Exception:
+            logging.exception('Failed to get updates')
+            sleep(3)
+            continue
+        for update in updates:
+            cluster.put(update)
+            offset = update['update_id'] + 1
+
+
+def run_cluster(allowed_updates: list = None):
+    """Serve updates with CLUSTER_WORKERS processes until interrupted"""
+    from bot import check_environment, setup_logging
+    check_environment()
+    setup_logging()
+    if getenv('TELEGRAM_API_URL'):
+        tb.apihelper.API_URL = getenv('TELEGRAM_API_URL')
+
+    cluster = ClusterDispatcher(
+        workers=int(getenv('CLUSTER_WORKERS')),
+        threads=int(getenv('WEBHOOK_WORKERS', 8)),            # Threads of every worker process
+        queue_size=int(getenv('WEBHOOK_QUEUE_SIZE', 1000))    # Updates waiting for every worker process
+    )
+    cluster.start()
+    # Files of media shortcuts are checked by the dispatcher only, workers see the results when their caches expire
+    start_media_validator(getenv('TGTOKEN').strip())
+    signal(SIGHUP, lambda signum, frame: Thread(target=cluster.restart_all, name='cluster-restart', daemon=True).start())
+    if getenv('METRICS_PORT'):
+        metrics.start_metrics_server(int(getenv('METRICS_PORT')), host=getenv('METRICS_HOST', '127.0.0.1'))
+
+    # Used only for calls of the dispatcher itself, handlers run in the workers
+    bot = tb.TeleBot(getenv('TGTOKEN').strip(), threaded=False)
+    try:
+        if getenv('BOT_MODE', 'polling') == 'webhook':
+            logging.info(f'Starting webhook server of {len(cluster.workers)} workers...')
+            serve_webhook(bot, cluster, allowed_updates, parse=json.loads)
+        else:
+            logging.info(f'Starting polling of {len(cluster.workers)} workers...')
+            poll(bot, cluster, allowed_updates)
+    finally:
+        cluster.stop()
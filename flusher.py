@@ -0,0 +1,58 @@
+import atexit
+from threading import Event, Lock, Thread
+
+
+class BackgroundFlusher:
+    """Base of write-behind buffers flushed by a background thread
+
+    Subclasses keep pending items in `_pending` under `_lock`, call `_added()` after
+    buffering one and implement `flush()`. The thread is started on first use and
+    flushes every `flush_interval` seconds or as soon as enough items are pending.
+    Pending items are also flushed at exit.
+    """
+
+    thread_name = 'flusher'
+
+    def __init__(self, flush_interval: float):
+        self.flush_interval = flush_interval
+        self._pending = {}
+        self._lock = Lock()
+        self._wakeup = Event()
+        self._stopped = Event()
+        self._thread = None
+
+    def flush(self):
+        raise NotImplementedError
+
+    def _added(self, size: int, flush_size: int):
+        """Starts the thread on first use and wakes it when `size` pending items reach `flush_size`"""
+        if self._thread is None:
+            self.start()
+        if size >= flush_size:
+            self._wakeup.set()
+
+    def start(self):
+        """Start the background flushing thread"""
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = Thread(target=self._run, name=self.thread_name, daemon=True)
+        self._thread.start()
+        atexit.register(self.stop)
+
+    def stop(self):
+        """Stop the background thread and flush pending items"""
+        self._stopped.set()
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join(timeout=self.flush_interval + 5)
+        self.flush()
+
+    def _run(self):
+        while not self._stopped.is_set():
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            self.flush()
+
+    def pending(self) -> int:
+        return len(self._pending)
@@ -0,0 +1,76 @@
+"""Logging off the update processing path: loggers only put records into a queue,
+a listener thread formats them and writes them to files and stderr.
+
+With LOG_FORMAT=json every record is written as one JSON object, with the fields
+passed in `extra`, e.g. logging.info('added', extra={'user_id': 1}).
+"""
+import atexit
+import json
+import logging
+from logging.handlers import QueueHandler, QueueListener
+from queue import Queue, Full
+
+import metrics
+
+# Attributes every LogRecord has, the others are passed in `extra`
+RECORD_ATTRIBUTES = set(vars(logging.LogRecord('', 0, '', 0, '', None, None))) | {'message', 'asctime', 'taskName'}
+
+_listener = None
+
+
+class JsonFormatter(logging.Formatter):
+    """Formats a record as a JSON object with time, level, logger, message, exception and `extra` fields"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        data = {
+            'time': self.formatTime(record, self.datefmt),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        data.update((key, value) for key, value in vars(record).items() if key not in RECORD_ATTRIBUTES)
+        if record.exc_info:
+            data['exception'] = self.formatException(record.exc_info)
+        return json.dumps(data, ensure_ascii=False, default=str)
+
+
+class NonBlockingQueueHandler(QueueHandler):
+    """Puts records into a bounded queue, records which do not fit are dropped and counted"""
+
+    def __init__(self, queue: Queue):
+        super().__init__(queue)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Records stay in this process, so only the message is merged right away, as its arguments may change
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except Full:
+            self.dropped += 1
+
+
+def start_queue_logging(handlers: list, level='INFO', queue_size: int = 10000):
+    """Sends records of the root logger to `handlers` through a queue served by a listener thread"""
+    global _listener
+    if _listener is not None:
+        return
+    queue_handler = NonBlockingQueueHandler(Queue(maxsize=queue_size))
+    logging.basicConfig(level=level, handlers=[queue_handler])
+    _listener = QueueListener(queue_handler.queue, *handlers, respect_handler_level=True)
+    _listener.start()
+    atexit.register(stop_queue_logging)
+    metrics.Gauge('log_records_dropped', 'Log records dropped because the queue was full', lambda: queue_handler.dropped)
+    metrics.Gauge('log_queue_depth', 'Log records waiting to be written', queue_handler.queue.qsize)
+
+
+def stop_queue_logging():
+    """Writes queued records and stops the listener thread"""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+"""One-shot maintenance commands, run separately from the bot processes.
+
+    python manage.py migrate            create or upgrade the database schema
+    python manage.py migrate 0001       upgrade or downgrade to a revision
+    python manage.py export 12345 -o shortcuts.jsonl
+                                        save shortcuts of a user as JSON Lines
+    python manage.py import 12345 shortcuts.jsonl
+                                        add shortcuts from JSON Lines to a user
+    python manage.py validate-media     check files of media shortcuts now, e.g. from cron
+    python manage.py rollup             aggregate usage events of yesterday and today, e.g. from cron
+"""
+import argparse
+import logging
+import sys
+from datetime import timedelta
+from os import getenv
+from time import perf_counter
+
+import telebot as tb
+
+import analytics
+import media
+import models
+import transfer
+
+
+def migrate(args):
+    models.migrate(args.revision)
+
+
+def export(args):
+    output = open(args.output, 'w', encoding='utf-8') if args.output else sys.stdout
+    try:
+        output.writelines(transfer.export_lines(args.telegram_user_id))
+    finally:
+        if args.output:
+            output.close()
+
+
+def import_(args):
+    if models.get_user(args.telegram_user_id) is None:
+        sys.exit(f'User {args.telegram_user_id} is not registered')
+    start = perf_counter()
+    with open(args.file, 'rb') as file:
+        result = transfer.import_lines(args.telegram_user_id, file, batch_size=args.batch_size)
+    logging.info(f'{result} in {perf_counter() - start:.1f} s')
+
+
+def validate_media(args):
+    if getenv('TELEGRAM_API_URL'):
+        tb.apihelper.API_URL = getenv('TELEGRAM_API_URL')
+    validator = media.MediaValidator(getenv('TGTOKEN').strip(), batch_size=args.batch_size, rate=args.rate, revalidate_after=timedelta(days=args.days))
+    start = perf_counter()
+    result = validator.validate()
+    logging.info(f'{result} in {perf_counter() - start:.1f} s')
+
+
+def rollup(args):
+    start = perf_counter()
+    result = analytics.rollup(days=args.days, keep_days=args.keep_days)
+    logging.info(f'{result} in {perf_counter() - start:.1f} s')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    command = commands.add_parser('migrate', help='create or upgrade the database schema')
+    command.add_argument('revision', nargs='?', default='head', help='target revision, the latest one by default')
+    command.set_defaults(handler=migrate)
+
+    command = commands.add_parser('export', help='save shortcuts of a user as JSON Lines')
+    command.add_argument('telegram_user_id', type=int)
+    command.add_argument('-o', '--output', help='file to write, stdout by default')
+    command.set_defaults(handler=export)
+
+    command = commands.add_parser('import', help='add shortcuts from JSON Lines to a user, skipping names the user already has')
+    command.add_argument('telegram_user_id', type=int)
+    command.add_argument('file', help='JSON Lines file, e.g. made by export')
+    command.add_argument('--batch-size', type=int, default=transfer.IMPORT_BATCH_SIZE, help='shortcuts inserted in one transaction')
+    command.set_defaults(handler=import_)
+
+    command = commands.add_parser('validate-media', help='check files of media shortcuts with getFile and mark the broken ones')
+    command.add_argument('--batch-size', type=int, default=media.MEDIA_VALIDATE_BATCH_SIZE, help='files checked and saved at once')
+    command.add_argument('--rate', type=float, default=media.MEDIA_VALIDATE_RATE, help='getFile calls per second')
+    command.add_argument('--days', type=float, default=media.MEDIA_REVALIDATE_DAYS, help='check files not checked for so many days, 0 for all')
+    command.set_defaults(handler=validate_media)
+
+    command = commands.add_parser('rollup', help='aggregate usage events into daily tables and delete old events')
+    command.add_argument('--days', type=int, default=2, help='days to aggregate again, today included')
+    command.add_argument('--keep-days', type=int, default=analytics.ANALYTICS_KEEP_DAYS, help='days events are kept, 0 to keep all')
+    command.set_defaults(handler=rollup)
+
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    args.handler(args)
+
+
+if __name__ == '__main__':
+    main()
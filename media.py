@@ -0,0 +1,153 @@
+"""Background validation of files of media shortcuts.
+
+Shortcuts keep only a file_id, which Telegram may stop serving. A background thread
+checks file ids with getFile in batches within MEDIA_VALIDATE_RATE calls per second,
+caches size and mime type of the files in the media_files table and marks shortcuts
+with files Telegram rejects, so inline queries and /list skip them. A file which is
+valid again on a later check unmarks its shortcuts.
+
+Run by one process only: the bot, the dispatcher of a cluster or `python manage.py validate-media`.
+"""
+import atexit
+import logging
+from datetime import datetime as dt, timedelta
+from mimetypes import guess_type
+from os import getenv
+from threading import Event, Thread
+from time import sleep
+
+import telebot as tb
+
+import metrics
+from models import get_media_files_to_validate, save_media_checks
+from sender import TokenBucket, get_retry_after
+
+MEDIA_VALIDATE_INTERVAL = float(getenv('MEDIA_VALIDATE_INTERVAL', 3600))    # Seconds between validation rounds, 0 to disable
+MEDIA_VALIDATE_BATCH_SIZE = int(getenv('MEDIA_VALIDATE_BATCH_SIZE', 100))   # Files checked and saved at once
+MEDIA_VALIDATE_RATE = float(getenv('MEDIA_VALIDATE_RATE', 5))               # getFile calls per second
+MEDIA_REVALIDATE_DAYS = float(getenv('MEDIA_REVALIDATE_DAYS', 7))           # Days before a checked file is checked again
+
+media_checks = metrics.Counter('media_file_checks_total', 'Files of media shortcuts checked with getFile', ['result'])
+
+
+class TransientError(Exception):
+    """getFile failed for a reason other than the file itself, e.g. flood control or a network error"""
+
+
+def get_media_metadata(message) -> dict:
+    """Returns metadata of a file sent in a message, None if the message has no file"""
+    if message.content_type in ('text', 'location'):
+        return None
+    media = getattr(message, message.content_type)
+    # The first of photo sizes, the one a shortcut keeps
+    media = media[0] if isinstance(media, list) else media
+    thumbnail = getattr(media, 'thumbnail', None)
+    return {
+        'file_unique_id': getattr(media, 'file_unique_id', None),
+        'file_size': getattr(media, 'file_size', None),
+        'mime_type': getattr(media, 'mime_type', None) or ('image/jpeg' if message.content_type == 'photo' else None),
+        'thumbnail_file_id': thumbnail.file_id if thumbnail else None,
+    }
+
+
+class MediaValidator:
+    """Checks file ids of media shortcuts with getFile from a background thread
+
+    Every `interval` seconds file ids never checked or not checked for `revalidate_after`
+    are checked in batches of `batch_size` until none are left. A round ends early on
+    errors unrelated to the files, which are retried in the next round.
+    """
+
+    def __init__(self, token: str, interval: float = 3600, batch_size: int = 100, rate: float = 5, revalidate_after: timedelta = timedelta(days=7)):
+        self.token = token
+        self.interval = interval
+        self.batch_size = batch_size
+        self.revalidate_after = revalidate_after
+        self.bucket = TokenBucket(rate)
+        self._stopped = Event()
+        self._thread = None
+
+    def check(self, file_id: str) -> dict:
+        """Returns a media_files row for a file id, raises TransientError if it can't be checked now"""
+        sleep(self.bucket.reserve())
+        try:
+            file = tb.apihelper.get_file(self.token, file_id)
+        except Exception as e:
+            if isinstance(e, tb.apihelper.ApiTelegramException) and e.error_code == 400:
+                # Files over 20 MB can't be downloaded by bots, but can still be sent
+                if 'too big' in e.description:
+                    media_checks.inc('too_big')
+                    return {'is_broken': False, 'error': None}
+                media_checks.inc('broken')
+                return {'is_broken': True, 'error': e.description}
+            retry_after = get_retry_after(e)
+            if retry_after is not None:
+                self.bucket.pause(retry_after)
+            media_checks.inc('failed')
+            raise TransientError(str(e)) from e
+        media_checks.inc('valid')
+        return {
+            'is_broken': False,
+            'error': None,
+            'file_unique_id': file.get('file_unique_id'),
+            'file_size': file.get('file_size'),
+            'mime_type': guess_type(file.get('file_path') or '')[0],
+        }
+
+    def validate(self) -> dict:
+        """Runs one round, returns numbers of checked files and of shortcuts marked or unmarked as broken"""
+        result = {'checked': 0, 'changed': 0}
+        checked_before = dt.now() - self.revalidate_after
+        while not self._stopped.is_set():
+            file_ids = get_media_files_to_validate(checked_before, self.batch_size)
+            checks = {}
+            try:
+                for file_id in file_ids:
+                    checks[file_id] = self.check(file_id)
+            except TransientError as e:
+                logging.warning(f'Media validation stopped until the next round: {e}')
+                file_ids = []
+            finally:
+                result['checked'] += len(checks)
+                result['changed'] += save_media_checks(checks)
+            if len(file_ids) < self.batch_size:
+                break
+        if result['changed']:
+            logging.info(f'Media validation: {result["changed"]} shortcuts changed their state, {result["checked"]} files checked')
+        return result
+
+    def start(self):
+        """Start the background validation thread"""
+        if self._thread is not None:
+            return
+        self._thread = Thread(target=self._run, name='media-validator', daemon=True)
+        self._thread.start()
+        atexit.register(self.stop)
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+
+    def _run(self):
+        while not self._stopped.is_set():
+            try:
+                self.validate()
+            except Exception:
+                logging.exception('Media validation failed')
+            self._stopped.wait(self.interval)
+
+
+def start_media_validator(token: str):
+    """Starts a MediaValidator configured by environment, unless MEDIA_VALIDATE_INTERVAL is 0"""
+    if not MEDIA_VALIDATE_INTERVAL:
+        return None
+    validator = MediaValidator(
+        token,
+        interval=MEDIA_VALIDATE_INTERVAL,
+        batch_size=MEDIA_VALIDATE_BATCH_SIZE,
+        rate=MEDIA_VALIDATE_RATE,
+        revalidate_after=timedelta(days=MEDIA_REVALIDATE_DAYS)
+    )
+    validator.start()
+    return validator
@@ -0,0 +1,285 @@
+"""Low overhead in-process metrics served in Prometheus text format.
+
+Recording a value is a perf_counter call, a bisect over fixed buckets and
+a few additions under a lock, so metrics are always on.
+"""
+import inspect
+import logging
+from bisect import bisect_left
+from contextvars import ContextVar
+from functools import wraps
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock, Thread
+from time import perf_counter
+
+import telebot as tb
+
+# Seconds, from a cached lookup to a slow Telegram API call
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+REGISTRY = []
+
+
+def _format_labels(labelnames, labelvalues, extra: str = '') -> str:
+    pairs = [f'{name}="{str(value)}"' for name, value in zip(labelnames, labelvalues)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class Counter:
+    def __init__(self, name: str, documentation: str, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = Lock()
+        REGISTRY.append(self)
+
+    def inc(self, *labelvalues, amount: float = 1):
+        with self._lock:
+            self._values[labelvalues] = self._values.get(labelvalues, 0) + amount
+
+    def render(self) -> list:
+        with self._lock:
+            values = dict(self._values)
+        return [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} counter'] + [
+            f'{self.name}{_format_labels(self.labelnames, labelvalues)} {value}' for labelvalues, value in values.items()
+        ]
+
+
+class Histogram:
+    def __init__(self, name: str, documentation: str, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._values = {}   # label values -> [bucket counts..., +Inf count, sum]
+        self._lock = Lock()
+        REGISTRY.append(self)
+
+    def observe(self, value: float, *labelvalues):
+        i = bisect_left(self.buckets, value)
+        with self._lock:
+            values = self._values.get(labelvalues)
+            if values is None:
+                values = self._values[labelvalues] = [0] * (len(self.buckets) + 2)
+            values[i] += 1
+            values[-1] += value
+
+    def render(self) -> list:
+        with self._lock:
+            values = {labelvalues: list(counts) for labelvalues, counts in self._values.items()}
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} histogram']
+        for labelvalues, counts in values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                labels = _format_labels(self.labelnames, labelvalues, f'le="{bound}"')
+                lines.append(f'{self.name}_bucket{labels} {cumulative}')
+            lines.append(f'{self.name}_sum{_format_labels(self.labelnames, labelvalues)} {counts[-1]}')
+            lines.append(f'{self.name}_count{_format_labels(self.labelnames, labelvalues)} {cumulative}')
+        return lines
+
+
+class Gauge:
+    """Gauge whose value is taken from a callback when metrics are rendered"""
+
+    def __init__(self, name: str, documentation: str, callback):
+        self.name = name
+        self.documentation = documentation
+        self.callback = callback
+        REGISTRY.append(self)
+
+    def render(self) -> list:
+        try:
+            value = self.callback()
+        except Exception:
+            return []
+        return [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} gauge', f'{self.name} {value}']
+
+
+def render() -> str:
+    """Returns all metrics in Prometheus text format"""
+    return '\n'.join(line for metric in REGISTRY for line in metric.render()) + '\n'
+
+
+handler_latency = Histogram('bot_handler_latency_seconds', 'Latency of bot handlers', ['handler'])
+handler_errors = Counter('bot_handler_errors_total', 'Exceptions raised by bot handlers', ['handler'])
+db_function_latency = Histogram('db_function_latency_seconds', 'Latency of models.py functions', ['function'])
+db_queries = Counter('db_queries_total', 'SQL statements executed')
+db_queries_per_update = Histogram('db_queries_per_update', 'SQL statements executed while processing an update', ['update_type'], COUNT_BUCKETS)
+db_pool_checkout_wait = Histogram('db_pool_checkout_wait_seconds', 'Time spent waiting for a connection from the pool')
+telegram_api_latency = Histogram('telegram_api_latency_seconds', 'Latency of Telegram API calls', ['method'])
+telegram_api_errors = Counter('telegram_api_errors_total', 'Failed Telegram API calls', ['method'])
+
+# Number of SQL statements executed within the current update
+_update_queries = ContextVar('update_queries', default=None)
+_telegram_api_instrumented = False
+
+
+def timed(histogram: Histogram, label: str = None, errors: Counter = None):
+    """Decorator recording latency of a sync or async function into a histogram"""
+    def decorator(function):
+        name = label or function.__name__
+
+        if inspect.iscoroutinefunction(function):
+            @wraps(function)
+            async def async_wrapper(*args, **kwargs):
+                start = perf_counter()
+                try:
+                    return await function(*args, **kwargs)
+                except Exception:
+                    if errors is not None:
+                        errors.inc(name)
+                    raise
+                finally:
+                    histogram.observe(perf_counter() - start, name)
+            return async_wrapper
+
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            start = perf_counter()
+            try:
+                return function(*args, **kwargs)
+            except Exception:
+                if errors is not None:
+                    errors.inc(name)
+                raise
+            finally:
+                histogram.observe(perf_counter() - start, name)
+        return wrapper
+    return decorator
+
+
+def handler_timed(function):
+    """Records latency and errors of a bot handler"""
+    return timed(handler_latency, errors=handler_errors)(function)
+
+
+def instrument_module(module, histogram: Histogram = db_function_latency, skip=()):
+    """Wraps all public functions defined in a module, except those in `skip`, to record their latency"""
+    for name, function in list(vars(module).items()):
+        if (
+            not name.startswith('_')
+            and name not in skip
+            and inspect.isfunction(function)
+            and function.__module__ == module.__name__
+            and not inspect.isgeneratorfunction(function)
+            and not inspect.isasyncgenfunction(function)
+        ):
+            setattr(module, name, timed(histogram)(function))
+
+
+def instrument_engine(engine, pool_metrics: bool = True):
+    """Counts SQL statements and measures pool checkout wait and utilization of a SQLAlchemy engine"""
+    from sqlalchemy import event
+
+    @event.listens_for(engine, 'before_cursor_execute')
+    def count_query(conn, cursor, statement, parameters, context, executemany):
+        db_queries.inc()
+        queries = _update_queries.get()
+        if queries is not None:
+            queries[0] += 1
+
+    if not pool_metrics:
+        return
+    pool = engine.pool
+    do_get = pool._do_get
+
+    def timed_do_get():
+        start = perf_counter()
+        try:
+            return do_get()
+        finally:
+            db_pool_checkout_wait.observe(perf_counter() - start)
+
+    pool._do_get = timed_do_get
+    for name, documentation, attribute in (
+        ('db_pool_size', 'Permanent connections in the pool', 'size'),
+        ('db_pool_checked_out', 'Connections currently in use', 'checkedout'),
+        ('db_pool_overflow', 'Temporary connections over the pool size', 'overflow'),
+        ('db_pool_checked_in', 'Idle connections in the pool', 'checkedin'),
+    ):
+        if hasattr(pool, attribute):
+            Gauge(name, documentation, getattr(pool, attribute))
+
+
+def start_update():
+    """Starts counting SQL statements of an update processed in the current context"""
+    _update_queries.set([0])
+
+
+def finish_update(update_type: str):
+    queries = _update_queries.get()
+    if queries is not None:
+        db_queries_per_update.observe(queries[0], update_type)
+        _update_queries.set(None)
+
+
+def instrument_telegram_api():
+    """Records latency and errors of all Telegram API calls made by TeleBot and AsyncTeleBot, once per process"""
+    global _telegram_api_instrumented
+    if _telegram_api_instrumented:
+        return
+    _telegram_api_instrumented = True
+    make_request = tb.apihelper._make_request
+
+    @wraps(make_request)
+    def timed_make_request(token, method_name, *args, **kwargs):
+        start = perf_counter()
+        try:
+            return make_request(token, method_name, *args, **kwargs)
+        except Exception:
+            telegram_api_errors.inc(method_name)
+            raise
+        finally:
+            telegram_api_latency.observe(perf_counter() - start, method_name)
+
+    tb.apihelper._make_request = timed_make_request
+
+    try:
+        from telebot import asyncio_helper
+    except ImportError:
+        # aiohttp is not installed, the asyncio runtime is not used
+        return
+    process_request = asyncio_helper._process_request
+
+    @wraps(process_request)
+    async def timed_process_request(token, url, *args, **kwargs):
+        start = perf_counter()
+        try:
+            return await process_request(token, url, *args, **kwargs)
+        except Exception:
+            telegram_api_errors.inc(url)
+            raise
+        finally:
+            telegram_api_latency.observe(perf_counter() - start, url)
+
+    asyncio_helper._process_request = timed_process_request
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != '/metrics':
+            self.send_response(404)
+            self.end_headers()
+            return
+        body = render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_metrics_server(port: int, host: str = '127.0.0.1'):
+    """Serves /metrics from a background thread"""
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    Thread(target=server.serve_forever, name='metrics-server', daemon=True).start()
+    logging.info(f'Serving metrics on http://{host}:{port}/metrics')
+    return server
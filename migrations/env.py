@@ -0,0 +1,39 @@
+"""Alembic environment wired to models.Base and the engine of models.py"""
+from logging.config import fileConfig
+
+from alembic import context
+
+import models
+
+config = context.config
+if config.config_file_name is not None and config.attributes.get('configure_logger', True):
+    fileConfig(config.config_file_name)
+
+target_metadata = models.Base.metadata
+
+
+def run_migrations_offline():
+    """Prints SQL of migrations instead of executing it: `alembic upgrade head --sql`"""
+    context.configure(
+        url=models.get_engine().url,
+        target_metadata=target_metadata,
+        literal_binds=True,
+        dialect_opts={'paramstyle': 'named'},
+        render_as_batch=True
+    )
+    with context.begin_transaction():
+        context.run_migrations()
+
+
+def run_migrations_online():
+    with models.get_engine().connect() as connection:
+        # SQLite can't alter tables, batch mode recreates them instead
+        context.configure(connection=connection, target_metadata=target_metadata, render_as_batch=True)
+        with context.begin_transaction():
+            context.run_migrations()
+
+
+if context.is_offline_mode():
+    run_migrations_offline()
+else:
+    run_migrations_online()
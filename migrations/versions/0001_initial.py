@@ -0,0 +1,86 @@
+"""Initial schema, as it was created by Base.metadata.create_all
+
+Tables which already exist are skipped, so databases created before migrations
+are upgraded the same way as empty ones.
+
+Revision ID: 0001
+Revises:
+Create Date: 2026-10-17
+"""
+from alembic import op
+import sqlalchemy as sa
+
+revision = '0001'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    existing = set(sa.inspect(op.get_bind()).get_table_names())
+
+    if 'users' not in existing:
+        op.create_table(
+            'users',
+            sa.Column('telegram_user_id', sa.Integer(), nullable=False),
+            sa.Column('username', sa.String(), nullable=True),
+            sa.Column('created_at', sa.DateTime(), nullable=True),
+            sa.Column('start_param', sa.String(), nullable=True),
+            sa.PrimaryKeyConstraint('telegram_user_id'),
+            sa.UniqueConstraint('telegram_user_id')
+        )
+    if 'shortcuts' not in existing:
+        op.create_table(
+            'shortcuts',
+            sa.Column('telegram_user_id', sa.Integer(), nullable=False),
+            sa.Column('id', sa.Integer(), nullable=False),
+            sa.Column('shortcut_name', sa.String(), nullable=False),
+            sa.Column('content_type', sa.String(), nullable=False),
+            sa.Column('text', sa.String(), nullable=True),
+            sa.Column('content', sa.String(), nullable=True),
+            sa.Column('add_dt', sa.DateTime(), nullable=False),
+            sa.Column('update_dt', sa.DateTime(), nullable=False),
+            sa.Column('entities', sa.JSON(), nullable=True),
+            sa.Column('num_of_uses', sa.Integer(), nullable=True),
+            sa.Column('last_use_dt', sa.DateTime(), nullable=True),
+            sa.ForeignKeyConstraint(['telegram_user_id'], ['users.telegram_user_id']),
+            sa.PrimaryKeyConstraint('id')
+        )
+        op.create_index('ix_shortcuts_shortcut_name', 'shortcuts', ['shortcut_name'])
+        op.create_index('ix_shortcuts_num_of_uses', 'shortcuts', ['num_of_uses'])
+    elif 'ix_shortcuts_num_of_uses' not in {index['name'] for index in sa.inspect(op.get_bind()).get_indexes('shortcuts')}:
+        # Tables created before the admin stats have no index for top shortcuts
+        op.create_index('ix_shortcuts_num_of_uses', 'shortcuts', ['num_of_uses'])
+    if 'admins' not in existing:
+        op.create_table(
+            'admins',
+            sa.Column('telegram_user_id', sa.Integer(), nullable=False),
+            sa.PrimaryKeyConstraint('telegram_user_id')
+        )
+    if 'user_stats' not in existing:
+        op.create_table(
+            'user_stats',
+            sa.Column('telegram_user_id', sa.Integer(), nullable=False),
+            sa.Column('num_shortcuts', sa.Integer(), nullable=False),
+            sa.ForeignKeyConstraint(['telegram_user_id'], ['users.telegram_user_id']),
+            sa.PrimaryKeyConstraint('telegram_user_id')
+        )
+    if 'start_param_stats' not in existing:
+        op.create_table(
+            'start_param_stats',
+            sa.Column('start_param', sa.String(), nullable=False),
+            sa.Column('num_users', sa.Integer(), nullable=False),
+            sa.PrimaryKeyConstraint('start_param')
+        )
+    if 'user_activity' not in existing:
+        op.create_table(
+            'user_activity',
+            sa.Column('day', sa.Date(), nullable=False),
+            sa.Column('telegram_user_id', sa.Integer(), nullable=False),
+            sa.PrimaryKeyConstraint('day', 'telegram_user_id')
+        )
+
+
+def downgrade():
+    for table in ('user_activity', 'start_param_stats', 'user_stats', 'admins', 'shortcuts', 'users'):
+        op.drop_table(table)
@@ -0,0 +1,55 @@
+"""Composite indexes for lookups of user's shortcuts and unique names per user
+
+Existing duplicate names of one user are renamed to `name (id)`, the oldest
+shortcut keeps its name.
+
+Revision ID: 0002
+Revises: 0001
+Create Date: 2026-10-17
+"""
+from alembic import op
+import sqlalchemy as sa
+
+revision = '0002'
+down_revision = '0001'
+branch_labels = None
+depends_on = None
+
+shortcuts = sa.table(
+    'shortcuts',
+    sa.column('id', sa.Integer),
+    sa.column('telegram_user_id', sa.Integer),
+    sa.column('shortcut_name', sa.String)
+)
+
+
+def rename_duplicates(connection):
+    duplicates = connection.execute(
+        sa.select(shortcuts.c.telegram_user_id, shortcuts.c.shortcut_name)
+        .group_by(shortcuts.c.telegram_user_id, shortcuts.c.shortcut_name)
+        .having(sa.func.count() > 1)
+    ).all()
+    for telegram_user_id, shortcut_name in duplicates:
+        ids = connection.scalars(
+            sa.select(shortcuts.c.id)
+            .where(shortcuts.c.telegram_user_id == telegram_user_id, shortcuts.c.shortcut_name == shortcut_name)
+            .order_by(shortcuts.c.id)
+        ).all()
+        for shortcut_id in ids[1:]:
+            connection.execute(
+                shortcuts.update().where(shortcuts.c.id == shortcut_id).values(shortcut_name=f'{shortcut_name} ({shortcut_id})')
+            )
+
+
+def upgrade():
+    rename_duplicates(op.get_bind())
+    op.create_index('ix_shortcuts_user_uses', 'shortcuts', ['telegram_user_id', sa.text('num_of_uses DESC')])
+    op.create_index('uq_shortcuts_user_name', 'shortcuts', ['telegram_user_id', 'shortcut_name'], unique=True)
+    # Names are looked up only together with a user, which the unique index covers
+    op.drop_index('ix_shortcuts_shortcut_name', table_name='shortcuts')
+
+
+def downgrade():
+    op.create_index('ix_shortcuts_shortcut_name', 'shortcuts', ['shortcut_name'])
+    op.drop_index('uq_shortcuts_user_name', table_name='shortcuts')
+    op.drop_index('ix_shortcuts_user_uses', table_name='shortcuts')
@@ -0,0 +1,30 @@
+"""Pending steps of multi-message flows, kept in the database by STATE_STORE=sql
+
+Revision ID: 0003
+Revises: 0002
+Create Date: 2026-10-17
+"""
+from alembic import op
+import sqlalchemy as sa
+
+revision = '0003'
+down_revision = '0002'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'conversation_states',
+        sa.Column('chat_id', sa.Integer(), nullable=False),
+        sa.Column('step', sa.String(), nullable=False),
+        sa.Column('context', sa.JSON(), nullable=True),
+        sa.Column('expires_at', sa.DateTime(), nullable=False),
+        sa.PrimaryKeyConstraint('chat_id')
+    )
+    op.create_index('ix_conversation_states_expires_at', 'conversation_states', ['expires_at'])
+
+
+def downgrade():
+    op.drop_index('ix_conversation_states_expires_at', table_name='conversation_states')
+    op.drop_table('conversation_states')
@@ -0,0 +1,40 @@
+"""Metadata and validity of files of media shortcuts, validated by media.py
+
+Revision ID: 0004
+Revises: 0003
+Create Date: 2026-10-17
+"""
+from alembic import op
+import sqlalchemy as sa
+
+revision = '0004'
+down_revision = '0003'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'media_files',
+        sa.Column('file_id', sa.String(), nullable=False),
+        sa.Column('file_unique_id', sa.String(), nullable=True),
+        sa.Column('file_size', sa.Integer(), nullable=True),
+        sa.Column('mime_type', sa.String(), nullable=True),
+        sa.Column('thumbnail_file_id', sa.String(), nullable=True),
+        sa.Column('is_broken', sa.Boolean(), server_default=sa.false(), nullable=False),
+        sa.Column('error', sa.String(), nullable=True),
+        sa.Column('checked_at', sa.DateTime(), nullable=True),
+        sa.PrimaryKeyConstraint('file_id')
+    )
+    op.create_index('ix_media_files_checked_at', 'media_files', ['checked_at'])
+    op.add_column('shortcuts', sa.Column('is_broken', sa.Boolean(), server_default=sa.false(), nullable=False))
+    op.create_index('ix_shortcuts_content', 'shortcuts', ['content'])
+
+
+def downgrade():
+    op.drop_index('ix_shortcuts_content', table_name='shortcuts')
+    # SQLite can drop a column only by copying the table
+    with op.batch_alter_table('shortcuts') as batch:
+        batch.drop_column('is_broken')
+    op.drop_index('ix_media_files_checked_at', table_name='media_files')
+    op.drop_table('media_files')
@@ -0,0 +1,43 @@
+"""Counts users by start param and shortcuts of users registered before the statistics counters
+
+Counters of start params are recounted from users, so they are right whether the
+table was empty or already had increments. Users without a counter get theirs.
+
+Revision ID: 0005
+Revises: 0004
+Create Date: 2026-10-17
+"""
+from alembic import op
+import sqlalchemy as sa
+
+revision = '0005'
+down_revision = '0004'
+branch_labels = None
+depends_on = None
+
+users = sa.table('users', sa.column('telegram_user_id', sa.Integer()), sa.column('start_param', sa.String()))
+shortcuts = sa.table('shortcuts', sa.column('id', sa.Integer()), sa.column('telegram_user_id', sa.Integer()))
+user_stats = sa.table('user_stats', sa.column('telegram_user_id', sa.Integer()), sa.column('num_shortcuts', sa.Integer()))
+start_param_stats = sa.table('start_param_stats', sa.column('start_param', sa.String()), sa.column('num_users', sa.Integer()))
+
+
+def upgrade():
+    op.execute(sa.delete(start_param_stats))
+    start_param = sa.func.coalesce(users.c.start_param, '')
+    op.execute(sa.insert(start_param_stats).from_select(
+        ['start_param', 'num_users'],
+        sa.select(start_param, sa.func.count()).group_by(start_param)
+    ))
+    op.execute(sa.insert(user_stats).from_select(
+        ['telegram_user_id', 'num_shortcuts'],
+        sa.select(users.c.telegram_user_id, sa.func.count(shortcuts.c.id)).select_from(
+            users.outerjoin(shortcuts, shortcuts.c.telegram_user_id == users.c.telegram_user_id)
+        ).where(
+            ~sa.exists().where(user_stats.c.telegram_user_id == users.c.telegram_user_id)
+        ).group_by(users.c.telegram_user_id)
+    ))
+
+
+def downgrade():
+    # Counters are data, they stay
+    pass
@@ -1,28 +1,81 @@
-from sqlalchemy import create_engine, Column, Integer, String, ForeignKey, DateTime, func, JSON
-from sqlalchemy.orm import sessionmaker, relationship, declarative_base
+from sqlalchemy import create_engine, Column, Integer, String, Boolean, ForeignKey, DateTime, Date, func, JSON, select, update, insert, delete, bindparam, Index, desc, or_, false
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.engine import make_url
+from sqlalchemy.orm import Session as OrmSession, relationship, declarative_base
 from dotenv import load_dotenv
-from datetime import datetime as dt
+from dataclasses import dataclass
+from datetime import datetime as dt, timedelta
 from os import getenv
+from os.path import dirname, join
+from cache import LRUCache
+from search import ShortcutIndex
+from analytics import get_shortcut_uses
+import metrics
+import asyncio
+import sys
+from threading import Lock
 
 load_dotenv()
 
-# Validate DATABASE_URL exists
 DATABASE_URL = getenv('DATABASE_URL')
-if not DATABASE_URL:
-    raise ValueError("DATABASE_URL environment variable is required")
-
-# Create engine with connection pooling
-engine = create_engine(
-    DATABASE_URL,
-    pool_size=20,           # Maximum number of permanent connections
-    max_overflow=10,        # Maximum number of temporary connections
-    pool_pre_ping=True,     # Verify connections before using
-    pool_recycle=3600,      # Recycle connections after 1 hour
-    echo=False              # Set to True for SQL debugging
-)
-Session = sessionmaker(bind=engine)
+DB_POOL_SIZE = int(getenv('DB_POOL_SIZE', 20))          # Maximum number of permanent connections of a process
+DB_MAX_OVERFLOW = int(getenv('DB_MAX_OVERFLOW', 10))    # Maximum number of temporary connections of a process
+
+# Engine and its connection pool are created by init() or on first use, so importing is cheap
+engine = None
+_engine_lock = Lock()
 Base = declarative_base()
 
+def _database_url() -> str:
+    url = DATABASE_URL or getenv('DATABASE_URL')
+    if not url:
+        raise ValueError("DATABASE_URL environment variable is required")
+    return url
+
+def init(database_url: str=None, pool_size: int=None, max_overflow: int=None):
+    """Creates the engine with connection pooling, for DATABASE_URL and a pool of DB_POOL_SIZE unless others are given"""
+    global DATABASE_URL, engine
+    with _engine_lock:
+        if engine is None:
+            DATABASE_URL = database_url or _database_url()
+            engine = create_engine(
+                DATABASE_URL,
+                pool_size=DB_POOL_SIZE if pool_size is None else pool_size,
+                max_overflow=DB_MAX_OVERFLOW if max_overflow is None else max_overflow,
+                pool_pre_ping=True,     # Verify connections before using
+                pool_recycle=3600,      # Recycle connections after 1 hour
+                echo=False              # Set to True for SQL debugging
+            )
+            metrics.instrument_engine(engine)
+    return engine
+
+def get_engine():
+    return engine or init()
+
+class Session(OrmSession):
+    """Session bound to the engine, which is created on first use"""
+
+    def __init__(self, **kwargs):
+        super().__init__(bind=get_engine(), **kwargs)
+
+# Async engine for the asyncio runtime, created on first use
+ASYNC_DRIVERS = {
+    'postgresql': 'postgresql+asyncpg',
+    'sqlite': 'sqlite+aiosqlite',
+    'mysql': 'mysql+aiomysql',
+}
+async_engine = None
+AsyncSession = None
+
+# Per-user cache of shortcuts search indexes for inline queries
+shortcut_cache = LRUCache(
+    maxsize=int(getenv('SHORTCUT_CACHE_SIZE', 1000)),   # Maximum number of cached users
+    ttl=float(getenv('SHORTCUT_CACHE_TTL', 600))        # Seconds before a user's shortcuts are reloaded
+)
+
+# Ids of all admins, which are added directly to DB and so are reloaded periodically
+admin_cache = LRUCache(maxsize=1, ttl=float(getenv('ADMIN_CACHE_TTL', 60)))
+
 class User(Base):
     __tablename__ = 'users'
 
@@ -40,17 +93,26 @@ class Shortcut(Base):
 
     telegram_user_id = Column(Integer, ForeignKey('users.telegram_user_id'), nullable=False)
     id = Column(Integer, primary_key=True)
-    shortcut_name = Column(String, index=True, nullable=False)
+    shortcut_name = Column(String, nullable=False)
     content_type = Column(String, nullable=False)
     text = Column(String, nullable=True)
     content = Column(String, nullable=True)
     add_dt = Column(DateTime, nullable=False)
     update_dt = Column(DateTime, nullable=False)
     entities = Column(JSON, nullable=True)
-    num_of_uses = Column(Integer, default=0)
+    num_of_uses = Column(Integer, default=0, index=True)
     last_use_dt = Column(DateTime, nullable=True)
+    is_broken = Column(Boolean, nullable=False, default=False, server_default=false())    # Telegram no longer serves the file in `content`
     user = relationship('User', back_populates='shortcuts')
 
+    __table_args__ = (
+        # All user's shortcuts ranked by use, and a shortcut by its name
+        Index('ix_shortcuts_user_uses', 'telegram_user_id', desc('num_of_uses')),
+        Index('uq_shortcuts_user_name', 'telegram_user_id', 'shortcut_name', unique=True),
+        # Shortcuts with a file, to mark them when the file is validated
+        Index('ix_shortcuts_content', 'content'),
+    )
+
     def __repr__(self):
         return f"<Shortcut(shortcut_name='{self.shortcut_name}', content='{self.text[:10]}...')>"
 
@@ -62,8 +124,281 @@ class Admin(Base):
     def __repr__(self):
         return f"<Admin(telegram_user_id='{self.telegram_user_id}')>"
 
-# Создать все таблицы
-Base.metadata.create_all(engine)
+# Счётчики для статистики, обновляются вместе с основными таблицами
+
+class UserStats(Base):
+    __tablename__ = 'user_stats'
+
+    telegram_user_id = Column(Integer, ForeignKey('users.telegram_user_id'), primary_key=True)
+    num_shortcuts = Column(Integer, nullable=False, default=0)
+
+class StartParamStats(Base):
+    __tablename__ = 'start_param_stats'
+
+    start_param = Column(String, primary_key=True)     # Empty string for users without a start param
+    num_users = Column(Integer, nullable=False, default=0)
+
+class UserActivity(Base):
+    __tablename__ = 'user_activity'
+
+    day = Column(Date, primary_key=True)
+    telegram_user_id = Column(Integer, primary_key=True)
+
+# Незавершённые шаги диалогов (/add, /delete), см. state.py
+
+class ConversationState(Base):
+    __tablename__ = 'conversation_states'
+
+    chat_id = Column(Integer, primary_key=True)
+    step = Column(String, nullable=False)               # Name of a handler of the next message
+    context = Column(JSON, nullable=True)
+    expires_at = Column(DateTime, nullable=False, index=True)
+
+# Метаданные файлов медиа-шорткатов, проверяются фоновым потоком, см. media.py
+
+# Content types of shortcuts whose `content` is not a file_id
+NON_FILE_CONTENT_TYPES = ('text', 'location')
+
+class MediaFile(Base):
+    __tablename__ = 'media_files'
+
+    file_id = Column(String, primary_key=True)
+    file_unique_id = Column(String, nullable=True)
+    file_size = Column(Integer, nullable=True)
+    mime_type = Column(String, nullable=True)
+    thumbnail_file_id = Column(String, nullable=True)
+    is_broken = Column(Boolean, nullable=False, default=False, server_default=false())
+    error = Column(String, nullable=True)               # Description of the last failed getFile
+    checked_at = Column(DateTime, nullable=True, index=True)
+
+# Схема БД создаётся и обновляется миграциями Alembic из migrations/
+
+def migrate(revision: str='head'):
+    """Upgrades the database schema, the same as `alembic upgrade head`"""
+    from alembic import command
+    from alembic.config import Config
+
+    config = Config(join(dirname(__file__), 'alembic.ini'))
+    config.set_main_option('script_location', join(dirname(__file__), 'migrations'))
+    # Keep logging of the bot as it is
+    config.attributes['configure_logger'] = False
+    command.upgrade(config, revision)
+
+# Лёгкие проекции Shortcut без тяжёлых колонок text, content и entities
+
+TEXT_PREVIEW_LENGTH = int(getenv('TEXT_PREVIEW_LENGTH', 256))  # Characters of a text kept in the cache for inline search
+
+@dataclass(slots=True)
+class ShortcutInfo:
+    """Shortcut without its content, enough for search, lists and keyboards"""
+    id: int
+    telegram_user_id: int
+    shortcut_name: str
+    content_type: str
+    text_preview: str
+    num_of_uses: int
+    last_use_dt: dt
+    update_dt: dt
+    is_broken: bool = False
+
+    @classmethod
+    def from_shortcut(cls, shortcut):
+        return cls(
+            shortcut.id,
+            shortcut.telegram_user_id,
+            shortcut.shortcut_name,
+            shortcut.content_type,
+            (shortcut.text or '')[:TEXT_PREVIEW_LENGTH],
+            shortcut.num_of_uses or 0,
+            shortcut.last_use_dt,
+            shortcut.update_dt,
+            bool(shortcut.is_broken)
+        )
+
+def _shortcut_infos_query():
+    return select(
+        Shortcut.id,
+        Shortcut.telegram_user_id,
+        Shortcut.shortcut_name,
+        Shortcut.content_type,
+        func.substr(func.coalesce(Shortcut.text, ''), 1, TEXT_PREVIEW_LENGTH),
+        func.coalesce(Shortcut.num_of_uses, 0),
+        Shortcut.last_use_dt,
+        Shortcut.update_dt,
+        Shortcut.is_broken
+    )
+
+def _shortcuts_by_ids_query(telegram_user_id: int, shortcut_ids: list):
+    return select(Shortcut).where(
+        Shortcut.telegram_user_id == telegram_user_id,
+        Shortcut.id.in_([int(x) for x in shortcut_ids])
+    )
+
+def _in_order(shortcuts, shortcut_ids: list) -> list:
+    """Orders Shortcuts as their ids were requested"""
+    by_id = {shortcut.id: shortcut for shortcut in shortcuts}
+    return [by_id[int(x)] for x in shortcut_ids if int(x) in by_id]
+
+# Функции для поддержки кэша в актуальном состоянии
+
+def _cache_shortcut_saved(shortcut):
+    """Adds a new or updated Shortcut to the cached index of its owner"""
+    index = shortcut_cache.peek(shortcut.telegram_user_id)
+    if index is not None:
+        index.update(ShortcutInfo.from_shortcut(shortcut))
+
+def _cache_shortcut_deleted(telegram_user_id: int, shortcut_id: int):
+    index = shortcut_cache.peek(telegram_user_id)
+    if index is not None:
+        index.remove(int(shortcut_id))
+
+def cache_shortcut_used(telegram_user_id: int, shortcut_id: int, delta: int, last_use_dt: dt):
+    """Keeps cached copy in sync instead of reloading all user's shortcuts"""
+    index = shortcut_cache.peek(telegram_user_id)
+    cached = index.get(int(shortcut_id)) if index is not None else None
+    if cached is not None:
+        cached.num_of_uses = (cached.num_of_uses or 0) + delta
+        cached.last_use_dt = last_use_dt
+
+def cache_shortcut_broken(telegram_user_id: int, shortcut_id: int, is_broken: bool):
+    index = shortcut_cache.peek(telegram_user_id)
+    cached = index.get(int(shortcut_id)) if index is not None else None
+    if cached is not None:
+        cached.is_broken = is_broken
+
+def _usage_update_query():
+    """Atomic increment of usage counters, executed once per Shortcut with executemany"""
+    shortcuts = Shortcut.__table__
+    return update(shortcuts).where(
+        shortcuts.c.id == bindparam('b_id'),
+        shortcuts.c.telegram_user_id == bindparam('b_telegram_user_id')
+    ).values(
+        num_of_uses=func.coalesce(shortcuts.c.num_of_uses, 0) + bindparam('b_delta'),
+        last_use_dt=bindparam('b_last_use_dt')
+    )
+
+def _usage_update_params(deltas: dict) -> list:
+    return [
+        {'b_id': int(shortcut_id), 'b_telegram_user_id': telegram_user_id, 'b_delta': delta, 'b_last_use_dt': last_use_dt}
+        for (telegram_user_id, shortcut_id), (delta, last_use_dt) in deltas.items()
+    ]
+
+def _users_list_query():
+    return select(
+        User.telegram_user_id,
+        User.created_at,
+        User.username,
+        User.start_param,
+        func.coalesce(UserStats.num_shortcuts, 0).label('num_shortcuts')
+    ).outerjoin(
+        UserStats
+    ).order_by(
+        User.created_at,
+        User.telegram_user_id
+    ).execution_options(
+        # Server-side cursor, rows are fetched in batches
+        yield_per=500
+    )
+
+def _count_registration(session, telegram_user_id: int, start_param: str):
+    session.add(UserStats(telegram_user_id=telegram_user_id, num_shortcuts=0))
+    session.execute(_increment_counter(session.get_bind().dialect.name, StartParamStats, 'num_users', 1).values(
+        start_param=start_param or '', num_users=1
+    ))
+
+def _count_shortcuts(session, telegram_user_id: int, delta: int):
+    """Changes the number of user's shortcuts in the same transaction as the change itself"""
+    # Users registered before the stats were introduced are counted once on their first change
+    num_shortcuts = select(func.count()).select_from(Shortcut).filter_by(telegram_user_id=telegram_user_id).scalar_subquery()
+    session.execute(_increment_counter(session.get_bind().dialect.name, UserStats, 'num_shortcuts', delta).values(
+        telegram_user_id=telegram_user_id, num_shortcuts=num_shortcuts
+    ))
+
+def _increment_counter(dialect_name: str, model, column: str, delta: int):
+    """INSERT of a counter row which adds `delta` to the counter instead if the row exists, atomically"""
+    table = model.__table__
+    if dialect_name == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert as dialect_insert
+    elif dialect_name == 'sqlite':
+        from sqlalchemy.dialects.sqlite import insert as dialect_insert
+    else:
+        from sqlalchemy.dialects.mysql import insert as dialect_insert
+        return dialect_insert(table).on_duplicate_key_update({column: table.c[column] + delta})
+    return dialect_insert(table).on_conflict_do_update(
+        index_elements=[key.name for key in table.primary_key],
+        set_={column: table.c[column] + delta}
+    )
+
+def _insert_shortcuts_ignoring_duplicates(dialect_name: str):
+    """INSERT which skips shortcuts with names the user already has, returns ids of inserted ones where supported"""
+    table = Shortcut.__table__
+    if dialect_name == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert as dialect_insert
+    elif dialect_name == 'sqlite':
+        from sqlalchemy.dialects.sqlite import insert as dialect_insert
+    else:
+        # MySQL, which counts only inserted rows
+        return insert(table).prefix_with('IGNORE')
+    return dialect_insert(table).on_conflict_do_nothing(index_elements=['telegram_user_id', 'shortcut_name']).returning(table.c.id)
+
+def _media_files_to_validate_query(checked_before: dt, limit: int):
+    """File ids of shortcuts never validated first, then the ones validated longest ago"""
+    return select(
+        Shortcut.content
+    ).outerjoin(
+        MediaFile, MediaFile.file_id == Shortcut.content
+    ).where(
+        Shortcut.content_type.not_in(NON_FILE_CONTENT_TYPES),
+        Shortcut.content.is_not(None),
+        or_(MediaFile.checked_at.is_(None), MediaFile.checked_at < checked_before)
+    ).group_by(
+        Shortcut.content,
+        MediaFile.checked_at
+    ).order_by(
+        MediaFile.checked_at.is_not(None),
+        MediaFile.checked_at
+    ).limit(limit)
+
+def _save_media_file(session, file_id: str, media: dict):
+    """Metadata of a file sent with /add, its validity is checked later"""
+    if file_id and media:
+        session.merge(MediaFile(file_id=file_id, **media))
+
+def _top_shortcuts_query(limit: int):
+    return select(
+        Shortcut.shortcut_name,
+        Shortcut.num_of_uses,
+        Shortcut.telegram_user_id,
+        User.username
+    ).join(
+        User
+    ).order_by(
+        Shortcut.num_of_uses.desc()
+    ).limit(limit)
+
+def _daily_active_users_query(days: int):
+    return select(
+        UserActivity.day,
+        func.count().label('num_users')
+    ).where(
+        UserActivity.day > dt.now().date() - timedelta(days=days)
+    ).group_by(
+        UserActivity.day
+    ).order_by(
+        UserActivity.day
+    )
+
+# Users already recorded as active today, to write each of them once a day
+_active_users = {'day': None, 'ids': set()}
+
+def _is_new_activity(telegram_user_id: int) -> bool:
+    today = dt.now().date()
+    if _active_users['day'] != today:
+        _active_users['day'], _active_users['ids'] = today, set()
+    if telegram_user_id in _active_users['ids']:
+        return False
+    _active_users['ids'].add(telegram_user_id)
+    return True
 
 # Функции для взаимодействия с базой данных
 
@@ -71,6 +406,8 @@ def create_user(telegram_user_id: int, username: str, start_param: str=None):
     with Session() as session:
         user = User(username=username, telegram_user_id=telegram_user_id, created_at=dt.now(), start_param=start_param)
         session.add(user)
+        session.flush()
+        _count_registration(session, telegram_user_id, start_param)
         session.commit()
 
 def get_user(telegram_user_id: int):
@@ -81,8 +418,8 @@ def get_user(telegram_user_id: int):
             session.expunge(user)
         return user
 
-def add_shortcut(shortcut_name: str, telegram_user_id: int, content_type: str, text: str, content: str, entities: list=None):
-    with Session() as session:
+def add_shortcut(shortcut_name: str, telegram_user_id: int, content_type: str, text: str, content: str, entities: list=None, media: dict=None):
+    with Session(expire_on_commit=False) as session:
         shortcut = Shortcut(
             shortcut_name=shortcut_name, 
             telegram_user_id=telegram_user_id,
@@ -94,82 +431,440 @@ def add_shortcut(shortcut_name: str, telegram_user_id: int, content_type: str, t
             entities=entities or []
         )
         session.add(shortcut)
+        _count_shortcuts(session, telegram_user_id, 1)
+        _save_media_file(session, content, media)
         session.commit()
+        session.expunge(shortcut)
+    _cache_shortcut_saved(shortcut)
 
-def get_shortcuts(telegram_user_id):
+def import_shortcuts(telegram_user_id: int, shortcuts: list) -> int:
+    """Inserts a batch of shortcuts with executemany, skipping names the user already has. Returns the number of inserted"""
+    if not shortcuts:
+        return 0
+    now = dt.now()
+    rows = [
+        {**shortcut, 'telegram_user_id': telegram_user_id, 'add_dt': now, 'update_dt': now, 'num_of_uses': 0}
+        for shortcut in shortcuts
+    ]
     with Session() as session:
-        # Query shortcuts directly instead of via user relationship
-        shortcuts = session.query(Shortcut).filter_by(
-            telegram_user_id=telegram_user_id
-        ).all()
-        # Detach all shortcuts from session before returning
-        for shortcut in shortcuts:
-            session.expunge(shortcut)
-        return shortcuts
+        result = session.execute(_insert_shortcuts_ignoring_duplicates(session.bind.dialect.name), rows)
+        inserted = len(result.all()) if result.returns_rows else result.rowcount
+        if inserted:
+            _count_shortcuts(session, telegram_user_id, inserted)
+        session.commit()
+    # Reloaded with the imported shortcuts on next use
+    shortcut_cache.pop(telegram_user_id)
+    return inserted
+
+def get_shortcuts_index(telegram_user_id) -> ShortcutIndex:
+    """Returns the search index over all user's ShortcutInfos, loading it from DB on a cache miss"""
+    index = shortcut_cache.get(telegram_user_id)
+    if index is not None:
+        return index
+    with Session() as session:
+        rows = session.execute(_shortcut_infos_query().where(Shortcut.telegram_user_id == telegram_user_id).order_by(Shortcut.id)).all()
+    # Recent uses are counted by `python manage.py rollup`, the cached index picks them up when reloaded
+    index = ShortcutIndex((ShortcutInfo(*row) for row in rows), recent_uses=get_shortcut_uses(telegram_user_id))
+    shortcut_cache.put(telegram_user_id, index)
+    return index
+
+def get_shortcuts(telegram_user_id) -> list:
+    """Returns ShortcutInfos of all user's Shortcuts, use get_shortcuts_by_ids for their content"""
+    return get_shortcuts_index(telegram_user_id).shortcuts()
+
+def get_shortcut_names(telegram_user_id) -> list:
+    return [shortcut.shortcut_name for shortcut in get_shortcuts(telegram_user_id)]
+
+def search_shortcuts(telegram_user_id, query: str, limit: int=50) -> list:
+    """Returns ShortcutInfos of top Shortcuts matching a query ranked by match quality, usage and recency"""
+    return get_shortcuts_index(telegram_user_id).search(query, limit=limit)
+
+def search_shortcuts_page(telegram_user_id, query: str, limit: int=50, after: tuple=None) -> tuple:
+    """Returns ShortcutInfos of the next page of search results after the position `after` and the position of the last one, see ShortcutIndex.search_page"""
+    return get_shortcuts_index(telegram_user_id).search_page(query, limit=limit, after=after)
+
+def get_shortcuts_by_ids(telegram_user_id, shortcut_ids: list) -> list:
+    """Loads complete Shortcuts with one query, in the order of given ids"""
+    if not shortcut_ids:
+        return []
+    with Session() as session:
+        shortcuts = session.scalars(_shortcuts_by_ids_query(telegram_user_id, shortcut_ids)).all()
+        session.expunge_all()
+    return _in_order(shortcuts, shortcut_ids)
 
 def get_shortcut(telegram_user_id, shortcut_name):
+    """Returns ShortcutInfo of a Shortcut with the name or None"""
+    index = shortcut_cache.peek(telegram_user_id)
+    if index is not None:
+        return index.find_by_name(shortcut_name)
     with Session() as session:
-        shortcut = session.query(Shortcut).filter_by(
-            telegram_user_id=telegram_user_id,
-            shortcut_name=shortcut_name
-        ).first()
-        if shortcut:
-            session.expunge(shortcut)
-        return shortcut
+        row = session.execute(_shortcut_infos_query().where(
+            Shortcut.telegram_user_id == telegram_user_id,
+            Shortcut.shortcut_name == shortcut_name
+        ).limit(1)).first()
+        return ShortcutInfo(*row) if row else None
 
 def update_shortcut(shortcut_id: int, new_shortcut_name: str, telegram_user_id: int, new_content_type: str, new_text: str, new_content: str):
-    with Session() as session:
+    with Session(expire_on_commit=False) as session:
         shortcut = session.query(Shortcut).filter_by(id=shortcut_id).first()
         if shortcut:
             shortcut.shortcut_name = new_shortcut_name
             shortcut.content_type = new_content_type
             shortcut.text = new_text
             shortcut.content = new_content
+            shortcut.is_broken = False
+            shortcut.update_dt = dt.now()
             session.commit()
+            session.expunge(shortcut)
+            _cache_shortcut_saved(shortcut)
 
 def delete_shortcut(shortcut_id):
     with Session() as session:
-        shortcut = session.query(Shortcut).filter_by(id=shortcut_id).first()
-        if shortcut:
-            session.delete(shortcut)
+        telegram_user_id = session.scalar(select(Shortcut.telegram_user_id).filter_by(id=shortcut_id))
+        if telegram_user_id is not None:
+            session.execute(delete(Shortcut).filter_by(id=shortcut_id))
+            _count_shortcuts(session, telegram_user_id, -1)
             session.commit()
+            _cache_shortcut_deleted(telegram_user_id, shortcut_id)
 
-def get_users_list() -> dict:
-    with Session() as session:
-        users = (
-            session.query(
-                User.telegram_user_id,
-                User.created_at,
-                User.username,
-                User.start_param,
-                func.count(
-                    Shortcut.id.distinct()
-                ).label(
-                    'num_shortcuts'
-                )
-            ).outerjoin(
-                Shortcut
-            ).group_by(
-                User.telegram_user_id, 
-                User.created_at, 
-                User.username,
-                User.start_param
-            ).order_by(
-                User.created_at
-            )
+def iter_users_list():
+    """Streams users ordered by registration with their numbers of shortcuts"""
+    with Session() as session:
+        yield from session.execute(_users_list_query())
+
+def iter_shortcuts_export(telegram_user_id):
+    """Streams name, content type, text, content and entities of user's shortcuts in the order they were added"""
+    with Session() as session:
+        yield from session.execute(
+            select(Shortcut.shortcut_name, Shortcut.content_type, Shortcut.text, Shortcut.content, Shortcut.entities)
+            .where(Shortcut.telegram_user_id == telegram_user_id)
+            .order_by(Shortcut.id)
+            .execution_options(yield_per=500)
         )
-        return {user.username or str(user.telegram_user_id): (user.created_at, user.num_shortcuts, user.start_param) for user in users}
 
-def increase_chosen_result_counter(shortcut_id: int):
+def get_media_files_to_validate(checked_before: dt, limit: int=100) -> list:
+    """Returns file ids of shortcuts which were not validated since `checked_before`"""
     with Session() as session:
-        shortcut = session.query(Shortcut).filter_by(id=shortcut_id).first()
-        if shortcut:
-            shortcut.num_of_uses += 1
-            shortcut.last_use_dt = dt.now()
+        return session.scalars(_media_files_to_validate_query(checked_before, limit)).all()
+
+def save_media_checks(checks: dict) -> int:
+    """Stores results of getFile, {file_id: {is_broken, error, file_unique_id, file_size, mime_type}}, and marks shortcuts with broken files
+
+    Metadata which a check did not return is kept. Returns the number of shortcuts marked or unmarked as broken.
+    """
+    if not checks:
+        return 0
+    now = dt.now()
+    with Session() as session:
+        media_files = {media.file_id: media for media in session.scalars(select(MediaFile).where(MediaFile.file_id.in_(list(checks))))}
+        for file_id, check in checks.items():
+            media = media_files.get(file_id)
+            if media is None:
+                media = MediaFile(file_id=file_id)
+                session.add(media)
+            for key, value in check.items():
+                # Mime types sent with a file are more exact than the ones guessed from its path
+                if key == 'mime_type' and media.mime_type is not None:
+                    continue
+                if value is not None or key in ('is_broken', 'error'):
+                    setattr(media, key, value)
+            media.checked_at = now
+        shortcuts = session.execute(
+            select(Shortcut.telegram_user_id, Shortcut.id, Shortcut.content, Shortcut.is_broken).where(
+                Shortcut.content.in_(list(checks)),
+                Shortcut.content_type.not_in(NON_FILE_CONTENT_TYPES)
+            )
+        ).all()
+        changed = [
+            (telegram_user_id, shortcut_id, checks[content]['is_broken'])
+            for telegram_user_id, shortcut_id, content, is_broken in shortcuts
+            if bool(is_broken) != checks[content]['is_broken']
+        ]
+        for is_broken in (True, False):
+            shortcut_ids = [shortcut_id for _, shortcut_id, x in changed if x == is_broken]
+            if shortcut_ids:
+                session.execute(update(Shortcut).where(Shortcut.id.in_(shortcut_ids)).values(is_broken=is_broken))
+        session.commit()
+    for telegram_user_id, shortcut_id, is_broken in changed:
+        cache_shortcut_broken(telegram_user_id, shortcut_id, is_broken)
+    return len(changed)
+
+def get_media_stats() -> dict:
+    """Returns numbers of validated files, broken files and shortcuts with broken files"""
+    with Session() as session:
+        return {
+            'validated': session.scalar(select(func.count()).select_from(MediaFile).where(MediaFile.checked_at.is_not(None))),
+            'broken': session.scalar(select(func.count()).select_from(MediaFile).where(MediaFile.is_broken)),
+            'broken_shortcuts': session.scalar(select(func.count()).select_from(Shortcut).where(Shortcut.is_broken)),
+        }
+
+def get_users_count() -> int:
+    with Session() as session:
+        return session.scalar(select(func.coalesce(func.sum(StartParamStats.num_users), 0)))
+
+def get_registrations() -> list:
+    """Returns (start param, number of users) pairs, most popular first"""
+    with Session() as session:
+        return session.execute(select(StartParamStats.start_param, StartParamStats.num_users).order_by(StartParamStats.num_users.desc())).all()
+
+def get_top_shortcuts(limit: int=10) -> list:
+    with Session() as session:
+        return session.execute(_top_shortcuts_query(limit)).all()
+
+def record_activity(telegram_user_id: int):
+    """Marks a user as active today, writes to DB only once per user a day"""
+    if _is_new_activity(telegram_user_id):
+        with Session() as session:
+            try:
+                session.add(UserActivity(day=dt.now().date(), telegram_user_id=telegram_user_id))
+                session.commit()
+            except IntegrityError:
+                # Already recorded by another process
+                session.rollback()
+
+def get_daily_active_users(days: int=7) -> list:
+    """Returns (day, number of active users) pairs for the last days"""
+    with Session() as session:
+        return session.execute(_daily_active_users_query(days)).all()
+
+def rebuild_stats():
+    """Recounts all statistics counters from scratch, e.g. after they were introduced"""
+    with Session() as session:
+        session.execute(delete(UserStats))
+        session.execute(delete(StartParamStats))
+        session.execute(insert(UserStats).from_select(
+            ['telegram_user_id', 'num_shortcuts'],
+            select(User.telegram_user_id, func.count(Shortcut.id)).outerjoin(Shortcut).group_by(User.telegram_user_id)
+        ))
+        session.execute(insert(StartParamStats).from_select(
+            ['start_param', 'num_users'],
+            select(func.coalesce(User.start_param, ''), func.count()).group_by(func.coalesce(User.start_param, ''))
+        ))
+        session.commit()
+
+def increase_chosen_result_counter(shortcut_id: int, telegram_user_id: int):
+    last_use_dt = dt.now()
+    apply_usage_deltas({(telegram_user_id, shortcut_id): (1, last_use_dt)})
+    cache_shortcut_used(telegram_user_id, shortcut_id, 1, last_use_dt)
+
+def apply_usage_deltas(deltas: dict):
+    """Adds usage counters in one transaction: {(telegram_user_id, shortcut_id): (delta, last_use_dt)}"""
+    if deltas:
+        with Session() as session:
+            session.execute(_usage_update_query(), _usage_update_params(deltas))
             session.commit()
-    
 
-def is_admin(telegram_user_id: int) -> bool:
+def get_cache_stats() -> dict:
+    """Returns hit/miss/eviction counters of the shortcut cache"""
+    return shortcut_cache.stats()
+
+def set_conversation_state(chat_id: int, step: str, context: dict, expires_at: dt):
     with Session() as session:
-        admin = session.query(Admin).filter_by(telegram_user_id=telegram_user_id).first()
-        return admin is not None
+        session.merge(ConversationState(chat_id=chat_id, step=step, context=context, expires_at=expires_at))
+        session.commit()
+
+def pop_conversation_state(chat_id: int):
+    """Removes a pending step of a chat, returns (step, context) or None if there is no step or it has expired"""
+    with Session() as session:
+        state = session.get(ConversationState, chat_id)
+        if state is None:
+            return None
+        step, context, expires_at = state.step, state.context, state.expires_at
+        session.execute(delete(ConversationState).filter_by(chat_id=chat_id))
+        session.commit()
+        return (step, context) if expires_at > dt.now() else None
+
+def delete_expired_conversation_states() -> int:
+    with Session() as session:
+        deleted = session.execute(delete(ConversationState).where(ConversationState.expires_at <= dt.now())).rowcount
+        session.commit()
+        return deleted
+
+def is_admin(telegram_user_id: int) -> bool:
+    admin_ids = admin_cache.get('ids')
+    if admin_ids is None:
+        with Session() as session:
+            admin_ids = frozenset(session.scalars(select(Admin.telegram_user_id)))
+        admin_cache.put('ids', admin_ids)
+    return telegram_user_id in admin_ids
+
+# Асинхронные версии функций для asyncio-режима бота
+
+def get_async_engine():
+    """Creates the async engine on first use. The driver is taken from ASYNC_DATABASE_URL or derived from DATABASE_URL"""
+    global async_engine, AsyncSession
+    if async_engine is None:
+        from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+
+        url = getenv('ASYNC_DATABASE_URL')
+        if not url:
+            url = make_url(_database_url())
+            url = url.set(drivername=ASYNC_DRIVERS.get(url.get_backend_name(), url.drivername))
+        async_engine = create_async_engine(
+            url,
+            pool_size=DB_POOL_SIZE,
+            max_overflow=DB_MAX_OVERFLOW,
+            pool_pre_ping=True,
+            pool_recycle=3600,
+            echo=False
+        )
+        metrics.instrument_engine(async_engine.sync_engine, pool_metrics=False)
+        AsyncSession = async_sessionmaker(bind=async_engine, expire_on_commit=False)
+    return async_engine
+
+def _async_session():
+    get_async_engine()
+    return AsyncSession()
+
+async def async_create_user(telegram_user_id: int, username: str, start_param: str=None):
+    async with _async_session() as session:
+        session.add(User(username=username, telegram_user_id=telegram_user_id, created_at=dt.now(), start_param=start_param))
+        await session.flush()
+        await session.run_sync(_count_registration, telegram_user_id, start_param)
+        await session.commit()
+
+async def async_get_user(telegram_user_id: int):
+    async with _async_session() as session:
+        return await session.get(User, telegram_user_id)
+
+async def async_add_shortcut(shortcut_name: str, telegram_user_id: int, content_type: str, text: str, content: str, entities: list=None, media: dict=None):
+    async with _async_session() as session:
+        shortcut = Shortcut(
+            shortcut_name=shortcut_name,
+            telegram_user_id=telegram_user_id,
+            content_type=content_type,
+            text=text,
+            content=content,
+            add_dt=dt.now(),
+            update_dt=dt.now(),
+            entities=entities or []
+        )
+        session.add(shortcut)
+        await session.run_sync(_count_shortcuts, telegram_user_id, 1)
+        await session.run_sync(_save_media_file, content, media)
+        await session.commit()
+        session.expunge(shortcut)
+    _cache_shortcut_saved(shortcut)
+
+async def async_get_shortcuts_index(telegram_user_id) -> ShortcutIndex:
+    index = shortcut_cache.get(telegram_user_id)
+    if index is not None:
+        return index
+    async with _async_session() as session:
+        rows = (await session.execute(_shortcut_infos_query().where(Shortcut.telegram_user_id == telegram_user_id).order_by(Shortcut.id))).all()
+    recent_uses = await asyncio.to_thread(get_shortcut_uses, telegram_user_id)
+    index = ShortcutIndex((ShortcutInfo(*row) for row in rows), recent_uses=recent_uses)
+    shortcut_cache.put(telegram_user_id, index)
+    return index
+
+async def async_get_shortcuts(telegram_user_id) -> list:
+    return (await async_get_shortcuts_index(telegram_user_id)).shortcuts()
+
+async def async_get_shortcut_names(telegram_user_id) -> list:
+    return [shortcut.shortcut_name for shortcut in await async_get_shortcuts(telegram_user_id)]
+
+async def async_search_shortcuts(telegram_user_id, query: str, limit: int=50) -> list:
+    return (await async_get_shortcuts_index(telegram_user_id)).search(query, limit=limit)
+
+async def async_search_shortcuts_page(telegram_user_id, query: str, limit: int=50, after: tuple=None) -> tuple:
+    return (await async_get_shortcuts_index(telegram_user_id)).search_page(query, limit=limit, after=after)
+
+async def async_get_shortcuts_by_ids(telegram_user_id, shortcut_ids: list) -> list:
+    if not shortcut_ids:
+        return []
+    async with _async_session() as session:
+        shortcuts = (await session.scalars(_shortcuts_by_ids_query(telegram_user_id, shortcut_ids))).all()
+        session.expunge_all()
+    return _in_order(shortcuts, shortcut_ids)
+
+async def async_get_shortcut(telegram_user_id, shortcut_name):
+    index = shortcut_cache.peek(telegram_user_id)
+    if index is not None:
+        return index.find_by_name(shortcut_name)
+    async with _async_session() as session:
+        row = (await session.execute(
+            _shortcut_infos_query().where(Shortcut.telegram_user_id == telegram_user_id, Shortcut.shortcut_name == shortcut_name).limit(1)
+        )).first()
+        return ShortcutInfo(*row) if row else None
+
+async def async_delete_shortcut(shortcut_id):
+    async with _async_session() as session:
+        telegram_user_id = await session.scalar(select(Shortcut.telegram_user_id).filter_by(id=int(shortcut_id)))
+        if telegram_user_id is not None:
+            await session.execute(delete(Shortcut).filter_by(id=int(shortcut_id)))
+            await session.run_sync(_count_shortcuts, telegram_user_id, -1)
+            await session.commit()
+            _cache_shortcut_deleted(telegram_user_id, shortcut_id)
+
+async def async_iter_users_list():
+    async with _async_session() as session:
+        async for user in await session.stream(_users_list_query()):
+            yield user
+
+async def async_get_users_count() -> int:
+    async with _async_session() as session:
+        return await session.scalar(select(func.coalesce(func.sum(StartParamStats.num_users), 0)))
+
+async def async_get_registrations() -> list:
+    async with _async_session() as session:
+        return (await session.execute(select(StartParamStats.start_param, StartParamStats.num_users).order_by(StartParamStats.num_users.desc()))).all()
+
+async def async_get_top_shortcuts(limit: int=10) -> list:
+    async with _async_session() as session:
+        return (await session.execute(_top_shortcuts_query(limit))).all()
+
+async def async_record_activity(telegram_user_id: int):
+    if _is_new_activity(telegram_user_id):
+        async with _async_session() as session:
+            try:
+                session.add(UserActivity(day=dt.now().date(), telegram_user_id=telegram_user_id))
+                await session.commit()
+            except IntegrityError:
+                await session.rollback()
+
+async def async_get_daily_active_users(days: int=7) -> list:
+    async with _async_session() as session:
+        return (await session.execute(_daily_active_users_query(days))).all()
+
+async def async_increase_chosen_result_counter(shortcut_id: int, telegram_user_id: int):
+    last_use_dt = dt.now()
+    await async_apply_usage_deltas({(telegram_user_id, shortcut_id): (1, last_use_dt)})
+    cache_shortcut_used(telegram_user_id, shortcut_id, 1, last_use_dt)
+
+async def async_apply_usage_deltas(deltas: dict):
+    if deltas:
+        async with _async_session() as session:
+            await session.execute(_usage_update_query(), _usage_update_params(deltas))
+            await session.commit()
+
+async def async_set_conversation_state(chat_id: int, step: str, context: dict, expires_at: dt):
+    async with _async_session() as session:
+        await session.merge(ConversationState(chat_id=chat_id, step=step, context=context, expires_at=expires_at))
+        await session.commit()
+
+async def async_pop_conversation_state(chat_id: int):
+    async with _async_session() as session:
+        state = await session.get(ConversationState, chat_id)
+        if state is None:
+            return None
+        step, context, expires_at = state.step, state.context, state.expires_at
+        await session.execute(delete(ConversationState).filter_by(chat_id=chat_id))
+        await session.commit()
+        return (step, context) if expires_at > dt.now() else None
+
+async def async_delete_expired_conversation_states() -> int:
+    async with _async_session() as session:
+        deleted = (await session.execute(delete(ConversationState).where(ConversationState.expires_at <= dt.now()))).rowcount
+        await session.commit()
+        return deleted
+
+async def async_is_admin(telegram_user_id: int) -> bool:
+    admin_ids = admin_cache.get('ids')
+    if admin_ids is None:
+        async with _async_session() as session:
+            admin_ids = frozenset(await session.scalars(select(Admin.telegram_user_id)))
+        admin_cache.put('ids', admin_ids)
+    return telegram_user_id in admin_ids
+
+# Latency of every public function above except engine setup is recorded in metrics
+metrics.instrument_module(sys.modules[__name__], skip={'init', 'get_engine', 'get_async_engine', 'migrate'})
@@ -0,0 +1,172 @@
+from bisect import bisect_left, insort
+from datetime import datetime as dt
+from heapq import nlargest
+from operator import itemgetter
+from threading import RLock
+
+# Match tiers, lower is better
+NAME_PREFIX, NAME_SUBSTRING, TEXT_SUBSTRING, FUZZY = range(4)
+
+NGRAM_SIZE = 3
+FUZZY_THRESHOLD = 0.4   # Minimal share of query n-grams found in a name for a fuzzy match
+
+
+def ngrams(value: str) -> set:
+    """Returns a set of n-grams of a lowercased string padded with spaces"""
+    value = f' {value} '
+    return {value[i: i + NGRAM_SIZE] for i in range(len(value) - NGRAM_SIZE + 1)}
+
+
+def rank_key(shortcut) -> tuple:
+    """Usage and recency of a Shortcut, higher is better"""
+    return (shortcut.num_of_uses or 0, shortcut.last_use_dt or dt.min)
+
+
+def page_key(shortcut, tier: int = NAME_PREFIX, recent_uses: int = 0) -> tuple:
+    """Position of a Shortcut in search results, higher is better, unique as older Shortcuts win ties
+
+    Within a tier Shortcuts chosen more often recently, as counted by the usage log rollups, go first.
+    """
+    return (-tier, recent_uses, *rank_key(shortcut), -shortcut.id)
+
+
+class ShortcutIndex:
+    """Per-user search index over ShortcutInfo names and text previews
+
+    Keeps a sorted list of names for prefix lookups and n-gram postings for
+    substring and fuzzy matching. Maintained incrementally on add/update/remove.
+    `recent_uses` maps ids to times the Shortcuts were chosen recently, a ranking feature.
+    """
+
+    def __init__(self, shortcuts=(), recent_uses: dict = None):
+        self._recent_uses = recent_uses or {}
+        self._shortcuts = {}
+        self._names = []        # Sorted (lowercased name, id) pairs
+        self._name_grams = {}   # n-gram -> ids of Shortcuts with it in the name
+        self._text_grams = {}   # n-gram -> ids of Shortcuts with it in the text
+        self._keys = {}         # id -> (lowercased name, lowercased text)
+        self._lock = RLock()
+        for shortcut in shortcuts:
+            self.add(shortcut)
+
+    def __len__(self):
+        return len(self._shortcuts)
+
+    def __iter__(self):
+        return iter(self.shortcuts())
+
+    def shortcuts(self) -> list:
+        """Returns all indexed Shortcuts in insertion order"""
+        with self._lock:
+            return list(self._shortcuts.values())
+
+    def get(self, shortcut_id: int):
+        return self._shortcuts.get(shortcut_id)
+
+    def find_by_name(self, shortcut_name: str):
+        """Returns a Shortcut with exactly the given name or None"""
+        with self._lock:
+            name = shortcut_name.lower()
+            i = bisect_left(self._names, (name, -1))
+            while i < len(self._names) and self._names[i][0] == name:
+                shortcut = self._shortcuts[self._names[i][1]]
+                if shortcut.shortcut_name == shortcut_name:
+                    return shortcut
+                i += 1
+            return None
+
+    def add(self, shortcut):
+        """Adds a Shortcut or replaces an indexed one with the same id"""
+        with self._lock:
+            if shortcut.id in self._shortcuts:
+                self.remove(shortcut.id)
+            name, text = shortcut.shortcut_name.lower(), (shortcut.text_preview or '').lower()
+            self._shortcuts[shortcut.id] = shortcut
+            self._keys[shortcut.id] = (name, text)
+            insort(self._names, (name, shortcut.id))
+            for gram in ngrams(name):
+                self._name_grams.setdefault(gram, set()).add(shortcut.id)
+            for gram in ngrams(text):
+                self._text_grams.setdefault(gram, set()).add(shortcut.id)
+
+    update = add
+
+    def remove(self, shortcut_id: int):
+        """Removes a Shortcut from the index"""
+        with self._lock:
+            if self._shortcuts.pop(shortcut_id, None) is None:
+                return
+            name, text = self._keys.pop(shortcut_id)
+            del self._names[bisect_left(self._names, (name, shortcut_id))]
+            for postings, value in ((self._name_grams, name), (self._text_grams, text)):
+                for gram in ngrams(value):
+                    ids = postings.get(gram)
+                    if ids is not None:
+                        ids.discard(shortcut_id)
+                        if not ids:
+                            del postings[gram]
+
+    def _candidates(self, postings: dict, query: str) -> set:
+        """Returns ids which contain every n-gram of a query (a superset of substring matches)"""
+        grams = {query[i: i + NGRAM_SIZE] for i in range(len(query) - NGRAM_SIZE + 1)}
+        if not grams:
+            return set(self._shortcuts)
+        ids = None
+        for gram in sorted(grams, key=lambda x: len(postings.get(x, ()))):
+            ids = set(postings.get(gram, ())) if ids is None else ids & postings.get(gram, set())
+            if not ids:
+                break
+        return ids
+
+    def _tiers(self, query: str) -> dict:
+        """Returns id -> best match tier for all Shortcuts matching a query"""
+        tiers = {}
+        for shortcut_id in self._candidates(self._name_grams, query):
+            name = self._keys[shortcut_id][0]
+            if name.startswith(query):
+                tiers[shortcut_id] = NAME_PREFIX
+            elif query in name:
+                tiers[shortcut_id] = NAME_SUBSTRING
+        for shortcut_id in self._candidates(self._text_grams, query):
+            if shortcut_id not in tiers and query in self._keys[shortcut_id][1]:
+                tiers[shortcut_id] = TEXT_SUBSTRING
+        if not tiers and len(query) >= NGRAM_SIZE:
+            # The query is usually an unfinished word, so it is padded only from the left
+            query_grams = {gram for gram in ngrams(query) if not gram.endswith(' ')}
+            overlaps = {}
+            for gram in query_grams:
+                for shortcut_id in self._name_grams.get(gram, ()):
+                    overlaps[shortcut_id] = overlaps.get(shortcut_id, 0) + 1
+            for shortcut_id, overlap in overlaps.items():
+                if overlap / len(query_grams) >= FUZZY_THRESHOLD:
+                    tiers[shortcut_id] = FUZZY
+        return tiers
+
+    def search(self, query: str, limit: int = 50) -> list:
+        """Returns top `limit` Shortcuts matching a query, ranked by match quality, recent and total usage and recency
+
+        An empty query matches every Shortcut. Shortcuts marked as broken are skipped.
+        """
+        return self.search_page(query, limit)[0]
+
+    def search_page(self, query: str, limit: int = 50, after: tuple = None) -> tuple:
+        """Returns the next `limit` search results after the one with page_key `after`
+
+        Returns the Shortcuts and page_key of the last of them, or None if there are no more.
+        Pages are selected by position, so Shortcuts which change rank between pages
+        are neither repeated nor skipped unless they move over the page boundary.
+        """
+        with self._lock:
+            query = (query or '').strip().lower()
+            if query:
+                tiers = self._tiers(query)
+                keyed = ((page_key(self._shortcuts[x], tier, self._recent_uses.get(x, 0)), self._shortcuts[x]) for x, tier in tiers.items())
+            else:
+                keyed = ((page_key(x, recent_uses=self._recent_uses.get(x.id, 0)), x) for x in self._shortcuts.values())
+            keyed = (item for item in keyed if not item[1].is_broken and (after is None or item[0] < after))
+            # One more to know whether there is a next page
+            page = nlargest(limit + 1, keyed, key=itemgetter(0))
+        if len(page) <= limit:
+            return [shortcut for _, shortcut in page], None
+        page = page[:limit]
+        return [shortcut for _, shortcut in page], page[-1][0]
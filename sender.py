@@ -0,0 +1,401 @@
+"""Outbound send pipeline: rate limiting, retries on flood control and batching of shortcuts.
+
+Messages are described as a plan of (method name, kwargs, reply to previous) steps, which
+is executed by Sender (TeleBot) or AsyncSender (AsyncTeleBot) under the same rate limits.
+"""
+import asyncio
+import logging
+from json import loads
+from queue import Queue
+from threading import Lock, Thread
+from time import monotonic, sleep
+
+import telebot as tb
+
+from cache import LRUCache
+from flusher import BackgroundFlusher
+
+# Telegram limits a message to 4096 characters, an album to 10 media and forwarding to 100 messages at once
+MAX_MESSAGE_LENGTH = 4096
+MAX_MEDIA_GROUP_SIZE = 10
+MAX_FORWARD_MESSAGES = 100
+
+# Media which can be sent together in one album
+ALBUM_KINDS = {'photo': 'visual', 'video': 'visual', 'document': 'document', 'audio': 'audio'}
+INPUT_MEDIA = {
+    'photo': tb.types.InputMediaPhoto,
+    'video': tb.types.InputMediaVideo,
+    'document': tb.types.InputMediaDocument,
+    'audio': tb.types.InputMediaAudio,
+}
+
+
+class TokenBucket:
+    """Token bucket rate limiter, `rate` tokens per second with bursts up to `capacity`"""
+
+    def __init__(self, rate: float, capacity: float = None):
+        self.rate = rate
+        self.capacity = capacity or max(rate, 1)
+        self.tokens = self.capacity
+        self.updated_at = monotonic()
+        self._lock = Lock()
+
+    def reserve(self) -> float:
+        """Takes a token and returns how many seconds to wait before using it"""
+        with self._lock:
+            now = monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+            self.updated_at = now
+            self.tokens -= 1
+            return 0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def pause(self, seconds: float):
+        """Makes the bucket empty for some time, e.g. after a 429 response"""
+        with self._lock:
+            self.tokens = min(self.tokens, -seconds * self.rate)
+
+
+def utf16_len(text: str) -> int:
+    """Length of a text in UTF-16 code units, which Telegram uses for entity offsets"""
+    return len(text.encode('utf-16-le')) // 2
+
+
+def get_retry_after(e: Exception):
+    """Returns seconds to wait from a 429 Telegram error or None for other errors"""
+    if isinstance(e, tb.apihelper.ApiTelegramException) and e.error_code == 429:
+        return (e.result_json.get('parameters') or {}).get('retry_after', 1)
+    return None
+
+
+class Sender:
+    """Calls TeleBot methods within global and per-chat rate limits, retrying on flood control
+
+    call() and run() wait for the limits in the calling thread. Handlers submit() plans
+    instead, which `workers` background threads execute, so a long /list does not hold
+    up updates of other users processed by the same thread.
+    """
+
+    def __init__(self, bot, global_rate: float = 30, chat_rate: float = 1, chat_burst: float = 3, max_retries: int = 3, workers: int = 4):
+        self.bot = bot
+        self.max_retries = max_retries
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.workers = workers
+        self.global_bucket = TokenBucket(global_rate)
+        self.chat_buckets = LRUCache(maxsize=10000)
+        self._lock = Lock()
+        self._queues = None
+
+    def _chat_bucket(self, chat_id) -> TokenBucket:
+        with self._lock:
+            bucket = self.chat_buckets.peek(chat_id)
+            if bucket is None:
+                bucket = TokenBucket(self.chat_rate, self.chat_burst)
+                self.chat_buckets.put(chat_id, bucket)
+            return bucket
+
+    def _delay(self, chat_id) -> float:
+        return max(self.global_bucket.reserve(), self._chat_bucket(chat_id).reserve())
+
+    def _retry_delay(self, chat_id, e: Exception, attempt: int):
+        """Holds the chat's bucket for `retry_after` seconds, returns None if the error must be raised instead"""
+        retry_after = get_retry_after(e)
+        if retry_after is None or attempt >= self.max_retries:
+            return None
+        logging.warning(f'Flood control in chat {chat_id}, retrying in {retry_after} s')
+        self._chat_bucket(chat_id).pause(retry_after)
+        return retry_after
+
+    def call(self, method_name: str, chat_id, **kwargs):
+        """Calls a bot method like bot.send_message(chat_id=chat_id, **kwargs)"""
+        for attempt in range(self.max_retries + 1):
+            sleep(self._delay(chat_id))
+            try:
+                return getattr(self.bot, method_name)(chat_id=chat_id, **kwargs)
+            except Exception as e:
+                retry_after = self._retry_delay(chat_id, e, attempt)
+                if retry_after is None:
+                    raise
+
+    def run(self, chat_id, plan):
+        """Executes a plan of (method name, kwargs, reply to previous) steps"""
+        prev_message = None
+        for method_name, kwargs, reply in plan:
+            if reply and prev_message is not None:
+                kwargs = {**kwargs, 'reply_to_message_id': prev_message.message_id}
+            try:
+                prev_message = self.call(method_name, chat_id, **kwargs)
+            except Exception as e:
+                logging.error(f'{chat_id}: {method_name} failed: {e}')
+                prev_message = None
+
+    def submit(self, chat_id, plan):
+        """Queues a plan for a background thread and returns at once
+
+        Plans of one chat are executed by the same thread in the order they were submitted.
+        """
+        if self._queues is None:
+            self.start()
+        self._queues[hash(chat_id) % len(self._queues)].put((chat_id, plan))
+
+    def start(self):
+        """Start the background sending threads"""
+        with self._lock:
+            if self._queues is not None:
+                return
+            queues = [Queue() for _ in range(self.workers)]
+            for i, queue in enumerate(queues):
+                Thread(target=self._work, args=(queue,), name=f'sender-{i}', daemon=True).start()
+            self._queues = queues
+
+    def join(self):
+        """Waits until all submitted plans are executed"""
+        for queue in self._queues or ():
+            queue.join()
+
+    def _work(self, queue: Queue):
+        while True:
+            chat_id, plan = queue.get()
+            try:
+                self.run(chat_id, plan)
+            except Exception:
+                logging.exception(f'{chat_id}: failed to send a plan')
+            finally:
+                queue.task_done()
+
+    def pending(self) -> int:
+        return sum(queue.qsize() for queue in self._queues or ())
+
+
+class AsyncSender(Sender):
+    """Sender for AsyncTeleBot
+
+    Waiting for the limits does not block the event loop, so handlers await run() directly.
+    """
+
+    async def call(self, method_name: str, chat_id, **kwargs):
+        for attempt in range(self.max_retries + 1):
+            await asyncio.sleep(self._delay(chat_id))
+            try:
+                return await getattr(self.bot, method_name)(chat_id=chat_id, **kwargs)
+            except Exception as e:
+                retry_after = self._retry_delay(chat_id, e, attempt)
+                if retry_after is None:
+                    raise
+
+    async def run(self, chat_id, plan):
+        prev_message = None
+        for method_name, kwargs, reply in plan:
+            if reply and prev_message is not None:
+                kwargs = {**kwargs, 'reply_to_message_id': prev_message.message_id}
+            try:
+                prev_message = await self.call(method_name, chat_id, **kwargs)
+            except Exception as e:
+                logging.error(f'{chat_id}: {method_name} failed: {e}')
+                prev_message = None
+
+
+class ForwardBatcher(BackgroundFlusher):
+    """Forwards messages to one chat in batches from a background thread
+
+    Messages are collected per source chat and forwarded every `flush_interval` seconds
+    or as soon as `batch_size` are pending, by forward_messages through a Sender, so they
+    share its rate limits. Up to `max_pending` messages wait, the others are dropped.
+    Pending messages are also forwarded at exit.
+    """
+
+    thread_name = 'forward-batcher'
+
+    def __init__(self, sender: Sender, chat_id, flush_interval: float = 5, batch_size: int = MAX_FORWARD_MESSAGES, max_pending: int = 10000):
+        super().__init__(flush_interval)
+        self.sender = sender
+        self.chat_id = chat_id
+        self.batch_size = batch_size
+        self.max_pending = max_pending
+        self.dropped = 0
+        self._size = 0
+
+    def add(self, from_chat_id, message_id: int):
+        """Queue a message for forwarding, never calls Telegram itself"""
+        with self._lock:
+            if self._size >= self.max_pending:
+                self.dropped += 1
+                return
+            self._pending.setdefault(from_chat_id, []).append(message_id)
+            self._size += 1
+            size = self._size
+        self._added(size, self.batch_size)
+
+    def _take(self) -> list:
+        """Removes pending messages, returns them as (source chat id, message ids) batches"""
+        with self._lock:
+            pending, self._pending, self._size = self._pending, {}, 0
+        return [
+            (from_chat_id, message_ids[i: i + MAX_FORWARD_MESSAGES])
+            for from_chat_id, message_ids in pending.items()
+            for i in range(0, len(message_ids), MAX_FORWARD_MESSAGES)
+        ]
+
+    def flush(self):
+        """Forward all pending messages"""
+        for from_chat_id, message_ids in self._take():
+            try:
+                self.sender.call('forward_messages', self.chat_id, from_chat_id=from_chat_id, message_ids=sorted(set(message_ids)))
+            except Exception as e:
+                logging.error(f'Failed to forward {len(message_ids)} messages from {from_chat_id}: {e}')
+
+    def pending(self) -> int:
+        return self._size
+
+
+class AsyncForwardBatcher(ForwardBatcher):
+    """ForwardBatcher for AsyncSender, forwarding from a task of the running event loop"""
+
+    def __init__(self, sender: AsyncSender, chat_id, **kwargs):
+        super().__init__(sender, chat_id, **kwargs)
+        self._wakeup = asyncio.Event()
+
+    async def flush(self):
+        for from_chat_id, message_ids in self._take():
+            try:
+                await self.sender.call('forward_messages', self.chat_id, from_chat_id=from_chat_id, message_ids=sorted(set(message_ids)))
+            except Exception as e:
+                logging.error(f'Failed to forward {len(message_ids)} messages from {from_chat_id}: {e}')
+
+    def start(self):
+        if self._thread is None:
+            self._thread = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        if self._thread is not None:
+            self._thread.cancel()
+        await self.flush()
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+
+
+def _parse_entities(shortcut, shift: int = 0) -> list:
+    entities = tb.types.Message.parse_entities(shortcut.entities or []) or []
+    for entity in entities:
+        entity.offset += shift
+    return entities
+
+
+def _numbered_names(numbered_shortcuts) -> tuple:
+    """Returns a text with numbered Shortcut names formatted as code and its entities"""
+    text, entities = '', []
+    for i, shortcut in numbered_shortcuts:
+        prefix = f'{i}. '
+        entities.append(tb.types.MessageEntity('code', utf16_len(text + prefix), utf16_len(shortcut.shortcut_name)))
+        text += f'{prefix}{shortcut.shortcut_name}:\n'
+    return text.rstrip('\n'), entities
+
+
+def _text_batch_plan(batch) -> list:
+    """One message with several text Shortcuts, each under its numbered name"""
+    text, entities = '', []
+    for i, shortcut in batch:
+        header, header_entities = _numbered_names([(i, shortcut)])
+        for entity in header_entities:
+            entity.offset += utf16_len(text)
+        entities += header_entities
+        text += header + '\n'
+        entities += _parse_entities(shortcut, shift=utf16_len(text))
+        text += (shortcut.text or '') + '\n\n'
+    return [('send_message', {'text': text.rstrip('\n'), 'entities': entities, 'parse_mode': ''}, False)]
+
+
+def _single_plan(i: int, shortcut) -> list:
+    """A numbered name followed by a reply with the Shortcut itself"""
+    header, header_entities = _numbered_names([(i, shortcut)])
+    plan = [('send_message', {'text': header, 'entities': header_entities, 'parse_mode': ''}, False)]
+    if shortcut.content_type == 'text':
+        plan.append(('send_message', {'text': shortcut.text, 'entities': _parse_entities(shortcut), 'parse_mode': ''}, True))
+    elif shortcut.content_type == 'location':
+        plan.append(('send_location', loads(shortcut.content), True))
+    else:
+        plan.append((f'send_{shortcut.content_type}', {
+            shortcut.content_type: shortcut.content,
+            'caption': shortcut.text,
+            'caption_entities': _parse_entities(shortcut),
+            'parse_mode': ''
+        }, True))
+    return plan
+
+
+def _album_plan(batch) -> list:
+    """Numbered names followed by a reply with an album of media Shortcuts"""
+    header, header_entities = _numbered_names(batch)
+    media = [
+        INPUT_MEDIA[shortcut.content_type](
+            media=shortcut.content,
+            caption=shortcut.text,
+            caption_entities=_parse_entities(shortcut),
+            parse_mode=''
+        )
+        for _, shortcut in batch
+    ]
+    return [
+        ('send_message', {'text': header, 'entities': header_entities, 'parse_mode': ''}, False),
+        ('send_media_group', {'media': media}, True)
+    ]
+
+
+def shortcuts_plan(shortcuts, start: int = 1) -> list:
+    """Plans messages for a list of Shortcuts numbered from `start`
+
+    Consecutive short text Shortcuts are combined into one message and consecutive
+    media which can share an album are sent with send_media_group.
+    """
+    plan, batch, batch_kind, batch_length = [], [], None, 0
+
+    def single_plan(i: int, shortcut) -> list:
+        try:
+            return _single_plan(i, shortcut)
+        except (KeyError, TypeError, ValueError):
+            logging.error(f'Failed to process shortcut {shortcut.id}: {shortcut.content_type}')
+            logging.error(f'Content: {shortcut.content}')
+            return []
+
+    def flush():
+        if not batch:
+            return
+        try:
+            if batch_kind == 'text' and batch_length <= MAX_MESSAGE_LENGTH:
+                plan.extend(_text_batch_plan(batch))
+            elif len(batch) == 1:
+                plan.extend(single_plan(*batch[0]))
+            else:
+                plan.extend(_album_plan(batch))
+        except (KeyError, TypeError, ValueError):
+            # Malformed entities of a Shortcut, the others of the batch are sent one by one
+            for numbered in batch:
+                plan.extend(single_plan(*numbered))
+        batch.clear()
+
+    for i, shortcut in enumerate(shortcuts, start=start):
+        if shortcut.content_type == 'text':
+            kind = 'text'
+            length = utf16_len(f'{i}. {shortcut.shortcut_name}:\n{shortcut.text or ""}\n\n')
+            fits = batch_length + length <= MAX_MESSAGE_LENGTH
+        else:
+            kind = ALBUM_KINDS.get(shortcut.content_type)
+            length = 0
+            fits = len(batch) < MAX_MEDIA_GROUP_SIZE
+        if kind is None or kind != batch_kind or not fits:
+            flush()
+            batch_kind, batch_length = kind, 0
+        if kind is None:
+            plan.extend(single_plan(i, shortcut))
+            continue
+        batch.append((i, shortcut))
+        batch_length += length
+    flush()
+    return plan
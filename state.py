@@ -0,0 +1,137 @@
+"""Pending steps of multi-message flows (/add, /delete) shared by all bot processes.
+
+A pending step of a chat is the name of a handler for its next message and a JSON
+serializable context, so a flow started by one process can be continued by another
+one and survives restarts. Flows abandoned for STATE_TTL seconds expire.
+
+    STATE_STORE=memory                      within one process, the default
+    STATE_STORE=sql                         conversation_states table of DATABASE_URL
+    STATE_STORE=redis://localhost:6379/0    Redis or a compatible server, needs `redis` package
+"""
+from datetime import datetime as dt, timedelta
+from json import dumps, loads
+from os import getenv
+from threading import Lock
+from time import monotonic
+
+import models
+
+STATE_TTL = int(getenv('STATE_TTL', 3600))  # Seconds a pending step waits for the next message
+
+
+class MemoryStateStore:
+    """Pending steps in a dict of this process, lost on restart"""
+
+    def __init__(self, ttl: int = STATE_TTL):
+        self.ttl = ttl
+        self._states = {}
+        self._lock = Lock()
+        self._next_purge = monotonic() + ttl
+
+    def set(self, chat_id: int, step: str, context: dict = None):
+        now = monotonic()
+        # Serialized right away, so a context which can't be stored elsewhere fails here too
+        with self._lock:
+            self._states[chat_id] = (step, dumps(context or {}), now + self.ttl)
+            if now >= self._next_purge:
+                self._states = {key: value for key, value in self._states.items() if value[2] > now}
+                self._next_purge = now + self.ttl
+
+    def pop(self, chat_id: int):
+        """Removes a pending step of a chat, returns (step, context) or None"""
+        with self._lock:
+            state = self._states.pop(chat_id, None)
+        if state is None or state[2] <= monotonic():
+            return None
+        return state[0], loads(state[1])
+
+    async def async_set(self, chat_id: int, step: str, context: dict = None):
+        self.set(chat_id, step, context)
+
+    async def async_pop(self, chat_id: int):
+        return self.pop(chat_id)
+
+
+class SQLStateStore:
+    """Pending steps in the conversation_states table, expired rows are deleted once per `ttl`"""
+
+    def __init__(self, ttl: int = STATE_TTL):
+        self.ttl = ttl
+        self._next_purge = monotonic()
+
+    def _purge_due(self) -> bool:
+        now = monotonic()
+        if now < self._next_purge:
+            return False
+        self._next_purge = now + self.ttl
+        return True
+
+    def set(self, chat_id: int, step: str, context: dict = None):
+        models.set_conversation_state(chat_id, step, context or {}, dt.now() + timedelta(seconds=self.ttl))
+        if self._purge_due():
+            models.delete_expired_conversation_states()
+
+    def pop(self, chat_id: int):
+        return models.pop_conversation_state(chat_id)
+
+    async def async_set(self, chat_id: int, step: str, context: dict = None):
+        await models.async_set_conversation_state(chat_id, step, context or {}, dt.now() + timedelta(seconds=self.ttl))
+        if self._purge_due():
+            await models.async_delete_expired_conversation_states()
+
+    async def async_pop(self, chat_id: int):
+        return await models.async_pop_conversation_state(chat_id)
+
+
+class RedisStateStore:
+    """Pending steps in Redis keys which expire by themselves"""
+    KEY_PREFIX = 'shortcut_holder:state:'
+
+    def __init__(self, url: str, ttl: int = STATE_TTL):
+        import redis
+        import redis.asyncio
+
+        self.ttl = ttl
+        self.client = redis.Redis.from_url(url)
+        self.async_client = redis.asyncio.Redis.from_url(url)
+
+    def _key(self, chat_id: int) -> str:
+        return f'{self.KEY_PREFIX}{chat_id}'
+
+    def _dumps(self, step: str, context: dict) -> str:
+        return dumps({'step': step, 'context': context or {}})
+
+    def _loads(self, value):
+        if value is None:
+            return None
+        state = loads(value)
+        return state['step'], state['context']
+
+    def set(self, chat_id: int, step: str, context: dict = None):
+        self.client.set(self._key(chat_id), self._dumps(step, context), ex=self.ttl)
+
+    def pop(self, chat_id: int):
+        # GET and DEL in one MULTI instead of GETDEL, which older compatible servers lack
+        with self.client.pipeline() as pipe:
+            value, _ = pipe.get(self._key(chat_id)).delete(self._key(chat_id)).execute()
+        return self._loads(value)
+
+    async def async_set(self, chat_id: int, step: str, context: dict = None):
+        await self.async_client.set(self._key(chat_id), self._dumps(step, context), ex=self.ttl)
+
+    async def async_pop(self, chat_id: int):
+        async with self.async_client.pipeline() as pipe:
+            value, _ = await pipe.get(self._key(chat_id)).delete(self._key(chat_id)).execute()
+        return self._loads(value)
+
+
+def create_state_store(store: str = None, ttl: int = STATE_TTL):
+    """Creates a store selected by STATE_STORE"""
+    store = store or getenv('STATE_STORE', 'memory')
+    if store == 'memory':
+        return MemoryStateStore(ttl)
+    if store == 'sql':
+        return SQLStateStore(ttl)
+    if store.startswith(('redis://', 'rediss://', 'unix://')):
+        return RedisStateStore(store, ttl)
+    raise ValueError(f'Unknown STATE_STORE: {store}')
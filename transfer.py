@@ -0,0 +1,120 @@
+"""Export and import of user's shortcuts as JSON Lines, one shortcut per line:
+
+    {"shortcut_name": "card", "content_type": "text", "text": "Name: ...", "content": null, "entities": []}
+
+Both directions stream, so memory use does not depend on the number of shortcuts.
+File ids in `content` are valid only for the bot which received the files.
+"""
+from json import dumps, loads
+from os import getenv
+from tempfile import SpooledTemporaryFile
+
+import requests
+import telebot as tb
+
+from models import import_shortcuts, iter_shortcuts_export
+
+EXPORT_FIELDS = ('shortcut_name', 'content_type', 'text', 'content', 'entities')
+IMPORT_BATCH_SIZE = int(getenv('IMPORT_BATCH_SIZE', 1000))  # Shortcuts inserted in one transaction
+# Types inline results and /list can send
+CONTENT_TYPES = ('text', 'location', 'photo', 'video', 'animation', 'document', 'audio')
+
+
+def export_lines(telegram_user_id: int):
+    """Yields user's shortcuts as JSON Lines"""
+    for row in iter_shortcuts_export(telegram_user_id):
+        yield dumps(dict(zip(EXPORT_FIELDS, row)), ensure_ascii=False) + '\n'
+
+
+def export_file(telegram_user_id: int):
+    """Returns a binary file with user's shortcuts as JSON Lines, kept in memory until it grows over 1 MB"""
+    file = SpooledTemporaryFile(max_size=1024 * 1024)
+    for line in export_lines(telegram_user_id):
+        file.write(line.encode('utf-8'))
+    file.seek(0)
+    return file
+
+
+def is_valid_entity(entity) -> bool:
+    """Whether a stored entity, a dict or a JSON string, can be parsed into a MessageEntity"""
+    if not isinstance(entity, (dict, str)):
+        return False
+    try:
+        tb.types.MessageEntity.de_json(entity)
+    except (KeyError, TypeError, ValueError):
+        return False
+    return True
+
+
+def is_valid_location(content: str) -> bool:
+    """Whether content of a location shortcut is a JSON object with coordinates"""
+    try:
+        location = loads(content)
+    except ValueError:
+        return False
+    return isinstance(location, dict) and all(isinstance(location.get(key), (int, float)) for key in ('latitude', 'longitude'))
+
+
+def parse_shortcut(line) -> dict:
+    """Returns fields of a shortcut from a JSON line, None if the line does not describe a valid shortcut"""
+    try:
+        shortcut = loads(line)
+    except ValueError:
+        return None
+    if not isinstance(shortcut, dict):
+        return None
+    shortcut = {field: shortcut.get(field) for field in EXPORT_FIELDS}
+    if not isinstance(shortcut['shortcut_name'], str) or not shortcut['shortcut_name'].strip():
+        return None
+    if shortcut['content_type'] not in CONTENT_TYPES or not isinstance(shortcut['entities'] or [], list):
+        return None
+    if not all(shortcut[field] is None or isinstance(shortcut[field], str) for field in ('text', 'content')):
+        return None
+    # Text shortcuts are sent from `text`, all the others from `content`
+    if not shortcut['text' if shortcut['content_type'] == 'text' else 'content']:
+        return None
+    if shortcut['content_type'] == 'location' and not is_valid_location(shortcut['content']):
+        return None
+    shortcut['entities'] = shortcut['entities'] or []
+    if not all(is_valid_entity(entity) for entity in shortcut['entities']):
+        return None
+    return shortcut
+
+
+def import_lines(telegram_user_id: int, lines, batch_size: int = IMPORT_BATCH_SIZE) -> dict:
+    """Imports shortcuts from JSON Lines, str or bytes, in batches
+
+    Invalid lines and shortcuts with names the user already has are skipped.
+    Returns numbers of imported, duplicate and invalid shortcuts.
+    """
+    result = {'imported': 0, 'duplicates': 0, 'invalid': 0}
+    batch = {}
+
+    def flush():
+        imported = import_shortcuts(telegram_user_id, list(batch.values()))
+        result['imported'] += imported
+        result['duplicates'] += len(batch) - imported
+        batch.clear()
+
+    for line in lines:
+        if not line.strip():
+            continue
+        shortcut = parse_shortcut(line)
+        if shortcut is None:
+            result['invalid'] += 1
+        elif shortcut['shortcut_name'] in batch:
+            result['duplicates'] += 1
+        else:
+            batch[shortcut['shortcut_name']] = shortcut
+            if len(batch) >= batch_size:
+                flush()
+    if batch:
+        flush()
+    return result
+
+
+def import_url(telegram_user_id: int, url: str) -> dict:
+    """Imports shortcuts from JSON Lines downloaded line by line, e.g. a file sent to the bot"""
+    with requests.get(url, stream=True, timeout=60) as response:
+        response.raise_for_status()
+        return import_lines(telegram_user_id, response.iter_lines(chunk_size=64 * 1024))
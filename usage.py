@@ -0,0 +1,61 @@
+import logging
+from datetime import datetime as dt
+from os import getenv
+from traceback import format_exc
+
+from flusher import BackgroundFlusher
+from models import apply_usage_deltas, cache_shortcut_used
+
+
+class UsageAggregator(BackgroundFlusher):
+    """Write-behind buffer for usage counters of chosen inline results
+
+    Deltas and last use datetimes are collected in memory and written by a background
+    thread every `flush_interval` seconds or as soon as `flush_size` Shortcuts are pending,
+    as one bulk atomic UPDATE. Pending counters are also flushed at exit.
+    With `flush_interval=0` every use is written immediately.
+    """
+
+    thread_name = 'usage-flusher'
+
+    def __init__(self, flush_interval: float = 5, flush_size: int = 500):
+        super().__init__(flush_interval)
+        self.flush_size = flush_size
+
+    def record(self, shortcut_id: int, telegram_user_id: int):
+        """Count one use of a Shortcut. Never touches DB unless buffering is disabled"""
+        last_use_dt = dt.now()
+        # Cached ranking is updated right away, DB catches up on flush
+        cache_shortcut_used(telegram_user_id, shortcut_id, 1, last_use_dt)
+        if not self.flush_interval:
+            apply_usage_deltas({(telegram_user_id, shortcut_id): (1, last_use_dt)})
+            return
+        with self._lock:
+            key = (telegram_user_id, int(shortcut_id))
+            delta, _ = self._pending.get(key, (0, None))
+            self._pending[key] = (delta + 1, last_use_dt)
+            size = len(self._pending)
+        self._added(size, self.flush_size)
+
+    def flush(self):
+        """Write all pending counters to DB"""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        if not pending:
+            return
+        try:
+            apply_usage_deltas(pending)
+        except Exception:
+            logging.error(f'Failed to flush usage counters of {len(pending)} shortcuts')
+            logging.error(format_exc())
+            # Put counters back to retry on the next flush
+            with self._lock:
+                for key, (delta, last_use_dt) in pending.items():
+                    new_delta, new_last_use_dt = self._pending.get(key, (0, last_use_dt))
+                    self._pending[key] = (delta + new_delta, new_last_use_dt)
+
+
+usage_aggregator = UsageAggregator(
+    flush_interval=float(getenv('USAGE_FLUSH_INTERVAL', 5)),   # Seconds between flushes, 0 to write every use
+    flush_size=int(getenv('USAGE_FLUSH_SIZE', 500))            # Flush earlier when so many shortcuts are pending
+)
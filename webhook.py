@@ -0,0 +1,189 @@
+"""Webhook server mode: Telegram POSTs updates to a local HTTP server,
+which hands them to a pool of workers.
+
+Updates of one user always go to the same worker and are processed in order,
+so next step handlers keep working; different users are processed in parallel.
+
+Recorded updates can be replayed locally:
+    curl -X POST -H 'Content-Type: application/json' -d @update.json http://127.0.0.1:8080/webhook
+"""
+import json
+import logging
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from os import getenv
+from queue import Queue, Full
+from threading import Thread, Lock
+from time import monotonic
+from traceback import format_exc
+
+import telebot as tb
+
+import metrics
+
+
+update_latency = metrics.Histogram('webhook_update_latency_seconds', 'Time from receiving an update to the end of its processing')
+
+
+# Types of updates caused by a user
+USER_UPDATE_TYPES = ('message', 'edited_message', 'inline_query', 'chosen_inline_result', 'callback_query')
+
+
+def get_update_user_id(update) -> int:
+    """Returns id of a user who caused an update, or 0 for updates without one"""
+    for kind in USER_UPDATE_TYPES:
+        event = getattr(update, kind, None)
+        if event is not None and getattr(event, 'from_user', None) is not None:
+            return event.from_user.id
+    return 0
+
+
+class UpdateDispatcher:
+    """Routes updates to worker threads by user id, each worker has its own bounded queue"""
+
+    def __init__(self, process, workers: int = 8, queue_size: int = 1000, latency_window: int = 1000):
+        self.process = process
+        self.queues = [Queue(maxsize=queue_size) for _ in range(workers)]
+        self.processed = 0
+        self.failed = 0
+        self.rejected = 0
+        self._latencies = deque(maxlen=latency_window)
+        self._lock = Lock()
+        metrics.Gauge('webhook_queue_depth', 'Updates waiting in worker queues', lambda: sum(q.qsize() for q in self.queues))
+        self._threads = [
+            Thread(target=self._work, args=(q,), name=f'update-worker-{i}', daemon=True)
+            for i, q in enumerate(self.queues)
+        ]
+
+    def start(self):
+        for thread in self._threads:
+            thread.start()
+
+    def submit(self, update) -> bool:
+        """Queue an update, returns False if the worker's queue is full"""
+        queue = self.queues[get_update_user_id(update) % len(self.queues)]
+        try:
+            queue.put_nowait((monotonic(), update))
+            return True
+        except Full:
+            with self._lock:
+                self.rejected += 1
+            return False
+
+    def join(self):
+        """Waits until all queued updates are processed"""
+        for queue in self.queues:
+            queue.join()
+
+    def _work(self, queue: Queue):
+        while True:
+            received_at, update = queue.get()
+            try:
+                self.process(update)
+                failed = 0
+            except Exception:
+                logging.error(f'Failed to process update {update.update_id}')
+                logging.error(format_exc())
+                failed = 1
+            finally:
+                queue.task_done()
+            latency = monotonic() - received_at
+            update_latency.observe(latency)
+            with self._lock:
+                self.processed += 1
+                self.failed += failed
+                self._latencies.append(latency)
+
+    def stats(self) -> dict:
+        """Returns queue depth and latency of recently processed updates"""
+        with self._lock:
+            latencies = sorted(self._latencies)
+            processed, failed, rejected = self.processed, self.failed, self.rejected
+
+        def percentile(p):
+            return round(latencies[min(int(len(latencies) * p), len(latencies) - 1)], 4) if latencies else None
+
+        return {
+            'queue_depth': sum(q.qsize() for q in self.queues),
+            'queue_depth_per_worker': [q.qsize() for q in self.queues],
+            'processed': processed,
+            'failed': failed,
+            'rejected': rejected,
+            'latency_p50': percentile(0.5),
+            'latency_p95': percentile(0.95),
+            'latency_p99': percentile(0.99),
+            'latency_max': latencies[-1] if latencies else None,
+        }
+
+
+def make_handler(dispatcher: UpdateDispatcher, path: str, secret_token: str = None, parse=tb.types.Update.de_json):
+    """Creates an HTTP request handler class receiving Telegram updates on a path
+
+    `parse` converts a request body to what `dispatcher.submit` takes.
+    """
+
+    class WebhookHandler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            if self.path != path:
+                return self._reply(404)
+            if secret_token and self.headers.get('X-Telegram-Bot-Api-Secret-Token') != secret_token:
+                return self._reply(403)
+            try:
+                update = parse(self.rfile.read(int(self.headers.get('Content-Length', 0))).decode('utf-8'))
+            except Exception:
+                logging.error(format_exc())
+                return self._reply(400)
+            # 503 makes Telegram retry the update later
+            self._reply(200 if dispatcher.submit(update) else 503)
+
+        def do_GET(self):
+            if self.path == '/stats':
+                return self._reply(200, json.dumps(dispatcher.stats()), 'application/json')
+            if self.path == '/metrics':
+                return self._reply(200, metrics.render(), 'text/plain; version=0.0.4')
+            self._reply(404)
+
+        def _reply(self, code: int, body: str = '', content_type: str = 'text/plain'):
+            data = body.encode('utf-8')
+            self.send_response(code)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, format, *args):
+            pass
+
+    return WebhookHandler
+
+
+def serve_webhook(bot: tb.TeleBot, dispatcher, allowed_updates: list = None, parse=tb.types.Update.de_json):
+    """Hand updates POSTed by Telegram to a started dispatcher until interrupted"""
+    host = getenv('WEBHOOK_HOST', '127.0.0.1')
+    port = int(getenv('WEBHOOK_PORT', 8080))
+    path = getenv('WEBHOOK_PATH', '/webhook')
+    secret_token = getenv('WEBHOOK_SECRET')
+
+    # Public URL is registered in Telegram only if given, e.g. when behind a reverse proxy
+    if getenv('WEBHOOK_URL'):
+        bot.set_webhook(url=getenv('WEBHOOK_URL'), secret_token=secret_token, allowed_updates=allowed_updates)
+
+    server = ThreadingHTTPServer((host, port), make_handler(dispatcher, path, secret_token, parse))
+    logging.info(f'Listening for webhook updates on http://{host}:{port}{path}')
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+
+
+def run_webhook(bot: tb.TeleBot, allowed_updates: list = None):
+    """Serve Telegram updates over a webhook until interrupted"""
+    # Updates are already processed in dispatcher's workers, in order per user
+    bot.threaded = False
+    dispatcher = UpdateDispatcher(
+        lambda update: bot.process_new_updates([update]),
+        workers=int(getenv('WEBHOOK_WORKERS', 8)),
+        queue_size=int(getenv('WEBHOOK_QUEUE_SIZE', 1000))
+    )
+    dispatcher.start()
+    serve_webhook(bot, dispatcher, allowed_updates)